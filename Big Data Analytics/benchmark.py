@@ -0,0 +1,223 @@
+"""
+General description of the code: Benchmark of every pipeline stage on synthetic data at several scale factors.
+For each scale (number of E-PRTR release rows) synthetic_data.py generates the input tables, then the
+stages of pipeline.py run one after another, each in a fresh process so its peak memory is its own (the
+Spark JVM is a separate process and not part of it): profile building, country aggregation
+(countryEmissions.py), the station join, LSH grouping, LSTM training epochs and the group correlation. Wall time, CPU time and peak memory of every stage are appended as JSON
+lines to a results file tagged with the code version, and compare() lines up two runs.
+Frameworks used here: Python standard library (the stages use pandas, PySpark, PyTorch)
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from queue import Empty
+
+import pipeline
+from synthetic_data import generate, parse_scale
+
+DEFAULT_SCALES = ['10k', '100k', '1M', '10M']
+
+
+def stages(data_dir, work_dir, num_epochs=2, min_group_size=20):
+    """
+    (name, stage function, inputs, outputs, params) in run order, wired like pipeline.build_pipeline()
+    """
+    out = lambda name: os.path.join(work_dir, name)
+    profiles = {'profiles_csv': out('emissionProfilesData.csv'), 'profiles_parquet': out('emissionProfilesData.parquet'),
+                'profile_matrix': out('emissionProfiles.npz')}
+    similarity = {'similarity_index': out('facilitySimilarityIndex'), 'groups': out('groups.npz')}
+    model_data = {'model_data': out('modelFeatures')}
+    weather = {'weather': os.path.join(data_dir, 'gsod', 'weather.csv')}
+    return [
+        ('profile_building', pipeline.profiles_stage, {'eprtr': os.path.join(data_dir, 'eprtr')}, profiles, {}),
+        ('country_aggregation', pipeline.country_emissions_stage, profiles,
+         {'country_means': out('avgEmissionPerCountry.csv'), 'country_stats': out('countryEmissionStats.parquet')}, {}),
+        ('lsh_grouping', pipeline.similarity_stage, profiles, similarity, {}),
+        ('station_join', pipeline.model_data_stage, {**weather, **profiles, **similarity}, model_data, {}),
+        ('lstm_training', pipeline.training_stage, model_data, {'model': out('facility_emissions_lstm.pt')},
+         {'num_epochs': num_epochs}),
+        ('correlation', pipeline.correlation_stage, model_data, {'group_correlation': out('groupCorrelation.csv')},
+         {'min_size': min_group_size}),
+    ]
+
+
+def _max_rss_mb(who):
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def _measure(func, inputs, outputs, params, queue, trace_python=False):
+    # tracemalloc slows down every allocation, so it only runs in a separate run whose times are not kept
+    if trace_python:
+        tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    error = None
+    try:
+        func(inputs, outputs, **params)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    if trace_python:
+        queue.put({'python_peak_mb': tracemalloc.get_traced_memory()[1] / 2 ** 20, 'error': error})
+        return
+    result = {'wall_s': time.perf_counter() - wall, 'cpu_s': time.process_time() - cpu,
+              'peak_rss_mb': _max_rss_mb(resource.RUSAGE_SELF),
+              # Child processes that have exited (DataLoader workers, the correlation process pool)
+              'peak_rss_children_mb': _max_rss_mb(resource.RUSAGE_CHILDREN),
+              'python_peak_mb': None, 'error': error}
+    queue.put(result)
+
+
+def _clear(outputs):
+    """
+    Remove the outputs of a stage and what it keeps next to them (e.g. <model>.checkpoints), so an earlier
+    run is never resumed or reused
+    """
+    for path in outputs.values():
+        directory, name = os.path.split(path.rstrip('/'))
+        for entry in os.listdir(directory or '.'):
+            if entry == name or entry.startswith(name + '.'):
+                entry = os.path.join(directory, entry)
+                shutil.rmtree(entry) if os.path.isdir(entry) else os.remove(entry)
+
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def run_stage(func, inputs, outputs, params, trace_python=False):
+    """
+    Run one stage in a fresh (spawned) process and return its measurements.
+    With trace_python only the peak of Python allocations (tracemalloc) is measured.
+    """
+    context = mp.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(func, inputs, outputs, params, queue, trace_python))
+    started = time.perf_counter()
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            # Killed (e.g. out of memory) before it could report
+            if not process.is_alive():
+                result = {'wall_s': time.perf_counter() - started, 'cpu_s': None, 'peak_rss_mb': None,
+                          'peak_rss_children_mb': None, 'python_peak_mb': None,
+                          'error': 'stage process exited with code {}'.format(process.exitcode)}
+                break
+    process.join()
+    result['output_bytes'] = sum(_size(path) for path in outputs.values())
+    return result
+
+
+def code_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmark(scales=DEFAULT_SCALES, work_dir='benchmark_data', results_path='benchmark_results.jsonl',
+                  only=None, num_epochs=2, seed=0, python_memory=False, log=print):
+    """
+    Generate data for every scale and run the stages on it (only: subset of stage names).
+    With python_memory every stage runs a second time under tracemalloc for python_peak_mb.
+    A failed stage is recorded with its error and the later stages of that scale are skipped.
+    Returns the list of result records, which are also appended to results_path.
+    """
+    version = code_version()
+    records = []
+    for scale in scales:
+        release_rows = parse_scale(scale)
+        scale_dir = os.path.join(work_dir, '{}_seed{}'.format(release_rows, seed))
+        sizes_path = os.path.join(scale_dir, 'sizes.json')
+        if os.path.exists(sizes_path):
+            # The generated data only depends on scale and seed, it is reused between runs
+            with open(sizes_path) as f:
+                sizes = json.load(f)
+        else:
+            started = time.perf_counter()
+            sizes = generate(scale_dir, release_rows, seed=seed)
+            with open(sizes_path, 'w') as f:
+                json.dump(sizes, f)
+            log(f"[{scale}] generated {sizes} in {time.perf_counter() - started:.1f}s")
+        # Stages that are not run (see only) leave their outputs of an earlier run for the later stages
+        output_dir = os.path.join(scale_dir, 'output')
+        os.makedirs(output_dir, exist_ok=True)
+        for name, func, inputs, outputs, params in stages(scale_dir, output_dir, num_epochs):
+            if only and name not in only:
+                continue
+            _clear(outputs)
+            record = {'version': version, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+                      'cpus': os.cpu_count(), 'scale': release_rows, **sizes, 'stage': name}
+            record.update(run_stage(func, inputs, outputs, params))
+            if python_memory and not record['error']:
+                _clear(outputs)
+                traced = run_stage(func, inputs, outputs, params, trace_python=True)
+                record['python_peak_mb'] = traced.get('python_peak_mb')
+            records.append(record)
+            with open(results_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            if record['error']:
+                log(f"[{scale}] {name} failed after {record['wall_s']:.2f}s: {record['error']}")
+                break
+            log(f"[{scale}] {name}: {record['wall_s']:.2f}s wall, {record['cpu_s']:.2f}s cpu, {record['peak_rss_mb']:.0f} MB peak")
+    return records
+
+
+def load_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(results, baseline_version, version, metric='wall_s'):
+    """
+    {(scale, stage): (baseline, current, current / baseline)} for the latest record of each version
+    """
+    latest = {}
+    for record in results:
+        if record['version'] in (baseline_version, version) and not record.get('error') and record.get(metric) is not None:
+            latest[record['version'], record['scale'], record['stage']] = record[metric]
+    table = {}
+    for (v, scale, stage), value in latest.items():
+        if v == baseline_version and (version, scale, stage) in latest:
+            current = latest[version, scale, stage]
+            table[scale, stage] = (value, current, current / value if value else float('nan'))
+    return dict(sorted(table.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on synthetic data")
+    parser.add_argument("--scales", nargs="*", default=DEFAULT_SCALES, help="release rows per run, e.g. 10k 100k 1M 10M")
+    parser.add_argument("--stages", nargs="*", default=None, help="only run these stages")
+    parser.add_argument("--work-dir", default="benchmark_data")
+    parser.add_argument("--results", default="benchmark_results.jsonl")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--python-memory", action="store_true",
+                        help="run every stage a second time under tracemalloc to record python_peak_mb")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "VERSION"), help="compare two recorded versions instead of running")
+    parser.add_argument("--metric", default="wall_s", choices=["wall_s", "cpu_s", "peak_rss_mb", "python_peak_mb"])
+    args = parser.parse_args()
+
+    if args.compare:
+        for (scale, stage), (baseline, current, ratio) in compare(load_results(args.results), *args.compare, args.metric).items():
+            print(f"{scale:>10} {stage:<20} {baseline:10.2f} {current:10.2f} {ratio:6.2f}x")
+        return
+    run_benchmark(args.scales, args.work_dir, args.results, args.stages, args.epochs, python_memory=args.python_memory)
+
+
+if __name__ == "__main__":
+    main()
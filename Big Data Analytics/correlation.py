@@ -0,0 +1,172 @@
+"""
+General description of the code: Vectorized Pearson correlation with two-sided p-values.
+The p-values come from the closed form t = r * sqrt((n - 2) / (1 - r^2)) with n - 2 degrees of freedom,
+which is what scipy.stats.pearsonr computes, but for the whole matrix in a few NumPy operations instead of
+one pearsonr call per cell. cross_correlation() only computes the pollutant x climate-variable block used
+in Parts 5 and 6 of predictive_model.py. CorrelationMoments keeps the same block as mergeable sufficient
+statistics, so it can be computed per partition and combined without collecting raw rows.
+permutation_test() gives distribution-free p-values for skewed, zero-inflated emissions: every batch of
+shuffles is a single matrix product.
+Frameworks used here: NumPy, SciPy
+"""
+
+import numpy as np
+from scipy import stats
+
+CLIMATE_COLUMNS = ['Change_in_avg_temp', 'change_in_avg_max_temp', 'change_in_avg_precipitation']
+
+
+def _standardize(data):
+    data = np.asarray(data, dtype=np.float64)
+    centered = data - data.mean(axis=0)
+    norms = np.sqrt((centered ** 2).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Constant columns have no correlation, they come out as NaN like np.corrcoef
+        return centered / np.where(norms > 0, norms, np.nan)
+
+
+def pearson_pvalues(r, n):
+    """
+    Two-sided p-values of correlation coefficients r computed from n samples
+    """
+    r = np.asarray(r, dtype=np.float64)
+    df = n - 2
+    if df <= 0:
+        return np.full(r.shape, np.nan)
+    r = np.clip(r, -1.0, 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(df / (1.0 - r ** 2))
+    p = 2 * stats.t.sf(np.abs(t), df)
+    # |r| == 1 gives an infinite t statistic, its p-value is 0
+    return np.where(np.abs(r) == 1.0, 0.0, p)
+
+
+def cross_correlation(X, Y):
+    """
+    Correlation coefficients and p-values between every column of X ([samples, pollutants]) and every
+    column of Y ([samples, climate variables]); both results are [pollutants, climate variables]
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if X.shape[0] != Y.shape[0]:
+        raise ValueError("X has {} samples but Y has {}".format(X.shape[0], Y.shape[0]))
+    r = np.clip(_standardize(X).T @ _standardize(Y), -1.0, 1.0)
+    return r, pearson_pvalues(r, X.shape[0])
+
+
+class CorrelationMoments:
+    """
+    Count, means, sums of squared deviations and co-moments of X ([samples, pollutants]) against
+    Y ([samples, climate variables]). Batches and partial results are combined with Chan et al.'s pairwise
+    update, which stays numerically stable where raw sums of squares would cancel.
+    """
+
+    def __init__(self, num_x, num_y):
+        self.n = 0
+        self.mean_x = np.zeros(num_x)
+        self.mean_y = np.zeros(num_y)
+        self.m2_x = np.zeros(num_x)
+        self.m2_y = np.zeros(num_y)
+        self.co_moment = np.zeros((num_x, num_y))
+
+    @classmethod
+    def from_batch(cls, X, Y):
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        moments = cls(X.shape[1], Y.shape[1])
+        if len(X):
+            moments.n = len(X)
+            moments.mean_x = X.mean(axis=0)
+            moments.mean_y = Y.mean(axis=0)
+            centered_x = X - moments.mean_x
+            centered_y = Y - moments.mean_y
+            moments.m2_x = (centered_x ** 2).sum(axis=0)
+            moments.m2_y = (centered_y ** 2).sum(axis=0)
+            moments.co_moment = centered_x.T @ centered_y
+        return moments
+
+    def update(self, X, Y):
+        return self.merge(CorrelationMoments.from_batch(X, Y))
+
+    def merge(self, other):
+        """
+        Fold other into self (in place) and return self
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.__dict__.update({k: np.copy(v) if isinstance(v, np.ndarray) else v for k, v in other.__dict__.items()})
+            return self
+        n = self.n + other.n
+        delta_x = other.mean_x - self.mean_x
+        delta_y = other.mean_y - self.mean_y
+        weight = self.n * other.n / n
+        self.mean_x = self.mean_x + delta_x * other.n / n
+        self.mean_y = self.mean_y + delta_y * other.n / n
+        self.m2_x = self.m2_x + other.m2_x + delta_x ** 2 * weight
+        self.m2_y = self.m2_y + other.m2_y + delta_y ** 2 * weight
+        self.co_moment = self.co_moment + other.co_moment + np.outer(delta_x, delta_y) * weight
+        self.n = n
+        return self
+
+    def correlation(self):
+        """
+        ([pollutants, climate variables] coefficients, p-values); constant columns give NaN
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = np.sqrt(np.outer(self.m2_x, self.m2_y))
+            r = np.clip(self.co_moment / np.where(denominator > 0, denominator, np.nan), -1.0, 1.0)
+        return r, pearson_pvalues(r, self.n)
+
+
+def _wilson_interval(hits, trials, z):
+    centre = (hits + z ** 2 / 2) / (trials + z ** 2)
+    half = z * np.sqrt(hits * (trials - hits) / trials + z ** 2 / 4) / (trials + z ** 2)
+    return centre - half, centre + half
+
+
+def permutation_test(X, Y, num_permutations=10000, batch_size=256, seed=0, alpha=0.05, early_stop=True, z=3.0):
+    """
+    Two-sided permutation p-values for the correlation of every column of X with every column of Y.
+    Y's rows are shuffled num_permutations times (reproducibly from seed), and p = (hits + 1) / (m + 1)
+    where hits counts shuffles with |r| at least the observed |r|. A batch of shuffles is evaluated as one
+    [pollutants, samples] x [samples, batch * climate variables] product. With early_stop, a cell stops
+    once a Wilson interval (z standard errors) around its p-value lies entirely above or below alpha.
+    Returns (r, p, permutations used per cell).
+    """
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    Xs = _standardize(X)
+    Ys = _standardize(Y)
+    observed = np.clip(Xs.T @ Ys, -1.0, 1.0)
+    num_x, num_y = observed.shape
+    n = X.shape[0]
+
+    hits = np.zeros(observed.shape, dtype=np.int64)
+    trials = np.zeros(observed.shape, dtype=np.int64)
+    # Cells with a NaN correlation (constant columns) have nothing to test
+    active = ~np.isnan(observed)
+    Xs = np.nan_to_num(Xs)
+    Ys = np.nan_to_num(Ys)
+    threshold = np.abs(observed) - 1e-12
+
+    done = 0
+    while done < num_permutations and active.any():
+        batch = min(batch_size, num_permutations - done)
+        rows = np.flatnonzero(active.any(axis=1))
+        permutations = rng.permuted(np.broadcast_to(np.arange(n), (batch, n)), axis=1)
+        # [samples, batch * climate variables] of shuffled climate columns
+        shuffled = Ys[permutations].transpose(1, 0, 2).reshape(n, batch * num_y)
+        r = (Xs[:, rows].T @ shuffled).reshape(len(rows), batch, num_y)
+        exceed = (np.abs(r) >= threshold[rows, np.newaxis, :]).sum(axis=1)
+        hits[rows] += np.where(active[rows], exceed, 0)
+        trials[rows] += np.where(active[rows], batch, 0)
+        done += batch
+        if early_stop:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                low, high = _wilson_interval(hits, np.maximum(trials, 1), z)
+            active &= ~((high < alpha) | (low > alpha))
+
+    p = np.where(np.isnan(observed), np.nan, (hits + 1) / (trials + 1))
+    return observed, p, trials
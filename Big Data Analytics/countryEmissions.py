@@ -1,51 +1,94 @@
-
 # Team Members - Deepika Gonela, Pandre Vamshi, Akshith Reddy Kota, Krishna Tej Alahari
 # From the emission profile data of each facility,
 # computing the average emission for each pollutant grouped by country in the european union
 # Frameworks used here: PySpark, ran using GCP computes with similar configuration from assignment2
+# The aggregation runs on the DataFrame API: mean, sum, count, min and max of every pollutant are computed
+# per country in a single groupBy, on as many cores as the configured master gives us.
+
+import argparse
 
-import csv
-from pyspark import SparkContext
 from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+from profile_store import load_profiles_spark
+
+# Excluding rowid, facility_id and the country columns; every pollutant plus Lat/Long is aggregated
+KEY_COLUMNS = ('', '_c0', 'Unnamed: 0', 'FacilityID', 'CountryCode', 'CountryName')
+
+
+def create_session(master="local[*]", shuffle_partitions=None, app_name="countryEmissions"):
+    builder = SparkSession.builder.master(master).appName(app_name)
+    if shuffle_partitions is not None:
+        builder = builder.config("spark.sql.shuffle.partitions", str(shuffle_partitions))
+    return builder.getOrCreate()
+
+
+def value_columns(columns):
+    return [col for col in columns if col not in KEY_COLUMNS]
+
+
+def country_statistics(profiles, country_column='CountryName'):
+    """
+    One pass aggregation of every value column grouped by country.
+    Returns (stats, columns) where stats has Country, CountryCode, count and sum_i/min_i/max_i for columns[i]
+    """
+    columns = value_columns(profiles.columns)
+    values = [F.coalesce(F.col('`{}`'.format(col)).cast('double'), F.lit(0.0)) for col in columns]
+    aggregations = [F.count(F.lit(1)).alias('count')]
+    for i, value in enumerate(values):
+        aggregations += [F.sum(value).alias('sum_{}'.format(i)),
+                         F.min(value).alias('min_{}'.format(i)),
+                         F.max(value).alias('max_{}'.format(i))]
+    stats = profiles.groupBy(F.col(country_column).alias('Country')) \
+        .agg(F.first('CountryCode').alias('CountryCode'), *aggregations)
+    return stats, columns
 
-sc = SparkContext("local").getOrCreate()
-spark = SparkSession.builder.appName("local").getOrCreate()
 
-# Reading the emission profiles data
-myRdd = sc.textFile("emissionProfilesData.csv")
+def country_means(stats, columns):
+    """
+    Wide table with the average emission of each pollutant per country (the avgEmissionPerCountry.csv layout)
+    """
+    return stats.select('Country', *[(F.col('sum_{}'.format(i)) / F.col('count')).alias(col) for i, col in enumerate(columns)],
+                        'CountryCode')
 
-header = myRdd.first()
-myRdd = myRdd.filter(lambda row: row != header)
-myRdd = myRdd.map(lambda line: line.split(","))
 
-# print(myRdd.take(3))
+def country_statistics_long(stats, columns):
+    """
+    Long table (Country, CountryCode, Pollutant, mean, sum, count, min, max), one row per country and pollutant
+    """
+    rows = F.array(*[F.struct(F.lit(col).alias('Pollutant'),
+                              (F.col('sum_{}'.format(i)) / F.col('count')).alias('mean'),
+                              F.col('sum_{}'.format(i)).alias('sum'),
+                              F.col('min_{}'.format(i)).alias('min'),
+                              F.col('max_{}'.format(i)).alias('max')) for i, col in enumerate(columns)])
+    return stats.select('Country', 'CountryCode', 'count', F.explode(rows).alias('s')) \
+        .select('Country', 'CountryCode', 's.Pollutant', 's.mean', 's.sum', 'count', 's.min', 's.max')
 
-totalCols = 95
-# Excluding rowid, facility_id, country_dode
-col_to_drop = [0, 1, 93, 94]
 
-new_rdd = myRdd.map(lambda row: (tuple(float(value) for i, value in enumerate(row) if i not in col_to_drop), row[-1]))
-flat_rdd = new_rdd.map(lambda x: tuple(list(x[0]) + [x[1]]))
-print(flat_rdd.take(1))
+def main():
+    parser = argparse.ArgumentParser(description="Per-country emission statistics")
+    parser.add_argument("--master", default="local[*]", help="Spark master, e.g. local[*], local[8] or yarn")
+    parser.add_argument("--shuffle-partitions", type=int, default=None)
+    parser.add_argument("--input", default="emissionProfilesData.csv")
+    parser.add_argument("--means-output", default="avgEmissionPerCountry.csv")
+    parser.add_argument("--stats-output", default="countryEmissionStats.parquet")
+    args = parser.parse_args()
 
-# Computing the average emission for each pollutant grouped by country
-result = flat_rdd.map(lambda x: (x[-1], tuple(x[:-1]) + (1,))).reduceByKey(lambda x, y: tuple(xi + yi for xi, yi in zip(x, y))) \
-    .mapValues(lambda x: tuple(xi/x[-1] if xi != 0 else 0 for xi in x[:-1]))
+    spark = create_session(args.master, args.shuffle_partitions)
 
-result = result.map(lambda x: ([x[0]] + list(x[1])))
+    # Reading the emission profiles data, from the typed Parquet copy when it exists (falls back to the CSV)
+    profiles = load_profiles_spark(spark, args.input)
 
-# collecting column Names
-column_names = []
-with open("emissionProfilesData.csv", newline='') as csvfile:
-    reader = csv.DictReader(csvfile)
-    column_names = reader.fieldnames
+    # Computing the statistics of each pollutant grouped by country, cached since both outputs reuse it
+    stats, columns = country_statistics(profiles)
+    stats = stats.cache()
 
-csvfile.close()
+    # Averages, one small row per country so a single CSV file is kept for the visualisation step
+    country_means(stats, columns).coalesce(1).write.mode("overwrite").csv(args.means_output, header=True)
 
-column_names = ['Country'] + column_names[2:-2]
-print(column_names)
-df = result.toDF(column_names)
+    # Full statistics, partitioned by country
+    country_statistics_long(stats, columns).write.mode("overwrite").partitionBy("Country").parquet(args.stats_output)
 
-# Writing to a single CSV
-df.coalesce(1).write.csv("avgEmissionPerCountry.csv", header=True)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+General description of the code: Out-of-core emission profile builder for the E-PRTR tables.
+The reporting years are filtered first, then the facility reports of those years are kept as a small
+lookup table and the (large) pollutant release table is streamed in chunks. Every chunk is added straight
+into a sparse facility x pollutant matrix, so peak memory depends on the number of facilities (and the
+pollutants they actually report) and not on the number of release rows.
+Frameworks used here: pandas, NumPy, SciPy
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+FACILITY_REPORT_FILE = 'dbo.PUBLISH_FACILITYREPORT.csv'
+POLLUTANT_RELEASE_FILE = 'dbo.PUBLISH_POLLUTANTRELEASE.csv'
+REPORT_FILE = 'dbo.PUBLISH_POLLUTANTRELEASEANDTRANSFERREPORT.csv'
+
+
+def read_reports(path, min_year=2017, chunksize=500000, max_year=None):
+    """
+    PollutantReleaseAndTransferReportID -> (CountryCode, CountryName) for reports from min_year on
+    (up to max_year when given)
+    """
+    parts = []
+    for chunk in pd.read_csv(path, encoding='latin-1', chunksize=chunksize,
+                             usecols=['PollutantReleaseAndTransferReportID', 'ReportingYear', 'CountryCode', 'CountryName']):
+        selected = chunk['ReportingYear'] >= min_year
+        if max_year is not None:
+            selected &= chunk['ReportingYear'] <= max_year
+        parts.append(chunk[selected].drop(columns='ReportingYear'))
+    return pd.concat(parts, ignore_index=True)
+
+
+def read_facility_reports(path, reports, chunksize=500000):
+    """
+    Facility reports belonging to the selected reporting years, with the country columns attached
+    """
+    report_ids = reports['PollutantReleaseAndTransferReportID'].values
+    parts = []
+    for chunk in pd.read_csv(path, encoding='latin-1', chunksize=chunksize,
+                             usecols=['FacilityReportID', 'PollutantReleaseAndTransferReportID', 'FacilityID', 'Lat', 'Long']):
+        parts.append(chunk[chunk['PollutantReleaseAndTransferReportID'].isin(report_ids)])
+    facility_reports = pd.concat(parts, ignore_index=True)
+    return facility_reports.merge(reports, on='PollutantReleaseAndTransferReportID')
+
+
+class EmissionProfileMatrix:
+    """
+    Sparse (CSR) facility x pollutant emission profiles.
+    Row i belongs to facility_ids[i], column j to pollutants[j]; pollutants that a facility did not report
+    are not stored.
+    """
+
+    def __init__(self, matrix, facility_ids, pollutants):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.facility_ids = np.asarray(facility_ids, dtype=np.int64)
+        self.pollutants = list(pollutants)
+        if self.matrix.shape != (len(self.facility_ids), len(self.pollutants)):
+            raise ValueError("matrix shape {} does not match {} facilities x {} pollutants".format(
+                self.matrix.shape, len(self.facility_ids), len(self.pollutants)))
+        # FacilityID -> row lookups through a sorted copy of the ids
+        self._order = np.argsort(self.facility_ids, kind='stable')
+        self._sorted_ids = self.facility_ids[self._order]
+
+    @classmethod
+    def from_frame(cls, finalData, pollutantColumns):
+        values = finalData.loc[:, pollutantColumns].fillna(0).values
+        return cls(sparse.csr_matrix(values), finalData['FacilityID'].values, pollutantColumns)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def rows_of(self, facility_ids):
+        """
+        Row positions of the given FacilityIDs, raises KeyError for unknown facilities
+        """
+        facility_ids = np.asarray(facility_ids, dtype=np.int64).reshape(-1)
+        positions = np.searchsorted(self._sorted_ids, facility_ids)
+        positions = np.minimum(positions, len(self._sorted_ids) - 1)
+        missing = self._sorted_ids[positions] != facility_ids if len(self._sorted_ids) else np.ones(len(facility_ids), dtype=bool)
+        if missing.any():
+            raise KeyError("unknown FacilityIDs: {}".format(facility_ids[missing][:10].tolist()))
+        return self._order[positions]
+
+    def rows_for(self, facility_ids):
+        """
+        Sparse sub-matrix holding the profiles of the given FacilityIDs, in the given order
+        """
+        return self.matrix[self.rows_of(facility_ids)]
+
+    def dense(self, facility_ids=None, dtype=np.float32):
+        """
+        Dense [facilities, pollutants] array for model inputs (all facilities when facility_ids is None)
+        """
+        matrix = self.matrix if facility_ids is None else self.rows_for(facility_ids)
+        return matrix.astype(dtype).toarray()
+
+    def to_frame(self):
+        frame = pd.DataFrame(self.matrix.toarray(), columns=pd.Index(self.pollutants, name='PollutantName'))
+        frame.insert(0, 'FacilityID', self.facility_ids)
+        return frame
+
+    def save(self, path):
+        np.savez(path, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 shape=np.array(self.matrix.shape), facility_ids=self.facility_ids,
+                 pollutants=np.array(self.pollutants, dtype=object))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as f:
+            matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            return cls(matrix, f['facility_ids'], f['pollutants'].tolist())
+
+
+def accumulate_releases(data_dir, reports, chunksize=500000):
+    """
+    Sum the pollutant releases of the given reports (a read_reports() table) per facility and pollutant.
+    Returns (profiles, facility_info) like build_emission_profile_matrix(), facility_info also holds
+    ReleaseRows, the number of release rows the Lat/Long averages were taken over.
+    """
+    data_dir = data_dir.rstrip('/') + '/'
+    facility_reports = read_facility_reports(data_dir + FACILITY_REPORT_FILE, reports, chunksize)
+
+    # Compact facility numbering, one row per facility in the output
+    facilityIDs = np.unique(facility_reports['FacilityID'].values)
+    lookup = facility_reports.drop_duplicates('FacilityReportID').set_index('FacilityReportID')
+    lookup['row'] = np.searchsorted(facilityIDs, lookup['FacilityID'].values)
+
+    num_facilities = len(facilityIDs)
+    pollutant_index = {}
+    totals = sparse.csr_matrix((num_facilities, 0), dtype=np.float64)
+    location = np.zeros((num_facilities, 2), dtype=np.float64)
+    release_rows = np.zeros(num_facilities, dtype=np.int64)
+
+    for chunk in pd.read_csv(data_dir + POLLUTANT_RELEASE_FILE, encoding='latin-1', chunksize=chunksize,
+                             usecols=['FacilityReportID', 'PollutantName', 'TotalQuantity']):
+        chunk = chunk[chunk['FacilityReportID'].isin(lookup.index)]
+        if chunk.empty:
+            continue
+        for name in chunk['PollutantName'].unique():
+            if name not in pollutant_index:
+                pollutant_index[name] = len(pollutant_index)
+        matched = lookup.reindex(chunk['FacilityReportID'].values)
+        rows = matched['row'].values
+        cols = chunk['PollutantName'].map(pollutant_index).values
+        shape = (num_facilities, len(pollutant_index))
+        totals.resize(shape)
+        # Duplicate (facility, pollutant) entries are summed by the COO -> CSR conversion
+        totals = totals + sparse.coo_matrix((chunk['TotalQuantity'].fillna(0).values, (rows, cols)), shape=shape).tocsr()
+        np.add.at(location, rows, matched[['Lat', 'Long']].values)
+        np.add.at(release_rows, rows, 1)
+
+    # Only facilities that reported releases in the selected years, pollutants in name order like the former pivot
+    keep = release_rows > 0
+    pollutants = sorted(pollutant_index)
+    order = [pollutant_index[name] for name in pollutants]
+    profiles = EmissionProfileMatrix(totals[np.flatnonzero(keep)][:, order], facilityIDs[keep], pollutants)
+    profiles.matrix.eliminate_zeros()
+
+    facility_info = pd.DataFrame({'FacilityID': facilityIDs[keep],
+                                  'Lat': location[keep, 0] / release_rows[keep],
+                                  'Long': location[keep, 1] / release_rows[keep],
+                                  'ReleaseRows': release_rows[keep]})
+    countries = facility_reports.drop_duplicates('FacilityID').set_index('FacilityID')
+    facility_info['CountryCode'] = countries['CountryCode'].reindex(facility_info['FacilityID']).values
+    facility_info['CountryName'] = countries['CountryName'].reindex(facility_info['FacilityID']).values
+    return profiles, facility_info
+
+
+def build_emission_profile_matrix(data_dir, min_year=2017, chunksize=500000, max_year=None):
+    """
+    Build the per-facility emission profiles (summed TotalQuantity per pollutant over the years min_year
+    to max_year, max_year=None means every later year).
+    Returns (profiles, facility_info) where profiles is an EmissionProfileMatrix with pollutants sorted by
+    name and facility_info holds FacilityID, Lat, Long, CountryCode, CountryName in the same row order.
+    Lat/Long are averaged over the release rows of each facility, the country columns are the first seen.
+    """
+    data_dir = data_dir.rstrip('/') + '/'
+    reports = read_reports(data_dir + REPORT_FILE, min_year, chunksize, max_year)
+    return accumulate_releases(data_dir, reports, chunksize)
@@ -0,0 +1,270 @@
+"""
+General description of the code: Memory-mapped feature store for the facility data of Parts 4-6.
+The aligned per-facility emission profiles (features), climate deltas (targets), similarity groups and
+countries are written once as flat float32/int files next to a small JSON description. Readers map the
+files instead of loading them, so training, correlation, LSH and visualization all get views of the same
+pages, and worker processes that open the store share them through the page cache. A store pickles as its
+path, so handing it (or a slice of it) to a process pool or DataLoader worker never copies the data.
+Frameworks used here: NumPy, PyTorch (optional, for FeatureDataset)
+"""
+
+import json
+import os
+
+import numpy as np
+
+# name -> (file, dtype); features and targets are 2-D, the others have one value per row
+_COLUMNS = {
+    'facility_ids': ('facility_ids.i64', np.int64),
+    'features': ('features.f32', np.float32),
+    'targets': ('targets.f32', np.float32),
+    'group_ids': ('group_ids.i64', np.int64),
+    'countries': ('countries.i32', np.int32),
+}
+
+
+class FeatureStoreWriter:
+    """
+    Appends blocks of rows to a new store. Rows keep the order they were appended in, so appending one
+    similarity group at a time keeps every group contiguous.
+    """
+
+    def __init__(self, path, pollutants, target_columns=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = {'pollutants': list(pollutants), 'target_columns': list(target_columns or []),
+                     'columns': ['facility_ids', 'features'], 'countries': [], 'rows': 0}
+        self._country_codes = {}
+        self._files = {}
+
+    def _write(self, name, values):
+        if name not in self._files:
+            if self.meta['rows']:
+                raise ValueError("{} has to be given from the first block on".format(name))
+            self._files[name] = open(os.path.join(self.path, _COLUMNS[name][0]), 'wb')
+            if name not in self.meta['columns']:
+                self.meta['columns'].append(name)
+        self._files[name].write(np.ascontiguousarray(values, dtype=_COLUMNS[name][1]).tobytes())
+
+    def append(self, facility_ids, features, targets=None, group_ids=None, countries=None):
+        facility_ids = np.asarray(facility_ids, dtype=np.int64).reshape(-1)
+        features = np.asarray(features, dtype=np.float32)
+        if features.shape != (len(facility_ids), len(self.meta['pollutants'])):
+            raise ValueError("features of shape {} for {} facilities x {} pollutants".format(
+                features.shape, len(facility_ids), len(self.meta['pollutants'])))
+        self._write('facility_ids', facility_ids)
+        self._write('features', features)
+        if targets is not None:
+            self._write('targets', np.asarray(targets, dtype=np.float32).reshape(len(facility_ids), len(self.meta['target_columns'])))
+        if group_ids is not None:
+            self._write('group_ids', np.broadcast_to(np.asarray(group_ids, dtype=np.int64), facility_ids.shape))
+        if countries is not None:
+            codes = [self._country_codes.setdefault(name, len(self._country_codes)) for name in countries]
+            self._write('countries', codes)
+        self.meta['rows'] += len(facility_ids)
+
+    def close(self):
+        # Without any block appended the store is empty, its column files still exist
+        for name in self.meta['columns']:
+            if name not in self._files:
+                self._files[name] = open(os.path.join(self.path, _COLUMNS[name][0]), 'wb')
+        for name, f in self._files.items():
+            f.close()
+            if name != 'facility_ids' and os.path.getsize(f.name) != self.meta['rows'] * self._row_bytes(name):
+                raise ValueError("{} was not given for every block".format(name))
+        self.meta['countries'] = sorted(self._country_codes, key=self._country_codes.get)
+        # FacilityID -> row index, a sorted copy of the ids and the rows in that order
+        ids = np.fromfile(os.path.join(self.path, _COLUMNS['facility_ids'][0]), dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        np.save(os.path.join(self.path, 'id_order.npy'), order)
+        np.save(os.path.join(self.path, 'sorted_ids.npy'), ids[order])
+        # The description is written last, a store without it is incomplete
+        with open(os.path.join(self.path, 'meta.json.tmp'), 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(os.path.join(self.path, 'meta.json.tmp'), os.path.join(self.path, 'meta.json'))
+        return FeatureStore.open(self.path)
+
+    def _row_bytes(self, name):
+        width = {'features': len(self.meta['pollutants']), 'targets': len(self.meta['target_columns'])}.get(name, 1)
+        return width * np.dtype(_COLUMNS[name][1]).itemsize
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self._files.values():
+                f.close()
+
+
+class FeatureStore:
+    """
+    Read side of a store: facility_ids, features [rows, pollutants], targets [rows, target columns],
+    group_ids and countries are memory-mapped arrays (None when the store was written without them).
+    mode 'c' maps copy-on-write, which torch.from_numpy needs for a writable view.
+    Also usable wherever an EmissionProfileMatrix is expected for hashing (facility_ids, pollutants, matrix).
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.pollutants = self.meta['pollutants']
+        self.target_columns = self.meta['target_columns']
+        self.country_names = self.meta['countries']
+        rows = self.meta['rows']
+        shapes = {'features': (rows, len(self.pollutants)), 'targets': (rows, len(self.target_columns))}
+        for name, (file, dtype) in _COLUMNS.items():
+            array = None
+            if name in self.meta['columns']:
+                shape = shapes.get(name, (rows,))
+                # np.memmap cannot map an empty file
+                array = np.memmap(os.path.join(path, file), dtype=dtype, mode=mode, shape=shape) if rows \
+                    else np.empty(shape, dtype=dtype)
+            setattr(self, name, array)
+        self._order = np.load(os.path.join(path, 'id_order.npy'), mmap_mode='r')
+        self._sorted_ids = np.load(os.path.join(path, 'sorted_ids.npy'), mmap_mode='r')
+        self._groups = None
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        return cls(path, mode)
+
+    @classmethod
+    def write(cls, path, facility_ids, features, pollutants, targets=None, target_columns=None, group_ids=None, countries=None):
+        """
+        Write a whole store in one call and open it
+        """
+        writer = FeatureStoreWriter(path, pollutants, target_columns)
+        writer.append(facility_ids, features, targets, group_ids, countries)
+        return writer.close()
+
+    def __getstate__(self):
+        return {'path': self.path, 'mode': self.mode}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['mode'])
+
+    def __len__(self):
+        return self.meta['rows']
+
+    @property
+    def shape(self):
+        return self.features.shape
+
+    @property
+    def matrix(self):
+        return self.features
+
+    def rows_of(self, facility_ids):
+        """
+        Row positions of the given FacilityIDs, raises KeyError for unknown facilities
+        """
+        facility_ids = np.asarray(facility_ids, dtype=np.int64).reshape(-1)
+        positions = np.minimum(np.searchsorted(self._sorted_ids, facility_ids), max(len(self) - 1, 0))
+        missing = self._sorted_ids[positions] != facility_ids if len(self) else np.ones(len(facility_ids), dtype=bool)
+        if missing.any():
+            raise KeyError("unknown FacilityIDs: {}".format(facility_ids[missing][:10].tolist()))
+        return np.asarray(self._order[positions])
+
+    def group_bounds(self):
+        """
+        {group_id: (start, stop)} of the contiguous row range of every group
+        """
+        if self.group_ids is None:
+            raise ValueError("store at {} has no group_ids".format(self.path))
+        if self._groups is None:
+            group_ids = np.asarray(self.group_ids)
+            starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]]) if len(group_ids) else np.empty(0, dtype=np.int64)
+            stops = np.r_[starts[1:], len(group_ids)]
+            self._groups = {int(group_ids[a]): (int(a), int(b)) for a, b in zip(starts, stops)}
+            if len(self._groups) != len(starts):
+                raise ValueError("rows of a group are not contiguous in {}".format(self.path))
+        return self._groups
+
+    def group(self, group_id):
+        """
+        (features, targets) views of one group
+        """
+        start, stop = self.group_bounds()[group_id]
+        return self.features[start:stop], self.targets[start:stop]
+
+    def group_data(self, min_size=1):
+        """
+        (group_id, X, Y) for every group with at least min_size rows, as group_analysis.analyse_groups() takes.
+        X and Y are StoreRows, so sending them to a process pool sends the store path and a row range.
+        """
+        for group_id, (start, stop) in self.group_bounds().items():
+            if stop - start >= min_size:
+                yield group_id, StoreRows(self, 'features', start, stop), StoreRows(self, 'targets', start, stop)
+
+    def dataset(self, rows=None):
+        return FeatureDataset(self, rows)
+
+
+class StoreRows:
+    """
+    A row range of one store column that pickles as (store path, column, range) and turns into a
+    memory-mapped view through np.asarray() in whichever process receives it
+    """
+
+    def __init__(self, store, column, start, stop):
+        self.store = store
+        self.column = column
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def shape(self):
+        return (len(self),) + getattr(self.store, self.column).shape[1:]
+
+    def __array__(self, dtype=None, copy=None):
+        view = getattr(self.store, self.column)[self.start:self.stop]
+        return view if dtype is None else view.astype(dtype)
+
+
+class FeatureDataset:
+    """
+    torch Dataset of (features, targets) rows of a store; items are tensors over copy-on-write views.
+    Pickling only sends the store path, so DataLoader workers and spawned training processes map the
+    files themselves.
+    """
+
+    def __init__(self, store, rows=None):
+        if store.targets is None:
+            raise ValueError("store at {} has no targets".format(store.path))
+        if store.mode != 'c':
+            store = FeatureStore.open(store.path, mode='c')
+        self.store = store
+        self.rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.store) if self.rows is None else len(self.rows)
+
+    def __getitem__(self, idx):
+        import torch
+        row = idx if self.rows is None else self.rows[idx]
+        return torch.from_numpy(self.store.features[row]), torch.from_numpy(self.store.targets[row])
+
+    def __getitems__(self, indices):
+        # Whole batches are gathered with one fancy index instead of one __getitem__ per row
+        import torch
+        rows = np.asarray(indices, dtype=np.int64) if self.rows is None else self.rows[indices]
+        X = torch.from_numpy(np.asarray(self.store.features[rows]))
+        y = torch.from_numpy(np.asarray(self.store.targets[rows]))
+        return list(zip(X, y))
+
+    def tensors(self):
+        """
+        (X, y) tensors sharing the mapped pages, no copy
+        """
+        import torch
+        if self.rows is not None:
+            raise ValueError("tensors() needs the whole store, not a subset of its rows")
+        return torch.from_numpy(self.store.features), torch.from_numpy(self.store.targets)
@@ -0,0 +1,57 @@
+"""
+General description of the code: Batched great circle (haversine) distances.
+haversine() keeps the scalar signature used in predictive_model.py, haversine_np() works on whole
+arrays at once (spatial_index.py refines its KD-tree candidates with it) and haversine_matrix() builds
+distance matrices block by block.
+Frameworks used here: NumPy
+"""
+
+from math import radians, cos, sin, asin, sqrt
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371  # Radius of earth in kilometers. Use 3956 for miles
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Calculate the great circle distance between two points
+    on the earth (specified in decimal degrees)
+    """
+    # Convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+
+    # Haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    return c * EARTH_RADIUS_KM
+
+
+def haversine_np(lon1, lat1, lon2, lat2):
+    """
+    Vectorized haversine, the arguments are arrays (or scalars) in decimal degrees and are
+    broadcast against each other. Returns float64 distances in kilometers.
+    """
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lon1, lat1, lon2, lat2))
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    # Clip guards against a slightly > 1 from rounding for antipodal points
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def haversine_matrix(lon1, lat1, lon2, lat2, block_size=4096):
+    """
+    Yield (start, block) pairs where block holds the distances from points
+    start..start+len(block) of the first set to every point of the second set.
+    Working in blocks keeps the temporary arrays at block_size x len(second set).
+    """
+    lon1 = np.asarray(lon1, dtype=np.float64)
+    lat1 = np.asarray(lat1, dtype=np.float64)
+    lon2 = np.asarray(lon2, dtype=np.float64)[np.newaxis, :]
+    lat2 = np.asarray(lat2, dtype=np.float64)[np.newaxis, :]
+    for start in range(0, len(lon1), block_size):
+        stop = start + block_size
+        yield start, haversine_np(lon1[start:stop, np.newaxis], lat1[start:stop, np.newaxis], lon2, lat2)
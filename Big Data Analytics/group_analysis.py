@@ -0,0 +1,99 @@
+"""
+General description of the code: Correlation and hypothesis testing over every similarity group.
+Each qualifying group is analysed in a process pool (pollutant x climate-variable correlation with
+p-values), then the p-values of all groups and pollutants are corrected together with Benjamini-Hochberg
+and returned as one tidy table: one row per (group, pollutant, climate variable).
+Frameworks used here: NumPy, pandas
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from correlation import CLIMATE_COLUMNS, cross_correlation, permutation_test
+
+RESULT_COLUMNS = ['group_id', 'pollutant', 'climate_variable', 'n', 'r', 'p_value']
+
+
+def benjamini_hochberg(p_values):
+    """
+    Benjamini-Hochberg adjusted p-values (q-values); NaN p-values stay NaN and are not counted as tests
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    q_values = np.full(p_values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    if not len(valid):
+        return q_values
+    order = valid[np.argsort(p_values[valid], kind='stable')]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    # Step-up: every q-value is the smallest adjusted value at its rank or above
+    q_values[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1.0)
+    return q_values
+
+
+def analyse_group(task):
+    """
+    Correlation block of one group, task is (group_id, X, Y, pollutants, climate_columns, test) where test
+    is None for Pearson p-values or a dict of permutation_test() options
+    """
+    group_id, X, Y, pollutants, climate_columns, test = task
+    if test is None:
+        r, p = cross_correlation(X, Y)
+    else:
+        # Seed per group so results do not depend on which worker runs the group
+        options = dict(test)
+        options['seed'] = options.get('seed', 0) + int(group_id)
+        r, p, _ = permutation_test(X, Y, **options)
+    num_pollutants, num_climate = r.shape
+    return pd.DataFrame({
+        'group_id': group_id,
+        'pollutant': np.repeat(np.asarray(pollutants, dtype=object), num_climate),
+        'climate_variable': np.tile(np.asarray(climate_columns, dtype=object), num_pollutants),
+        'n': len(X),
+        'r': r.reshape(-1),
+        'p_value': p.reshape(-1),
+    })
+
+
+def analyse_groups(group_data, pollutants, climate_columns=CLIMATE_COLUMNS, min_size=150, alpha=0.05,
+                   max_workers=None, method='pearson', num_permutations=10000, seed=0, analyse=analyse_group):
+    """
+    group_data yields (group_id, X, Y) with X [facilities, pollutants] and Y [facilities, climate variables].
+    Groups with fewer than min_size facilities are skipped, the others are analysed in a process pool of
+    spawned workers (callers such as pipeline.py run other threads, forking them could deadlock a worker).
+    method is 'pearson' (t-distribution p-values) or 'permutation' (batched permutation test with
+    num_permutations shuffles, reproducible from seed, stopping early once a p-value is clearly far from alpha).
+    Returns the tidy table with q_value (Benjamini-Hochberg over all groups and pollutants), significant
+    (q_value < alpha) and direction ('increases'/'decreases').
+    """
+    pollutants = list(pollutants)
+    climate_columns = list(climate_columns)
+    if method == 'pearson':
+        test = None
+    elif method == 'permutation':
+        test = {'num_permutations': num_permutations, 'seed': seed, 'alpha': alpha}
+    else:
+        raise ValueError("unknown method: {}".format(method))
+    tasks = ((group_id, X, Y, pollutants, climate_columns, test) for group_id, X, Y in group_data if len(X) >= min_size)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), mp_context=context) as pool:
+        parts = list(pool.map(analyse, tasks))
+    if not parts:
+        return pd.DataFrame(columns=RESULT_COLUMNS + ['q_value', 'significant', 'direction'])
+    results = pd.concat(parts, ignore_index=True)
+    results['q_value'] = benjamini_hochberg(results['p_value'].values)
+    results['significant'] = results['q_value'] < alpha
+    results['direction'] = np.where(results['r'] > 0, 'increases', 'decreases')
+    return results
+
+
+def significant_findings(results, top=None):
+    """
+    Significant rows ordered by strength of correlation, strongest first
+    """
+    found = results[results['significant']]
+    found = found.reindex(found['r'].abs().sort_values(ascending=False).index)
+    return found if top is None else found.head(top)
@@ -0,0 +1,114 @@
+"""
+General description of the code: Grouping of similar facilities from LSH candidate pairs.
+Candidate pairs (optionally only those above a similarity threshold) are merged with an array based
+union-find, so a group is a connected component of the "looks similar" graph. FacilityIDs are resolved
+through a precomputed array, there is no per-facility pandas access.
+Frameworks used here: NumPy
+"""
+
+import numpy as np
+
+
+class UnionFind:
+    """
+    Union-find over 0..n-1 where unions are applied to whole arrays of pairs at once.
+    Roots always point to a smaller index, so hooking can never form a cycle.
+    """
+
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    def _compress(self):
+        # Pointer jumping until every element points straight at its root
+        while True:
+            grandparent = self.parent[self.parent]
+            if np.array_equal(grandparent, self.parent):
+                return
+            self.parent = grandparent
+
+    def find(self, items=None):
+        self._compress()
+        return self.parent.copy() if items is None else self.parent[np.asarray(items, dtype=np.int64)]
+
+    def union(self, left, right):
+        left = np.asarray(left, dtype=np.int64)
+        right = np.asarray(right, dtype=np.int64)
+        while len(left):
+            self._compress()
+            root_left, root_right = self.parent[left], self.parent[right]
+            differ = root_left != root_right
+            if not differ.any():
+                return
+            left, right = left[differ], right[differ]
+            low = np.minimum(root_left[differ], root_right[differ])
+            high = np.maximum(root_left[differ], root_right[differ])
+            np.minimum.at(self.parent, high, low)
+
+
+class FacilityGroups:
+    """
+    Facility -> group assignment.
+    group_of[i] is the group of facility_ids[i]; groups are numbered by size, largest first, and
+    sizes[g] is the number of facilities in group g.
+    """
+
+    def __init__(self, facility_ids, group_of):
+        self.facility_ids = np.asarray(facility_ids, dtype=np.int64)
+        self.group_of = np.asarray(group_of, dtype=np.int64)
+        self.sizes = np.bincount(self.group_of, minlength=self.group_of.max() + 1 if len(self.group_of) else 0)
+        self._order = np.argsort(self.group_of, kind='stable')
+        self._starts = np.r_[0, np.cumsum(self.sizes)]
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def members(self, group_id):
+        """
+        FacilityIDs of one group
+        """
+        return self.facility_ids[self._order[self._starts[group_id]:self._starts[group_id + 1]]]
+
+    def to_dict(self, min_size=1):
+        """
+        {group_id: [FacilityID, ...]} for groups with at least min_size facilities
+        """
+        return {int(g): self.members(g).tolist() for g in np.flatnonzero(self.sizes >= min_size)}
+
+    def save(self, path):
+        np.savez(path, facility_ids=self.facility_ids, group_of=self.group_of)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['facility_ids'], f['group_of'])
+
+
+def group_facilities(facility_ids, left, right, similarity=None, threshold=None):
+    """
+    Connected components of the candidate pairs (left[i], right[i]), given as row positions into facility_ids.
+    With a threshold, only pairs whose estimated similarity is at least threshold are joined.
+    Facilities without any pair end up in a group of their own.
+    """
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    if threshold is not None:
+        keep = np.asarray(similarity) >= threshold
+        left, right = left[keep], right[keep]
+    union_find = UnionFind(len(facility_ids))
+    union_find.union(left, right)
+    _, labels, sizes = np.unique(union_find.find(), return_inverse=True, return_counts=True)
+    # Number groups by size (largest first), ties by first member
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(len(sizes))
+    return FacilityGroups(facility_ids, rank[labels.reshape(-1)])
+
+
+def pair_similarity(hasher, signatures, left, right, block_size=100000):
+    """
+    Estimated similarity of candidate pairs from their signatures, computed in blocks
+    """
+    out = np.empty(len(left), dtype=np.float64)
+    for start in range(0, len(left), block_size):
+        stop = start + block_size
+        out[start:stop] = hasher.similarity(np.asarray(signatures[left[start:stop]]), np.asarray(signatures[right[start:stop]]))
+    return out
@@ -0,0 +1,322 @@
+"""
+General description of the code: Incremental update of the emission profiles for new E-PRTR reporting years.
+The per-facility sums (emission profiles, Lat/Long sums, release row counts) and the per-country sums and
+facility counts are kept as persisted state together with the reports already applied. A new reporting year
+only streams the PUBLISH_POLLUTANTRELEASE rows of the new reports, adds them to the facilities they belong
+to and moves the country sums by the same difference. Only the changed facilities are re-signed in the
+similarity index, and only the groups they belong to (before or after the update) are recomputed; when most
+facilities changed (a full new year), rebuilding the index and groups is cheaper and done instead.
+Frameworks used here: pandas, NumPy, SciPy
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from emission_profiles import REPORT_FILE, EmissionProfileMatrix, accumulate_releases, read_reports
+from grouping import FacilityGroups, group_facilities, pair_similarity
+from profile_store import write_profiles_parquet
+from similarity_hashing import BandedLSH
+from similarity_index import FacilitySimilarityIndex
+
+# Location columns are averaged like the pollutants by countryEmissions.py
+LOCATION_SUMS = ['Lat', 'Long']
+
+
+def _country_sums(countries, values):
+    """
+    Sum the rows of values ([facilities, columns]) per entry of countries, returns (names, sums, counts)
+    """
+    names, codes, counts = np.unique(np.asarray(countries, dtype=object), return_inverse=True, return_counts=True)
+    indicator = sparse.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(len(names), len(codes)))
+    return names, indicator @ values, counts
+
+
+class IncrementalState:
+    """
+    Running aggregates of the emission profiles.
+    profiles holds the summed quantities per facility and pollutant; facilities is row aligned with it
+    (FacilityID, LatSum, LongSum, ReleaseRows, CountryCode, CountryName); countries is indexed by CountryName
+    with CountryCode, count (facilities) and the sums of every pollutant plus Lat and Long.
+    """
+
+    def __init__(self, profiles, facilities, countries, report_ids, min_year):
+        self.profiles = profiles
+        self.facilities = facilities.reset_index(drop=True)
+        self.countries = countries
+        self.report_ids = np.asarray(report_ids, dtype=np.int64)
+        self.min_year = min_year
+
+    @classmethod
+    def from_releases(cls, profiles, facility_info, report_ids, min_year):
+        facilities = pd.DataFrame({'FacilityID': facility_info['FacilityID'].values,
+                                   'LatSum': facility_info['Lat'].values * facility_info['ReleaseRows'].values,
+                                   'LongSum': facility_info['Long'].values * facility_info['ReleaseRows'].values,
+                                   'ReleaseRows': facility_info['ReleaseRows'].values,
+                                   'CountryCode': facility_info['CountryCode'].values,
+                                   'CountryName': facility_info['CountryName'].values})
+        state = cls(profiles, facilities, None, report_ids, min_year)
+        names, sums, counts = _country_sums(facilities['CountryName'].values, state._values(np.arange(len(facilities))))
+        countries = pd.DataFrame(sums, index=pd.Index(names, name='CountryName'), columns=state.value_columns)
+        countries.insert(0, 'count', counts)
+        codes = facilities.drop_duplicates('CountryName').set_index('CountryName')['CountryCode']
+        countries.insert(0, 'CountryCode', codes.reindex(countries.index).values)
+        state.countries = countries
+        return state
+
+    @classmethod
+    def build(cls, data_dir, min_year=2017, chunksize=500000):
+        """
+        Initial state from the full history of the E-PRTR tables
+        """
+        reports = read_reports(data_dir.rstrip('/') + '/' + REPORT_FILE, min_year, chunksize)
+        profiles, facility_info = accumulate_releases(data_dir, reports, chunksize)
+        return cls.from_releases(profiles, facility_info, reports['PollutantReleaseAndTransferReportID'].values, min_year)
+
+    @property
+    def value_columns(self):
+        return list(self.profiles.pollutants) + LOCATION_SUMS
+
+    def _values(self, rows):
+        """
+        [len(rows), pollutants + Lat + Long] values of facilities in the layout of emissionProfilesData.csv
+        """
+        facilities = self.facilities.iloc[rows]
+        location = np.column_stack([facilities['LatSum'].values, facilities['LongSum'].values]) / \
+            np.maximum(facilities['ReleaseRows'].values, 1)[:, np.newaxis]
+        return np.hstack([self.profiles.matrix[rows].toarray(), location])
+
+    def apply(self, data_dir, chunksize=500000):
+        """
+        Add the releases of reports that were not applied yet.
+        Returns the FacilityIDs whose profiles changed (empty when there was nothing new).
+        """
+        reports = read_reports(data_dir.rstrip('/') + '/' + REPORT_FILE, self.min_year, chunksize)
+        reports = reports[~reports['PollutantReleaseAndTransferReportID'].isin(self.report_ids)]
+        if reports.empty:
+            return np.empty(0, dtype=np.int64)
+        delta, delta_info = accumulate_releases(data_dir, reports, chunksize)
+        self.report_ids = np.union1d(self.report_ids, reports['PollutantReleaseAndTransferReportID'].values)
+        if not len(delta):
+            return np.empty(0, dtype=np.int64)
+
+        # Values of the changed facilities before the update (zeros for new facilities)
+        known = np.isin(delta.facility_ids, self.profiles.facility_ids)
+        old_values = np.zeros((len(delta), len(self.value_columns)))
+        old_values[known] = self._values(self.profiles.rows_of(delta.facility_ids[known]))
+        old_columns = self.value_columns
+
+        self._merge_profiles(delta, delta_info)
+        new_values = self._values(self.profiles.rows_of(delta.facility_ids))
+        # New pollutants become new columns of the old values, in the order of value_columns
+        old_values = pd.DataFrame(old_values, columns=old_columns).reindex(columns=self.value_columns, fill_value=0.0).values
+
+        countries = self.facilities.set_index('FacilityID').loc[delta.facility_ids, ['CountryCode', 'CountryName']]
+        self._update_countries(countries, new_values - old_values, ~known)
+        return delta.facility_ids
+
+    def _merge_profiles(self, delta, delta_info):
+        pollutants = sorted(set(self.profiles.pollutants) | set(delta.pollutants))
+        column_of = {name: j for j, name in enumerate(pollutants)}
+        facility_ids = np.union1d(self.profiles.facility_ids, delta.facility_ids)
+        shape = (len(facility_ids), len(pollutants))
+
+        def expand(profiles):
+            coo = profiles.matrix.tocoo()
+            rows = np.searchsorted(facility_ids, profiles.facility_ids)[coo.row]
+            cols = np.array([column_of[name] for name in profiles.pollutants], dtype=np.int64)[coo.col]
+            return sparse.csr_matrix((coo.data, (rows, cols)), shape=shape)
+
+        self.profiles = EmissionProfileMatrix(expand(self.profiles) + expand(delta), facility_ids, pollutants)
+
+        # Location sums and release counts add up, the country columns of known facilities are kept
+        old = self.facilities.set_index('FacilityID')
+        new = pd.DataFrame({'LatSum': delta_info['Lat'].values * delta_info['ReleaseRows'].values,
+                            'LongSum': delta_info['Long'].values * delta_info['ReleaseRows'].values,
+                            'ReleaseRows': delta_info['ReleaseRows'].values},
+                           index=pd.Index(delta_info['FacilityID'].values, name='FacilityID'))
+        index = pd.Index(facility_ids, name='FacilityID')
+        sums = old[['LatSum', 'LongSum', 'ReleaseRows']].reindex(index, fill_value=0) \
+            .add(new.reindex(index, fill_value=0))
+        country = old[['CountryCode', 'CountryName']].combine_first(
+            delta_info.set_index('FacilityID')[['CountryCode', 'CountryName']]).reindex(index)
+        self.facilities = pd.concat([sums, country], axis=1).reset_index()
+
+    def _update_countries(self, countries, difference, added):
+        names, sums, _ = _country_sums(countries['CountryName'].values, difference)
+        table = self.countries.reindex(columns=['CountryCode', 'count'] + self.value_columns)
+        table[self.value_columns] = table[self.value_columns].fillna(0.0)
+        for name in names:
+            if name not in table.index:
+                table.loc[name] = [countries.loc[countries['CountryName'] == name, 'CountryCode'].iloc[0], 0] + [0.0] * len(self.value_columns)
+        table.loc[names, self.value_columns] += sums
+        added_counts = pd.Series(countries['CountryName'].values[added]).value_counts()
+        table.loc[added_counts.index, 'count'] += added_counts.values
+        table['count'] = table['count'].astype(np.int64)
+        self.countries = table.sort_index()
+
+    def final_data(self):
+        """
+        Profiles in the emissionProfilesData.csv layout: FacilityID, pollutants, Lat, Long, CountryCode, CountryName
+        """
+        finalData = self.profiles.to_frame()
+        rows = np.maximum(self.facilities['ReleaseRows'].values, 1)
+        finalData['Lat'] = self.facilities['LatSum'].values / rows
+        finalData['Long'] = self.facilities['LongSum'].values / rows
+        finalData['CountryCode'] = self.facilities['CountryCode'].values
+        finalData['CountryName'] = self.facilities['CountryName'].values
+        return finalData
+
+    def country_means(self):
+        """
+        Average of every pollutant (and Lat/Long) per country in the avgEmissionPerCountry.csv layout
+        """
+        means = self.countries[self.value_columns].div(self.countries['count'], axis=0)
+        means.insert(0, 'Country', self.countries.index.values)
+        means['CountryCode'] = self.countries['CountryCode'].values
+        return means.reset_index(drop=True)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.profiles.save(os.path.join(path, 'profiles.npz'))
+        self.facilities.to_parquet(os.path.join(path, 'facilities.parquet'), index=False)
+        self.countries.to_parquet(os.path.join(path, 'countries.parquet'))
+        np.save(os.path.join(path, 'report_ids.npy'), self.report_ids)
+        with open(os.path.join(path, 'state.json'), 'w') as f:
+            json.dump({'min_year': self.min_year}, f)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'state.json')) as f:
+            config = json.load(f)
+        return cls(EmissionProfileMatrix.load(os.path.join(path, 'profiles.npz')),
+                   pd.read_parquet(os.path.join(path, 'facilities.parquet')),
+                   pd.read_parquet(os.path.join(path, 'countries.parquet')),
+                   np.load(os.path.join(path, 'report_ids.npy')), config['min_year'])
+
+
+def update_index(index, profiles, changed, rebuild_fraction=0.25):
+    """
+    Re-sign the changed facilities into the delta segment of a FacilitySimilarityIndex.
+    A new pollutant changes the signature layout, and a new reporting year usually touches most facilities;
+    in both cases (more than rebuild_fraction of the facilities changed) the whole index is rebuilt and
+    True is returned, the groups then have to be built from scratch as well.
+    """
+    if list(index.config['pollutants']) != list(profiles.pollutants) or \
+            len(changed) > rebuild_fraction * len(profiles.facility_ids):
+        config = index.config
+        rebuilt = FacilitySimilarityIndex.build(profiles, config['method'], config['num_perm'], config['bands'],
+                                                config['seed'], config['scale'])
+        return rebuilt, True
+    index.add(changed, profiles.rows_for(changed))
+    return index, False
+
+
+def build_groups(index, threshold=0.5):
+    """
+    Groups of all facilities of a freshly built index, as in predictive_model.py
+    """
+    left, right = BandedLSH(index.signatures, index.bands).candidate_pairs()
+    similarity = pair_similarity(index.hasher, index.signatures, left, right)
+    return group_facilities(index.facility_ids, left, right, similarity, threshold=threshold)
+
+
+def update_groups(groups, index, facility_ids, changed, threshold=0.5, rebuild_fraction=0.25):
+    """
+    Regroup after an update. Groups without changed facilities are kept as they are; the members of every
+    group that held a changed facility, and the changed facilities themselves, are queried in the index and
+    rejoined through the pairs above threshold (which may also merge them into untouched groups).
+    When more than rebuild_fraction of the facilities are affected that way, the index is compacted and
+    all groups are built again instead.
+    Returns (new FacilityGroups, ids of the new groups holding the affected facilities).
+    """
+    facility_ids = np.asarray(facility_ids, dtype=np.int64)
+    old_group = np.full(len(facility_ids), -1, dtype=np.int64)
+    old_group[np.searchsorted(facility_ids, groups.facility_ids)] = groups.group_of
+
+    changed_rows = np.searchsorted(facility_ids, np.asarray(changed, dtype=np.int64))
+    touched = np.unique(old_group[changed_rows])
+    affected = np.isin(old_group, touched[touched >= 0])
+    affected[changed_rows] = True
+    if affected.sum() > rebuild_fraction * len(facility_ids):
+        index.compact()
+        new_groups = build_groups(index, threshold)
+        return new_groups, np.arange(len(new_groups))
+
+    # Untouched groups stay connected through their first member
+    kept = np.flatnonzero(~affected & (old_group >= 0))
+    _, first = np.unique(old_group[kept], return_index=True)
+    representative = np.zeros(old_group.max() + 1 if len(old_group) else 0, dtype=np.int64)
+    representative[old_group[kept[first]]] = kept[first]
+    left = [kept]
+    right = [representative[old_group[kept]]]
+
+    # One batched lookup for all affected facilities
+    queried, neighbours, _ = index.neighbours(facility_ids[affected], threshold)
+    left.append(np.searchsorted(facility_ids, queried))
+    right.append(np.searchsorted(facility_ids, neighbours))
+
+    new_groups = group_facilities(facility_ids, np.concatenate(left), np.concatenate(right))
+    return new_groups, np.unique(new_groups.group_of[affected])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply new E-PRTR reporting years to the persisted aggregates")
+    parser.add_argument("--eprtr-dir", required=True, help="directory with the E-PRTR dbo.PUBLISH_*.csv tables")
+    parser.add_argument("--state-dir", default="incremental_state")
+    parser.add_argument("--work-dir", default="pipeline_output", help="where the profile, country and similarity outputs live")
+    parser.add_argument("--min-year", type=int, default=2017)
+    parser.add_argument("--num-perm", type=int, default=240)
+    parser.add_argument("--bands", type=int, default=60)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--rebuild-fraction", type=float, default=0.25,
+                        help="rebuild the index and groups when more than this fraction of the facilities changed")
+    args = parser.parse_args()
+
+    out = lambda name: os.path.join(args.work_dir, name)
+    os.makedirs(args.work_dir, exist_ok=True)
+    index_path = out('facilitySimilarityIndex')
+    if os.path.exists(os.path.join(args.state_dir, 'state.json')):
+        state = IncrementalState.load(args.state_dir)
+        changed = state.apply(args.eprtr_dir)
+        print(f"{len(changed)} facilities changed")
+        if not len(changed):
+            state.save(args.state_dir)
+            return
+    else:
+        # First run: full history, every output is written from scratch
+        state = IncrementalState.build(args.eprtr_dir, args.min_year)
+        changed = None
+
+    finalData = state.final_data()
+    finalData.to_csv(out('emissionProfilesData.csv'), index=False)
+    write_profiles_parquet(finalData, out('emissionProfilesData.parquet'), state.profiles.pollutants)
+    state.profiles.save(out('emissionProfiles.npz'))
+    state.country_means().to_csv(out('avgEmissionPerCountry.csv'), index=False)
+
+    rebuilt = changed is None or not os.path.exists(os.path.join(index_path, 'config.json')) or not os.path.exists(out('groups.npz'))
+    if rebuilt:
+        index = FacilitySimilarityIndex.build(state.profiles, num_perm=args.num_perm, bands=args.bands)
+    else:
+        index, rebuilt = update_index(FacilitySimilarityIndex.open(index_path), state.profiles, changed, args.rebuild_fraction)
+    if rebuilt:
+        groups = build_groups(index, args.threshold)
+    else:
+        groups, changed_groups = update_groups(FacilityGroups.load(out('groups.npz')), index, state.profiles.facility_ids,
+                                               changed, args.threshold, args.rebuild_fraction)
+        print(f"{len(changed_groups)} groups re-emitted")
+    # Only the delta segment is rewritten when the index was updated in place
+    index.save(index_path)
+    groups.save(out('groups.npz'))
+
+    # The state is saved last, a failed run is simply applied again
+    state.save(args.state_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+General description of the code: Batched inference for trained FacilityEmissionsLSTM models.
+A trained model is exported once (TorchScript, or ONNX when onnxruntime is available) and loaded by a
+BatchingPredictor. Concurrent "what-if" requests are queued and collected into micro-batches that are run
+as soon as the batch is full or the oldest request reaches its latency deadline. Everything runs in process,
+there are no external services.
+Frameworks used here: PyTorch, NumPy, ONNX Runtime (optional)
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+import numpy as np
+import torch
+
+
+def export_model(net, path, num_features, num_timesteps=None, format='torchscript'):
+    """
+    Export a trained model for serving. The example input is [1, features] (static profiles) or
+    [1, num_timesteps, features] when num_timesteps is given.
+    """
+    net.eval()
+    shape = (1, num_features) if num_timesteps is None else (1, num_timesteps, num_features)
+    example = torch.zeros(shape, dtype=torch.float32)
+    if format == 'torchscript':
+        with torch.inference_mode():
+            torch.jit.trace(net, example).save(path)
+    elif format == 'onnx':
+        torch.onnx.export(net, example, path, input_names=['profiles'], output_names=['climate_change'],
+                          dynamic_axes={'profiles': {0: 'batch'}, 'climate_change': {0: 'batch'}})
+    else:
+        raise ValueError("unknown export format: {}".format(format))
+    return path
+
+
+def load_model(path):
+    """
+    Load an exported model as a callable taking and returning float32 NumPy arrays
+    """
+    if path.endswith('.onnx'):
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        input_name = session.get_inputs()[0].name
+        return lambda batch: session.run(None, {input_name: batch})[0]
+
+    module = torch.jit.load(path, map_location='cpu')
+    module.eval()
+
+    def run(batch):
+        with torch.inference_mode():
+            return module(torch.from_numpy(batch)).numpy()
+    return run
+
+
+class LatencyStats:
+    """
+    Request latency percentiles over the last window requests and throughput counters
+    """
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.batches += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64)
+            requests, batches = self.requests, self.batches
+        elapsed = time.perf_counter() - self.started
+        return {
+            'requests': requests,
+            'batches': batches,
+            'mean_batch_size': requests / batches if batches else 0.0,
+            'throughput_rps': requests / elapsed if elapsed > 0 else 0.0,
+            'p50_ms': float(np.percentile(latencies, 50) * 1000) if len(latencies) else None,
+            'p99_ms': float(np.percentile(latencies, 99) * 1000) if len(latencies) else None,
+        }
+
+
+class BatchingPredictor:
+    """
+    Collects concurrent requests into micro-batches of at most max_batch_size profiles; a batch is run at
+    the latest max_latency_ms after its first request arrived. With num_features (and num_timesteps for
+    sequence models), profiles of another shape are rejected by submit(); requests of different shapes
+    never share a model call, so a malformed request only fails itself.
+    """
+
+    def __init__(self, model, max_batch_size=256, max_latency_ms=5, num_threads=None, num_features=None, num_timesteps=None):
+        if isinstance(model, str):
+            model = load_model(model)
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.model = model
+        self.shape = None
+        if num_features is not None:
+            self.shape = (num_features,) if num_timesteps is None else (num_timesteps, num_features)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.stats = LatencyStats()
+        self.queue = Queue()
+        self.closed = False
+        self.worker = threading.Thread(target=self._run, name='BatchingPredictor', daemon=True)
+        self.worker.start()
+
+    def submit(self, profile):
+        """
+        Queue one emission profile, returns a Future with its predicted climate change values
+        """
+        if self.closed:
+            raise RuntimeError("predictor is closed")
+        profile = np.asarray(profile, dtype=np.float32)
+        if self.shape is not None and profile.shape != self.shape:
+            raise ValueError("profile of shape {}, the model takes {}".format(profile.shape, self.shape))
+        future = Future()
+        self.queue.put((profile, time.perf_counter(), future))
+        return future
+
+    def predict(self, profile, timeout=None):
+        return self.submit(profile).result(timeout)
+
+    def predict_many(self, profiles, timeout=None):
+        futures = [self.submit(profile) for profile in profiles]
+        return np.stack([future.result(timeout) for future in futures])
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[1] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                # Past the deadline only requests that are already queued join the batch
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except Empty:
+                break
+            if item is None:
+                # Put the stop marker back so the loop ends after this batch
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            by_shape = {}
+            for item in batch:
+                by_shape.setdefault(item[0].shape, []).append(item)
+            for group in by_shape.values():
+                self._predict(group)
+
+    def _predict(self, batch):
+        try:
+            outputs = self.model(np.stack([item[0] for item in batch]))
+        except Exception as error:
+            for item in batch:
+                item[2].set_exception(error)
+            return
+        done = time.perf_counter()
+        for item, output in zip(batch, outputs):
+            item[2].set_result(output)
+        self.stats.record([done - item[1] for item in batch])
+
+    def close(self):
+        self.closed = True
+        self.queue.put(None)
+        self.worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
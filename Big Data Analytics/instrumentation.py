@@ -0,0 +1,263 @@
+"""
+General description of the code: Per-stage instrumentation for the pipeline, the notebook and training.
+profiler.stage(name) records wall time, CPU time, peak RSS and rows in/out of a block of code; given a
+SparkContext it also collects the job, task and shuffle metrics of the Spark jobs the block ran, and
+train_model() records the throughput of every batch. Recording is off unless enabled at runtime
+(profiler.enable() or EPRTR_PROFILE=1) and costs a single attribute check when off. Results export as JSON
+or as a Chrome trace (chrome://tracing, Perfetto). debug_take() replaces ad-hoc take() calls, it only
+runs a Spark job when debugging is enabled (EPRTR_DEBUG=1).
+Frameworks used here: Python standard library, PySpark (optional, for the Spark metrics)
+"""
+
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+
+def _env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process right now (falls back to the peak where /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+class _RssSampler:
+    """
+    Background thread sampling the RSS every interval seconds while at least one span is open.
+    ru_maxrss only knows the peak of the whole process, this gives the peak of each span.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.thread = None
+
+    def _run(self):
+        while True:
+            rss = current_rss_mb()
+            with self.lock:
+                if not self.peaks:
+                    self.thread = None
+                    return
+                for key in self.peaks:
+                    self.peaks[key] = max(self.peaks[key], rss)
+            time.sleep(self.interval)
+
+    def start(self, key):
+        with self.lock:
+            self.peaks[key] = current_rss_mb()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='RssSampler', daemon=True)
+                self.thread.start()
+
+    def stop(self, key):
+        rss = current_rss_mb()
+        with self.lock:
+            return max(self.peaks.pop(key), rss)
+
+
+def spark_metrics(sc, job_group):
+    """
+    Jobs, stages, tasks and I/O/shuffle bytes of the jobs run under job_group. Byte counts come from the
+    Spark UI's REST API; without a UI only the counts from the status tracker are returned.
+    """
+    tracker = sc.statusTracker()
+    job_ids = tracker.getJobIdsForGroup(job_group)
+    stage_ids = sorted({stage for job in job_ids for stage in (tracker.getJobInfo(job).stageIds if tracker.getJobInfo(job) else [])})
+    metrics = {'jobs': len(job_ids), 'stages': len(stage_ids), 'tasks': 0, 'failed_tasks': 0}
+    for stage in stage_ids:
+        info = tracker.getStageInfo(stage)
+        if info:
+            metrics['tasks'] += info.numTasks
+            metrics['failed_tasks'] += info.numFailedTasks
+    url = sc.uiWebUrl
+    if not url:
+        return metrics
+    totals = {'inputBytes': 0, 'outputBytes': 0, 'shuffleReadBytes': 0, 'shuffleWriteBytes': 0,
+              'memoryBytesSpilled': 0, 'diskBytesSpilled': 0, 'executorRunTime': 0}
+    try:
+        for stage in stage_ids:
+            with urllib.request.urlopen('{}/api/v1/applications/{}/stages/{}'.format(url, sc.applicationId, stage), timeout=5) as r:
+                for attempt in json.load(r):
+                    for key in totals:
+                        totals[key] += attempt.get(key, 0)
+    except (OSError, ValueError):
+        return metrics
+    metrics.update({'input_bytes': totals['inputBytes'], 'output_bytes': totals['outputBytes'],
+                    'shuffle_read_bytes': totals['shuffleReadBytes'], 'shuffle_write_bytes': totals['shuffleWriteBytes'],
+                    'spilled_bytes': totals['memoryBytesSpilled'] + totals['diskBytesSpilled'],
+                    'executor_run_time_s': totals['executorRunTime'] / 1000})
+    return metrics
+
+
+class Span:
+    """
+    One recorded block; rows_in, rows_out and anything passed to set() end up in its record
+    """
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.rows_in = None
+        self.rows_out = None
+        self.metrics = {}
+
+    def set(self, **metrics):
+        self.metrics.update(metrics)
+
+
+class _NullSpan(Span):
+    def set(self, **metrics):
+        pass
+
+
+class Profiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+        self.counters = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.sampler = _RssSampler()
+        self.local = threading.local()
+        self._next_id = 0
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.records = []
+            self.counters = []
+            self.origin = time.perf_counter()
+
+    def _now_us(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def stage(self, name, sc=None, rows_in=None):
+        """
+        Record the enclosed block as a stage. With sc, its Spark jobs run under a job group of their own
+        and their metrics are attached. Nested stages are recorded with their parent's name.
+        """
+        if not self.enabled:
+            yield _NullSpan(name)
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        span = Span(name, stack[-1].name if stack else None)
+        span.rows_in = rows_in
+        with self.lock:
+            self._next_id += 1
+            key = '{}-{}'.format(name, self._next_id)
+        if sc is not None:
+            previous_group = sc.getLocalProperty('spark.jobGroup.id')
+            sc.setJobGroup(key, name)
+        stack.append(span)
+        self.sampler.start(key)
+        start_us, cpu, error = self._now_us(), time.process_time(), None
+        try:
+            yield span
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            stack.pop()
+            record = {'name': name, 'parent': span.parent, 'thread': threading.current_thread().name,
+                      'start_us': start_us, 'wall_s': (self._now_us() - start_us) / 1e6,
+                      # CPU time of the whole process, so it includes other threads running meanwhile
+                      'cpu_s': time.process_time() - cpu, 'peak_rss_mb': self.sampler.stop(key),
+                      'rows_in': span.rows_in, 'rows_out': span.rows_out, 'error': error}
+            if sc is not None:
+                record['spark'] = spark_metrics(sc, key)
+                sc.setLocalProperty('spark.jobGroup.id', previous_group)
+            record.update(span.metrics)
+            with self.lock:
+                self.records.append(record)
+
+    def counter(self, name, **values):
+        """
+        Time series value (e.g. batch throughput), shown as a counter track in the Chrome trace
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters.append({'name': name, 'ts_us': self._now_us(), 'thread': threading.current_thread().name, **values})
+
+    def summary(self):
+        return {'stages': list(self.records), 'counters': list(self.counters)}
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1, default=str)
+        return path
+
+    def export_chrome_trace(self, path):
+        """
+        Trace Event Format: one complete event per stage (args hold the metrics), one counter event per sample
+        """
+        threads = {}
+        events = []
+        pid = os.getpid()
+        for record in self.records:
+            tid = threads.setdefault(record['thread'], len(threads))
+            args = {k: v for k, v in record.items() if k not in ('name', 'thread', 'start_us', 'wall_s')}
+            events.append({'name': record['name'], 'cat': 'stage', 'ph': 'X', 'ts': record['start_us'],
+                           'dur': record['wall_s'] * 1e6, 'pid': pid, 'tid': tid, 'args': args})
+        for sample in self.counters:
+            values = {k: v for k, v in sample.items() if k not in ('name', 'ts_us', 'thread')}
+            events.append({'name': sample['name'], 'ph': 'C', 'ts': sample['ts_us'], 'pid': pid, 'args': values})
+        for name, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+        return path
+
+    def export(self, path):
+        """
+        Chrome trace for *.trace.json files, the plain JSON summary otherwise
+        """
+        return self.export_chrome_trace(path) if path.endswith('.trace.json') else self.export_json(path)
+
+
+# Shared by every module, switched on and off at runtime
+profiler = Profiler(enabled=_env_flag('EPRTR_PROFILE'))
+
+_debug = _env_flag('EPRTR_DEBUG')
+
+
+def set_debug(enabled=True):
+    global _debug
+    _debug = enabled
+
+
+def debug_enabled():
+    return _debug
+
+
+def debug_take(rdd, n=1, log=print):
+    """
+    rdd.take(n) for inspecting intermediate results; does nothing (and runs no Spark job) unless debugging is on
+    """
+    if not _debug:
+        return None
+    rows = rdd.take(n)
+    log(rows)
+    return rows
@@ -0,0 +1,94 @@
+"""
+General description of the code: LSTM model of Part 4 in predictive_model.py and its input pipeline.
+Static emission profiles are fed as [facilities, pollutants] and only expanded to [facilities, timesteps,
+pollutants] as a view, so the repeated timesteps are never copied. A per-year mode builds real sequences
+where every timestep is the facility's profile for one reporting year.
+Frameworks used here: PyTorch, NumPy
+"""
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset
+
+
+class FacilityEmissionsLSTM(nn.Module):
+    def __init__(self, input_size, hidden_size, num_layers, output_size, num_timesteps=15):
+        super(FacilityEmissionsLSTM, self).__init__()
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        # Number of timesteps a static [batch, features] input is expanded to
+        self.num_timesteps = num_timesteps
+
+        # LSTM layer
+        self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
+
+        # Fully connected layer for output
+        self.fc = nn.Linear(hidden_size, output_size)
+
+    def forward(self, x):
+        batch_size = x.size(0)
+
+        # Static profiles are repeated over the timesteps as a view, not a copy
+        if x.dim() == 2:
+            x = expand_sequences(x, self.num_timesteps)
+
+        # Initialize hidden state and cell state
+        h0 = torch.zeros(self.num_layers, batch_size, self.hidden_size, dtype=x.dtype, device=x.device)
+        c0 = torch.zeros(self.num_layers, batch_size, self.hidden_size, dtype=x.dtype, device=x.device)
+
+        # Forward pass through LSTM layer
+        out, _ = self.lstm(x, (h0, c0))
+
+        # Use only the last time step output
+        out = self.fc(out[:, -1, :])
+
+        return out
+
+
+def expand_sequences(X, num_timesteps):
+    """
+    [samples, features] -> [samples, num_timesteps, features] view sharing X's memory
+    """
+    return X.unsqueeze(1).expand(-1, num_timesteps, -1)
+
+
+class YearlySequenceDataset(Dataset):
+    """
+    Real temporal input: sequences[i, t] is the profile of facility i in the t-th reporting year.
+    sequences is a [facilities, years, features] array, items are views into it.
+    """
+
+    def __init__(self, sequences, y):
+        self.sequences = torch.as_tensor(sequences, dtype=torch.float32)
+        self.y = torch.as_tensor(y, dtype=torch.float32)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __getitem__(self, idx):
+        return self.sequences[idx], self.y[idx]
+
+
+def yearly_sequences(yearly_profiles, facility_ids, pollutants=None):
+    """
+    Stack per-year EmissionProfileMatrix objects (oldest year first) into a [facilities, years, features]
+    float32 array aligned to facility_ids. Facilities missing from a year get a zero profile for that year,
+    pollutants missing from a year are zero as well.
+    """
+    if pollutants is None:
+        pollutants = sorted(set().union(*[p.pollutants for p in yearly_profiles]))
+    pollutant_index = {name: j for j, name in enumerate(pollutants)}
+    facility_ids = np.asarray(facility_ids, dtype=np.int64)
+    out = np.zeros((len(facility_ids), len(yearly_profiles), len(pollutants)), dtype=np.float32)
+    for t, profiles in enumerate(yearly_profiles):
+        present = np.isin(facility_ids, profiles.facility_ids)
+        if not present.any():
+            continue
+        columns = [pollutant_index[name] for name in profiles.pollutants if name in pollutant_index]
+        source_columns = [j for j, name in enumerate(profiles.pollutants) if name in pollutant_index]
+        rows = profiles.rows_for(facility_ids[present])[:, source_columns].astype(np.float32).toarray()
+        block = np.zeros((int(present.sum()), len(pollutants)), dtype=np.float32)
+        block[:, columns] = rows
+        out[present, t, :] = block
+    return out
@@ -0,0 +1,415 @@
+"""
+General description of the code: Stage runner for the whole project (weather_data.py, the emission
+profiles, countryEmissions.py and Parts 2-6 of predictive_model.py).
+Every stage declares its inputs, outputs and parameters. Its outputs are stored in a content-addressed
+cache keyed by a hash of the input data, the parameters and the keys of the upstream stages, so a stage
+whose inputs did not change is restored from the cache instead of being run again. The cache is bounded in
+size and evicts the least recently used entries. Stages that do not depend on each other run concurrently.
+Frameworks used here: Python standard library (the stages themselves use pandas, PySpark, PyTorch)
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from instrumentation import profiler, set_debug
+
+
+def _size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def _copy(source, target):
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    elif os.path.exists(target):
+        os.remove(target)
+    parent = os.path.dirname(target)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    if os.path.isdir(source):
+        shutil.copytree(source, target)
+    else:
+        shutil.copy2(source, target)
+
+
+def _files(path):
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                yield os.path.join(root, f)
+    else:
+        yield path
+
+
+class ContentHasher:
+    """
+    SHA-256 of files and directories. Hashes are remembered by (path, size, mtime) in a small JSON file,
+    so an unchanged multi-GB input is only read once.
+    """
+
+    def __init__(self, memo_path):
+        self.memo_path = memo_path
+        self.lock = threading.Lock()
+        try:
+            with open(memo_path) as f:
+                self.memo = json.load(f)
+        except (OSError, ValueError):
+            self.memo = {}
+
+    def _file_hash(self, path):
+        stat = os.stat(path)
+        stamp = '{}:{}:{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if stamp in self.memo:
+                return self.memo[stamp]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        with self.lock:
+            self.memo[stamp] = digest.hexdigest()
+        return self.memo[stamp]
+
+    def hash(self, path):
+        digest = hashlib.sha256()
+        for file in _files(path):
+            digest.update(os.path.relpath(file, path).encode() if file != path else b'')
+            digest.update(self._file_hash(file).encode())
+        return digest.hexdigest()
+
+    def save(self):
+        with self.lock:
+            with open(self.memo_path + '.tmp', 'w') as f:
+                json.dump(self.memo, f)
+            os.replace(self.memo_path + '.tmp', self.memo_path)
+
+
+class StageCache:
+    """
+    Stage outputs stored under <root>/<key>/, evicted least recently used first once the cache grows past max_bytes
+    """
+
+    def __init__(self, root, max_bytes=50 * 2 ** 30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.root, key)
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self._entry(key), 'manifest.json'))
+
+    def restore(self, key, outputs):
+        """
+        Put the cached outputs back at their paths; targets that are already identical are left alone
+        """
+        entry = self._entry(key)
+        with open(os.path.join(entry, 'manifest.json')) as f:
+            manifest = json.load(f)
+        for name, path in outputs.items():
+            stamp_file = path.rstrip('/') + '.stage-key'
+            if os.path.exists(path) and os.path.exists(stamp_file):
+                with open(stamp_file) as f:
+                    if f.read() == key:
+                        continue
+            _copy(os.path.join(entry, manifest[name]), path)
+            with open(stamp_file, 'w') as f:
+                f.write(key)
+        # Recently used entries are evicted last
+        os.utime(entry)
+
+    def store(self, key, outputs):
+        entry = self._entry(key)
+        staging = entry + '.tmp'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        manifest = {}
+        for i, (name, path) in enumerate(outputs.items()):
+            manifest[name] = '{}_{}'.format(i, os.path.basename(path.rstrip('/')))
+            _copy(path, os.path.join(staging, manifest[name]))
+            with open(path.rstrip('/') + '.stage-key', 'w') as f:
+                f.write(key)
+        with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        with self.lock:
+            if os.path.exists(entry):
+                shutil.rmtree(staging)
+            else:
+                os.replace(staging, entry)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.root):
+                path = self._entry(name)
+                if os.path.isdir(path) and not name.endswith('.tmp'):
+                    entries.append((os.path.getmtime(path), _size(path), name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                shutil.rmtree(self._entry(name), ignore_errors=True)
+                total -= size
+
+
+class Stage:
+    """
+    A unit of work: func(inputs, outputs, **params) reads the paths in inputs and writes every path in outputs.
+    inputs are external files/directories; the outputs of the stages named in deps are added to inputs.
+    Bump version when the code of the stage changes.
+    """
+
+    def __init__(self, name, func, inputs=None, outputs=None, deps=(), params=None, version=1):
+        self.name = name
+        self.func = func
+        self.inputs = dict(inputs or {})
+        self.outputs = dict(outputs or {})
+        self.deps = list(deps)
+        self.params = dict(params or {})
+        self.version = version
+
+
+class Pipeline:
+    def __init__(self, cache_dir, max_cache_bytes=50 * 2 ** 30, log=print):
+        self.stages = {}
+        self.cache = StageCache(os.path.join(cache_dir, 'stages'), max_cache_bytes)
+        self.hasher = ContentHasher(os.path.join(cache_dir, 'hashes.json'))
+        self.log = log
+
+    def add(self, stage):
+        for dep in stage.deps:
+            if dep not in self.stages:
+                raise ValueError("stage {} depends on unknown stage {}".format(stage.name, dep))
+        self.stages[stage.name] = stage
+        return stage
+
+    def _needed(self, targets):
+        needed, todo = set(), list(targets or self.stages)
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].deps)
+        return needed
+
+    def _inputs(self, stage):
+        inputs = dict(stage.inputs)
+        for dep in stage.deps:
+            inputs.update(self.stages[dep].outputs)
+        return inputs
+
+    def key(self, stage, dep_keys):
+        description = {
+            'stage': stage.name,
+            'version': stage.version,
+            'params': stage.params,
+            'inputs': {name: self.hasher.hash(path) for name, path in sorted(stage.inputs.items())},
+            'deps': {dep: dep_keys[dep] for dep in stage.deps},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+    def _run_stage(self, stage, dep_keys, force):
+        started = time.perf_counter()
+        with profiler.stage(stage.name) as span:
+            key = self.key(stage, dep_keys)
+            if stage.name not in force and self.cache.contains(key):
+                self.cache.restore(key, stage.outputs)
+                status = 'cached'
+            else:
+                stage.func(self._inputs(stage), stage.outputs, **stage.params)
+                self.cache.store(key, stage.outputs)
+                status = 'ran'
+            span.set(status=status)
+        elapsed = time.perf_counter() - started
+        self.log(f"[{stage.name}] {status} in {elapsed:.3f}s")
+        return key, status, elapsed
+
+    def run(self, targets=None, max_workers=4, force=()):
+        """
+        Run the target stages (all by default) and everything they depend on.
+        Returns {stage: (key, 'ran' or 'cached', seconds)}.
+        """
+        needed = self._needed(targets)
+        force = set(force)
+        results, running = {}, {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while len(results) < len(needed):
+                for name in needed:
+                    stage = self.stages[name]
+                    if name in results or name in running.values() or any(dep not in results for dep in stage.deps):
+                        continue
+                    # A rerun upstream stage forces its dependants too
+                    if any(results[dep][1] == 'ran' and dep in force for dep in stage.deps):
+                        force.add(name)
+                    dep_keys = {dep: results[dep][0] for dep in stage.deps}
+                    running[pool.submit(self._run_stage, stage, dep_keys, force)] = name
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        self.hasher.save()
+        return results
+
+
+# Stages of the project
+
+def weather_stage(inputs, outputs, backend='bigquery', data_dir=None, max_workers=8):
+    from weather_data import BigQueryBackend, DuckDBBackend, load_weather
+    source = BigQueryBackend() if backend == 'bigquery' else DuckDBBackend(data_dir)
+    load_weather(source, cache_dir=outputs['weather'] + '.cache', max_workers=max_workers).to_csv(outputs['weather'], index=False)
+
+
+def profiles_stage(inputs, outputs, min_year=2017):
+    from emission_profiles import build_emission_profile_matrix
+    from profile_store import write_profiles_parquet
+    with profiler.stage('build_profiles') as span:
+        profiles, facility_info = build_emission_profile_matrix(inputs['eprtr'], min_year=min_year)
+        span.rows_out = len(profiles)
+    finalData = profiles.to_frame()
+    for col in ['Lat', 'Long', 'CountryCode', 'CountryName']:
+        finalData[col] = facility_info[col].values
+    finalData.to_csv(outputs['profiles_csv'], index=False)
+    write_profiles_parquet(finalData, outputs['profiles_parquet'], profiles.pollutants)
+    profiles.save(outputs['profile_matrix'])
+
+
+def country_emissions_stage(inputs, outputs, master='local[*]'):
+    from countryEmissions import country_means, country_statistics, country_statistics_long, create_session
+    from profile_store import load_profiles_spark
+    spark = create_session(master)
+    with profiler.stage('country_statistics', sc=spark.sparkContext):
+        stats, columns = country_statistics(load_profiles_spark(spark, inputs['profiles_parquet']))
+        stats = stats.cache()
+        country_means(stats, columns).coalesce(1).write.mode("overwrite").csv(outputs['country_means'], header=True)
+        country_statistics_long(stats, columns).write.mode("overwrite").partitionBy("Country").parquet(outputs['country_stats'])
+
+
+def similarity_stage(inputs, outputs, num_perm=240, bands=60, threshold=0.5):
+    from emission_profiles import EmissionProfileMatrix
+    from grouping import group_facilities, pair_similarity
+    from similarity_hashing import BandedLSH
+    from similarity_index import FacilitySimilarityIndex
+    profiles = EmissionProfileMatrix.load(inputs['profile_matrix'])
+    with profiler.stage('minhash_signatures', rows_in=len(profiles)):
+        index = FacilitySimilarityIndex.build(profiles, method='minhash', num_perm=num_perm, bands=bands)
+        index.save(outputs['similarity_index'])
+    with profiler.stage('lsh_grouping', rows_in=len(profiles)) as span:
+        left, right = BandedLSH(index.signatures, bands).candidate_pairs()
+        similarity = pair_similarity(index.hasher, index.signatures, left, right)
+        groups = group_facilities(profiles.facility_ids, left, right, similarity, threshold=threshold)
+        span.rows_out = len(groups)
+        span.set(candidate_pairs=len(left))
+    groups.save(outputs['groups'])
+
+
+def model_data_stage(inputs, outputs, master='local[*]'):
+    from pyspark.sql import SparkSession
+    from emission_profiles import EmissionProfileMatrix
+    from grouping import FacilityGroups
+    from instrumentation import debug_take
+    from spark_stages import merge_facilities_with_climate, tag_groups, write_feature_store
+    spark = SparkSession.builder.master(master).getOrCreate()
+    # The transformations are lazy, all Spark jobs run while the store is written
+    with profiler.stage('station_join', sc=spark.sparkContext) as span:
+        final, _ = merge_facilities_with_climate(spark.sparkContext, spark, inputs['weather'], inputs['profiles_parquet'])
+        debug_take(final, 1)
+        tagged = tag_groups(spark.sparkContext, final, FacilityGroups.load(inputs['groups']))
+        store = write_feature_store(tagged, EmissionProfileMatrix.load(inputs['profile_matrix']), outputs['model_data'])
+        span.rows_out = len(store)
+
+
+def training_stage(inputs, outputs, hidden_size=40, num_layers=5, num_timesteps=15, num_epochs=15, lr=0.01):
+    from feature_store import FeatureStore
+    from inference_service import export_model
+    from lstm_model import FacilityEmissionsLSTM
+    from training import train_model
+    store = FeatureStore.open(inputs['model_data'])
+    # Epochs and batch throughput are recorded by train_model()
+    net = FacilityEmissionsLSTM(len(store.pollutants), hidden_size, num_layers, len(store.target_columns), num_timesteps=num_timesteps)
+    # The stage only runs when its key changed, so the checkpoints of an earlier run are never resumed
+    train_model(net, store.dataset(), num_epochs=num_epochs, lr=lr, num_threads=os.cpu_count(),
+                checkpoint_dir=outputs['model'] + '.checkpoints', resume=False)
+    export_model(net, outputs['model'], num_features=len(store.pollutants))
+
+
+def correlation_stage(inputs, outputs, min_size=150, alpha=0.05, method='pearson'):
+    from feature_store import FeatureStore
+    from group_analysis import analyse_groups
+    store = FeatureStore.open(inputs['model_data'])
+    with profiler.stage('group_correlation', rows_in=len(store)) as span:
+        results = analyse_groups(store.group_data(min_size), store.pollutants, min_size=min_size, alpha=alpha, method=method)
+        span.rows_out = len(results)
+    results.to_csv(outputs['group_correlation'], index=False)
+
+
+def build_pipeline(eprtr_dir, work_dir, cache_dir=None, weather_backend='bigquery', gsod_dir=None, master='local[*]'):
+    """
+    The project as stages: weather and profiles are independent, country emissions and the similarity
+    groups both only need the profiles, and the model data joins everything for training and correlation.
+    """
+    out = lambda name: os.path.join(work_dir, name)
+    pipeline = Pipeline(cache_dir or os.path.join(work_dir, '.stage_cache'))
+    pipeline.add(Stage('weather', weather_stage, outputs={'weather': out('weather.csv')},
+                       params={'backend': weather_backend, 'data_dir': gsod_dir},
+                       inputs={'gsod': gsod_dir} if gsod_dir else None))
+    pipeline.add(Stage('profiles', profiles_stage, inputs={'eprtr': eprtr_dir},
+                       outputs={'profiles_csv': out('emissionProfilesData.csv'),
+                                'profiles_parquet': out('emissionProfilesData.parquet'),
+                                'profile_matrix': out('emissionProfiles.npz')}))
+    pipeline.add(Stage('country_emissions', country_emissions_stage, deps=['profiles'], params={'master': master},
+                       outputs={'country_means': out('avgEmissionPerCountry.csv'),
+                                'country_stats': out('countryEmissionStats.parquet')}))
+    pipeline.add(Stage('similarity', similarity_stage, deps=['profiles'],
+                       outputs={'similarity_index': out('facilitySimilarityIndex'), 'groups': out('groups.npz')}))
+    pipeline.add(Stage('model_data', model_data_stage, deps=['weather', 'profiles', 'similarity'], params={'master': master},
+                       outputs={'model_data': out('modelFeatures')}))
+    pipeline.add(Stage('training', training_stage, deps=['model_data'],
+                       outputs={'model': out('facility_emissions_lstm.pt')}))
+    pipeline.add(Stage('correlation', correlation_stage, deps=['model_data'],
+                       outputs={'group_correlation': out('groupCorrelation.csv')}))
+    return pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the project pipeline with cached stages")
+    parser.add_argument("--eprtr-dir", required=True, help="directory with the E-PRTR dbo.PUBLISH_*.csv tables")
+    parser.add_argument("--work-dir", default="pipeline_output")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--weather-backend", choices=["bigquery", "duckdb"], default="bigquery")
+    parser.add_argument("--gsod-dir", default=None, help="local GSOD files for the duckdb backend")
+    parser.add_argument("--master", default="local[*]")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--force", nargs="*", default=[], help="stages to rerun even when cached")
+    parser.add_argument("--profile", default=None, help="record per-stage metrics to this file (*.trace.json for a Chrome trace)")
+    parser.add_argument("--debug", action="store_true", help="run the debugging take() actions")
+    parser.add_argument("targets", nargs="*", help="stages to run (default: all)")
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler.enable()
+    set_debug(args.debug)
+    os.makedirs(args.work_dir, exist_ok=True)
+    pipeline = build_pipeline(args.eprtr_dir, args.work_dir, args.cache_dir, args.weather_backend, args.gsod_dir, args.master)
+    try:
+        pipeline.run(args.targets or None, max_workers=args.workers, force=args.force)
+    finally:
+        if args.profile:
+            profiler.export(args.profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,124 @@
-
 # Team Members - Deepika Gonela, Pandre Vamshi, Akshith Reddy Kota, Krishna Tej Alahari
 # Data manipulation for visualizing data across a geomap, creating various visualizations based on the pollutant type and all countries
 # Frameworks used here: ran locally
 # Visualizing using https://www.datawrapper.de/maps/choropleth-map
+# The country aggregate output of countryEmissions.py is read once, ISO codes are joined by country code and
+# a datawrapper-ready file is written for every pollutant that has data, plus one long-format file.
+# The means can also be computed directly from the memory-mapped feature store (feature_store.py).
+
+import argparse
+import glob
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
-df = pd.read_csv('/Users/nani/Library/CloudStorage/OneDrive-Personal/CourseWork/BigDataAnalytics/BigDataAnalytics/Assignments/Project/groupedData.csv/part-00000-51cd1ddc-2bc4-4c5a-8c53-e9ee67a40587-c000.csv')
+from profile_store import pollutant_columns
+
+# E-PRTR country codes -> ISO 3166 alpha-3 codes used by the datawrapper maps (UK and EL are the EU spellings)
+ISO3_BY_CODE = {'AT': 'AUT', 'BE': 'BEL', 'BG': 'BGR', 'CH': 'CHE', 'CY': 'CYP', 'CZ': 'CZE', 'DE': 'DEU', 'DK': 'DNK',
+                'EE': 'EST', 'EL': 'GRC', 'ES': 'ESP', 'FI': 'FIN', 'FR': 'FRA', 'GB': 'GBR', 'GR': 'GRC', 'HR': 'HRV',
+                'HU': 'HUN', 'IE': 'IRL', 'IS': 'ISL', 'IT': 'ITA', 'LI': 'LIE', 'LT': 'LTU', 'LU': 'LUX', 'LV': 'LVA',
+                'MT': 'MLT', 'NL': 'NLD', 'NO': 'NOR', 'PL': 'POL', 'PT': 'PRT', 'RO': 'ROU', 'RS': 'SRB', 'SE': 'SWE',
+                'SI': 'SVN', 'SK': 'SVK', 'UK': 'GBR'}
+
+# Country names -> ISO codes, for aggregate files written before CountryCode was part of the output
+ISO3_BY_NAME = {'Austria': 'AUT', 'Belgium': 'BEL', 'Bulgaria': 'BGR', 'Switzerland': 'CHE', 'Cyprus': 'CYP',
+                'Czechia': 'CZE', 'Czech Republic': 'CZE', 'Germany': 'DEU', 'Denmark': 'DNK', 'Estonia': 'EST',
+                'Greece': 'GRC', 'Spain': 'ESP', 'Finland': 'FIN', 'France': 'FRA', 'United Kingdom': 'GBR',
+                'Croatia': 'HRV', 'Hungary': 'HUN', 'Ireland': 'IRL', 'Iceland': 'ISL', 'Italy': 'ITA',
+                'Liechtenstein': 'LIE', 'Lithuania': 'LTU', 'Luxembourg': 'LUX', 'Latvia': 'LVA', 'Malta': 'MLT',
+                'Netherlands': 'NLD', 'Norway': 'NOR', 'Poland': 'POL', 'Portugal': 'PRT', 'Romania': 'ROU',
+                'Serbia': 'SRB', 'Sweden': 'SWE', 'Slovenia': 'SVN', 'Slovakia': 'SVK'}
+
+
+def read_aggregates(path):
+    """
+    Read the country aggregate output, either a CSV file or the Spark output directory of part files
+    """
+    if os.path.isdir(path):
+        parts = sorted(glob.glob(os.path.join(path, 'part-*.csv')))
+        return pd.concat([pd.read_csv(part) for part in parts], ignore_index=True)
+    return pd.read_csv(path)
+
+
+def store_aggregates(path, block_size=65536):
+    """
+    Country means straight from a feature store written with countries, summed one block of the mapped
+    rows at a time. Same layout as the countryEmissions.py means output (Country, pollutants).
+    """
+    import numpy as np
+    from feature_store import FeatureStore
+    store = FeatureStore.open(path)
+    if store.countries is None:
+        raise ValueError("feature store at {} has no countries".format(path))
+    sums = np.zeros((len(store.country_names), len(store.pollutants)))
+    counts = np.bincount(store.countries, minlength=len(store.country_names))
+    for start in range(0, len(store), block_size):
+        np.add.at(sums, store.countries[start:start + block_size], store.features[start:start + block_size])
+    df = pd.DataFrame(sums / np.maximum(counts, 1)[:, np.newaxis], columns=store.pollutants)
+    df.insert(0, 'Country', store.country_names)
+    return df
+
+
+def add_iso_codes(df):
+    """
+    Join ISO3 codes on the country code (falling back to the country name), never on row position
+    """
+    if 'CountryCode' in df.columns:
+        iso = df['CountryCode'].map(ISO3_BY_CODE)
+    else:
+        iso = pd.Series(index=df.index, dtype=object)
+    df = df.assign(iso_code=iso.fillna(df['Country'].map(ISO3_BY_NAME)))
+    missing = df.loc[df['iso_code'].isna(), 'Country'].tolist()
+    if missing:
+        print(f"No ISO code for: {missing}")
+    return df
+
+
+def file_name(pollutant):
+    return re.sub(r'[^0-9A-Za-z]+', '_', pollutant).strip('_').lower() + '_emission.csv'
+
+
+def export_choropleths(df, output_dir='.', max_workers=8):
+    """
+    Write one iso_code/value file per pollutant with data and one long-format file for all of them.
+    Returns the list of files written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # The country means also average Lat/Long, those are not pollutants
+    key_columns = ['Country', 'CountryCode', 'iso_code']
+    pollutants = [col for col in pollutant_columns(df.columns) if col not in key_columns]
+
+    # Fill empty fields with 0 and drop pollutants with all 0 values (no Data)
+    values = df[pollutants].fillna(0)
+    pollutants = [col for col in pollutants if (values[col] != 0).any()]
+
+    long_format = df[['iso_code']].join(values[pollutants]).melt(id_vars='iso_code', var_name='pollutant', value_name='value')
+    jobs = [(os.path.join(output_dir, 'all_pollutants_emission.csv'), long_format)]
+    jobs += [(os.path.join(output_dir, file_name(col)), df[['iso_code']].assign(**{col: values[col]})) for col in pollutants]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(lambda job: job[1].to_csv(job[0], index=False), jobs))
+    return [path for path, _ in jobs]
 
-# Fill empty fields with 0
-df.fillna(value=0, inplace=True)
 
-# dropped pollutants with all 0 values (no Data)
-df = df.loc[:, (df != 0).any(axis=0)]
+def main():
+    parser = argparse.ArgumentParser(description="Datawrapper choropleth files for every pollutant")
+    parser.add_argument("--input", default="avgEmissionPerCountry.csv", help="countryEmissions.py means output (file or directory)")
+    parser.add_argument("--store", default=None, help="read the profiles from a feature store instead of --input")
+    parser.add_argument("--output-dir", default="choropleths")
+    args = parser.parse_args()
 
-# Add iso codes to visualize
-iso_codes = ['LTU', 'ITA', 'HUN', 'FRA', 'SWE', 'POL', 'CZE', 'DEU', 'CYP', 'SVN', 'PRT', 'FIN', 'NLD', 'EST', 'AUT', 'ESP', 'IRL', 'DNK', 'LVA', 'SVK', 'NOR', 'GBR', 'GRC', 'LUX', 'MLT', 'BEL', 'BGR', 'ROU', 'ISL', 'CHE', 'SRB', 'HRV']
+    df = add_iso_codes(store_aggregates(args.store) if args.store else read_aggregates(args.input))
+    written = export_choropleths(df, args.output_dir)
+    print(f"Wrote {len(written)} files to {args.output_dir}")
 
-# Add a column with ISO codes to the DataFrame for visualization
-df = df.assign(iso_code=iso_codes)
+    # Ammonia Emissions
+    if 'Ammonia (NH3)' in df.columns:
+        print(df[['iso_code', 'Ammonia (NH3)']])
 
-# Ammonia Emissions
-print(df[['iso_code', 'Ammonia (NH3)']])
 
-df.to_csv('ammonia_emission.csv', index=False)
+if __name__ == "__main__":
+    main()
@@ -34,107 +34,71 @@ drive.mount('/content/drive')
 
 """## **Emission Profiles**"""
 
-facilities = pd.read_csv('/content/drive/MyDrive/E-PRTR_database_v18_csv/dbo.PUBLISH_FACILITYREPORT.csv', encoding='latin-1')
-facilityIDs = facilities['FacilityID'].unique()
-facilitiesCount = facilityIDs.shape[0]
+from emission_profiles import build_emission_profile_matrix
 
-pollutants = pd.read_csv('/content/drive/MyDrive/E-PRTR_database_v18_csv/dbo.PUBLISH_POLLUTANTRELEASE.csv', encoding='latin-1')
+# Stream the E-PRTR tables in chunks: the reporting year filter runs before any join and the release rows
+# are summed straight into a sparse facility x pollutant matrix (one row per facility)
+profiles, facilityInfo = build_emission_profile_matrix('/content/drive/MyDrive/E-PRTR_database_v18_csv', min_year=2017)
+pollutantColumns = pd.Index(profiles.pollutants, name='PollutantName')
+facilityIDs = profiles.facility_ids
+facilitiesCount = facilityIDs.shape[0]
 
-# Merge Facilities and reporting year
-mergePollutants = pd.merge(facilities, pollutants, on='FacilityReportID')
-mergePollutants = mergePollutants.loc[:, ['FacilityID', 'FacilityReportID', 'PollutantReleaseAndTransferReportID', 'PollutantName', 'TotalQuantity', 'Lat', 'Long']]
+# Dense table (FacilityID, pollutants..., Lat, Long, CountryCode, CountryName) only for the CSV/Parquet outputs
+finalData = profiles.to_frame()
+for col in ['Lat', 'Long', 'CountryCode', 'CountryName']:
+    finalData[col] = facilityInfo[col].values
 
-years = pd.read_csv('/content/drive/MyDrive/E-PRTR_database_v18_csv/dbo.PUBLISH_POLLUTANTRELEASEANDTRANSFERREPORT.csv', encoding='latin-1')
-years = years[years['ReportingYear'] >= 2017]
+finalData.to_csv('/content/drive/MyDrive/emissionProfilesData.csv', index = False)
 
-mergedYear = pd.merge(mergePollutants, years, on='PollutantReleaseAndTransferReportID')
-mergedYear = mergedYear.loc[:, ['FacilityID', 'FacilityReportID', 'PollutantName', 'TotalQuantity', 'Lat', 'Long', 'CountryCode', 'CountryName']]
-mergedYear['Index'] = mergedYear.reset_index().index
+# Typed columnar copy (float32 pollutants, categorical country columns) for the downstream readers
+from profile_store import write_profiles_parquet
+write_profiles_parquet(finalData, '/content/drive/MyDrive/emissionProfilesData.parquet', pollutantColumns)
 
-# Merge Facilities and pollutants
-finalData = mergedYear.pivot(index = ['Index', 'FacilityReportID'], columns = 'PollutantName', values = 'TotalQuantity')
-finalData = pd.merge(finalData, mergedYear[['FacilityReportID', 'FacilityID', 'Lat', 'Long', 'CountryCode', 'CountryName']], on = 'FacilityReportID')
-finalData = finalData.drop(['FacilityReportID'], axis=1)
-pollutantColumns = finalData.columns[:-5]
+# Memory-mapped float32 copy with the countries, read by the visualisation (pollutantVisualisation.py --store)
+from feature_store import FeatureStore
+FeatureStore.write('/content/drive/MyDrive/emissionProfilesStore', facilityIDs, profiles.dense(), profiles.pollutants,
+                   countries=facilityInfo['CountryName'].values)
 
-# Group by facility
-finalData = finalData.groupby('FacilityID', as_index=False)
-finalData = finalData.agg({**{col: 'sum' for col in pollutantColumns}, **{col: 'mean' for col in ['Lat', 'Long']}, **{col: 'first' for col in ['CountryCode', 'CountryName']}})
-finalData = finalData.reset_index(drop=True)
+print(pollutantColumns)
+print(f"Profiles: {profiles.shape}, stored values: {profiles.nnz}")
 
-finalData.to_csv('/content/drive/MyDrive/emissionProfilesData.csv', index = False)
+"""## **Similarity Search**"""
 
-print(pollutantColumns)
+from similarity_hashing import BandedLSH
+from similarity_index import FacilitySimilarityIndex
 
-# Extracting Emission Profiles
-emissionsProfiles = finalData.loc[:, pollutantColumns]
-emissionsProfiles = emissionsProfiles.values.tolist()
+# Define the number of hash functions (k) and the number of LSH bands
+num_hash_functions = 240
+num_bands = 60
 
-"""## **Similarity Search**"""
+# Weighted MinHash signatures for all facilities at once (log-scaled quantities), saved as a memory-mapped
+# index so "which plants look like this one" lookups do not need this notebook:
+#   FacilitySimilarityIndex.open('/content/drive/MyDrive/facilitySimilarityIndex').query(facility_id, k=10)
+similarityIndex = FacilitySimilarityIndex.build(profiles, method='minhash', num_perm=num_hash_functions, bands=num_bands)
+similarityIndex.save('/content/drive/MyDrive/facilitySimilarityIndex')
+signature_matrix = similarityIndex.signatures
+lsh = BandedLSH(signature_matrix, num_bands)
 
-# !pip install datasketch
-# !pip install mmh3
+print(signature_matrix.shape)
+print(similarityIndex.query(facilityIDs[0], k=10))
 
-from datasketch import MinHash, MinHashLSH
-import mmh3
+from grouping import group_facilities, pair_similarity
 
-# Define the number of hash functions (k) and the signature length (b)
-num_hash_functions = 240
-signature_length = 240
-
-# Create an empty signature matrix
-signature_matrix = []
-minhashes = []
-
-# Create MinHash objects and compute the signatures for each list
-for i, item in enumerate(emissionsProfiles):
-    minhash = MinHash(num_perm=num_hash_functions)
-    for value in item:
-        minhash.update(str(value).encode('utf8'))
-    minhashes.append((i, minhash))
-    signature = minhash.digest()
-    signature_matrix.append(signature[:signature_length])
-
-print(len(signature_matrix), len(signature_matrix[0]))
-
-from datasketch import MinHashLSHForest, MinHash
-
-# LSH parameters
-num_perm = 240  # Number of permutations for MinHash
-
-# Create MinHash objects for all vectors
-minhashes = []
-for i, row in enumerate(signature_matrix):
-    minhash = MinHash(num_perm=num_perm)
-    for val in row:
-        minhash.update(str(val).encode('utf-8'))
-    minhashes.append((i, minhash))
-
-# Build LSH Forest
-forest = MinHashLSHForest(num_perm=num_perm)
-for idx, minhash in minhashes:
-    forest.add(idx, minhash)
-forest.index()
-
-# Retrieve similar groups
-groups = {}
-for idx, minhash in minhashes:
-    similar_items = forest.query(minhash, k = 200)
-    group_id = similar_items[0] % 200  # Assign the first similar item's group as the group ID
-    if group_id in groups:
-        groups[group_id].append(finalData.loc[[idx], ['FacilityID']].values[0][0])
-    else:
-        groups[group_id] = [finalData.loc[[idx], ['FacilityID']].values[0][0]]
+# Retrieve similar groups: candidate pairs from the LSH buckets above a similarity threshold are merged
+# with union-find, every connected component is a group
+similarity_threshold = 0.5
+left, right = lsh.candidate_pairs()
+similarity = pair_similarity(similarityIndex.hasher, signature_matrix, left, right)
+facilityGroups = group_facilities(facilityIDs, left, right, similarity, threshold=similarity_threshold)
+groups = facilityGroups.to_dict()
 
 # Print the groups
-count = 0
-groupSize = 0
-groups_list = []
-for group_id, vectors in groups.items():
-    count += 1 
-    groupSize += len(vectors)
-    print(f"Group {group_id}: {vectors}")
-    groups_list += vectors
+count = len(facilityGroups)
+groupSize = int(facilityGroups.sizes.sum())
+groups_list = facilityGroups.facility_ids.tolist()
+print(f"{count} groups, largest: {facilityGroups.sizes[:10].tolist()}")
+for group_id in range(min(count, 10)):
+    print(f"Group {group_id}: {facilityGroups.members(group_id).tolist()}")
 
 """## **Data Preprocessing and Merging using PySpark**"""
 
@@ -145,155 +109,62 @@ from pyspark import SparkContext
 # Create a SparkContext
 sc = SparkContext("local", "Weather")
 
-# Load the CSV file
-lines = sc.textFile("/content/drive/MyDrive/weather.csv")
-
-# Store the header in a separate variable
-header = lines.first()
-lines = lines.filter(lambda line: line != header)
-
-# Parse each line into a tuple of values
-rdd = lines.map(lambda line: tuple(line.split(",")))
-
-rdd=rdd.map(lambda x:tuple(x[1:]))
-# filter out the unwanted field avg_snow_depth
-filtered_rdd = rdd.map(lambda x: (x[0], x[1], x[2], x[3], float(x[4]), float(x[5]), float(x[6]), float(x[7]), float(x[8]), x[10]))
-
-# create key-value pairs with name, year as key and (avg_temp, avg_max_temp, avg_prcp, count) as value
-keyed_rdd = filtered_rdd.map(lambda x: ((x[0], x[1], x[2], x[5], x[6], x[9] ), (x[4], x[7], x[8], 1))) \
-                        .reduceByKey(lambda x, y: (x[0]+y[0], x[1]+y[1], x[2]+y[2], x[3]+y[3]))
-
-# calculate averages for each name, year
-avg_rdd = keyed_rdd.map(lambda x: (x[0][0], x[0][1], x[0][2], x[0][3], x[0][4], x[0][5], x[1][0]/x[1][3], x[1][1]/x[1][3], x[1][2]/x[1][3]))
-
-grouped_rdd = avg_rdd.groupBy(lambda x: (x[0], x[1], x[3], x[4]))
-
-# calculate the change in the last three elements over four years
-change_rdd = grouped_rdd.flatMapValues(lambda x: sorted(list(x), key=lambda y: y[2])).mapValues(lambda x: (x[6], x[7], x[8])).groupByKey().mapValues(lambda x: (list(x)[-1][0] - list(x)[0][0], list(x)[-1][1] - list(x)[0][1], list(x)[-1][2] - list(x)[0][2]))
-
-text = sc.textFile("/content/drive/MyDrive/emissionProfilesData.csv")
-
-# Store the header in a separate variable
-header = text.first()
-text = text.filter(lambda line: line != header)
-
-rdd = text.map(lambda line: tuple(line.split(",")))
-
-rdd.take(1)
-
-rdd1=rdd.map(lambda x:(x[0],(float(x[90]),float(x[91]))))
-
-rdd2=change_rdd.map(lambda x:(x[0][0],(x[0][2],x[0][3])))
-
-from math import radians, cos, sin, asin, sqrt
-from pyspark import SparkContext
-
-def haversine(lon1, lat1, lon2, lat2):
-    """
-    Calculate the great circle distance between two points
-    on the earth (specified in decimal degrees)
-    """
-    # Convert decimal degrees to radians
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+from pyspark.sql import SparkSession
+from instrumentation import debug_take, profiler
+from spark_stages import merge_facilities_with_climate
 
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a))
-    r = 6371  # Radius of earth in kilometers. Use 3956 for miles
-    return c * r
+spark = SparkSession(sc)
 
-# Create a Cartesian product of the two RDDs
-combinations = rdd1.cartesian(rdd2)
+# Yearly station averages -> change in temperature, max temperature and precipitation per station, then every
+# facility is paired with its nearest station (spatial index) and gets that station's changes.
+# final: FacilityID as the key and values as emission profiles along with changes in average temperature,
+# average maximum temperature and average precipitation
+final, change_rdd = merge_facilities_with_climate(sc, spark, "/content/drive/MyDrive/weather.csv",
+                                                  "/content/drive/MyDrive/emissionProfilesData.csv")
 
-# Calculate the distance between each facility and weather station
-distances = combinations.map(lambda x: (x[0][0], x[1][0], haversine(x[0][1][1], x[0][1][0], x[1][1][1], x[1][1][0])))
-
-# Group the combinations by facility and find the combination with the smallest distance
-nearest_stations = distances.groupBy(lambda x: x[0]).map(lambda x: (x[0], min(x[1], key=lambda y: y[2])[1]))
-
-# Create a new RDD with the facility and its nearest weather station
-result = nearest_stations.map(lambda x: (x[0], x[1]))
-
-ans=result.collect()
-
-rdd1=rdd.map(lambda x:(x[0],(x[1:90])))
-
-result=result.join(rdd1)
-
-#Create an RDD that has the weather station name and all the climate variables
-rdd2=change_rdd.map(lambda x:(x[0][0],(x[0][1],x[0][2],x[0][3],x[1][0],x[1][1],x[1][2])))
-
-result1=result.map(lambda x:(x[1][0],(x[0],x[1][1])))
-
-result1=result1.join(rdd2)
-
-#Create a final RDD that has FacilityID as the key and values as emission profiles along with changes in average temperature, average maximum temperature and average precipitation
-final=result1.map(lambda x:(x[1][0][0],(x[1][0][1],x[1][1][3],x[1][1][4],x[1][1][5])))
-
-final.take(1)
+# Only runs a Spark job when debugging is enabled (EPRTR_DEBUG=1 or instrumentation.set_debug())
+debug_take(final, 1)
 
 from pandas.core.internals.blocks import new_block
 from sklearn.model_selection import train_test_split
 
-#Building data from the similarity groups
-emprofile = []
-weatherprof = []
-for group_id,vectors in groups.items():
-  req = final.filter(lambda x:int(x[0]) in vectors)
-  #get data of all the similar groups
-  li = req.collect()
-  for x in li:
-    new_l = (x[1][0])
-    new_l = [float(x) for x in new_l]
-    emprofile.append(new_l)
-    weatherprof.append((x[1][1:]))
+from spark_stages import tag_groups, write_feature_store
+
+# Tag every row of final with its similarity group in one pass (broadcast FacilityID -> group_id mapping),
+# partitioned by group so all group datasets come out of a single shuffle
+taggedFinal = tag_groups(sc, final, facilityGroups).cache()
+
+# Building data from the similarity groups: written once to a memory-mapped store (profiles from the sparse
+# profile matrix, climate deltas from Spark), group by group; everything below reads views of it
+# With EPRTR_PROFILE=1 the Spark jobs of the join and the write are recorded with their shuffle metrics
+with profiler.stage('station_join', sc=sc) as span:
+  modelStore = write_feature_store(taggedFinal, profiles, '/content/drive/MyDrive/modelFeatures')
+  span.rows_out = len(modelStore)
+modelFacilityIDs = modelStore.facility_ids
 
 #sc.stop()
 
 """## **LSTM MODEL**"""
 
 #importing required libraries
+import os
+import numpy as np
 import torch
 import torch.nn as nn
-import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
-
-class FacilityEmissionsLSTM(nn.Module):
-    def __init__(self, input_size, hidden_size, num_layers, output_size):
-        super(FacilityEmissionsLSTM, self).__init__()
-        self.hidden_size = hidden_size
-        self.num_layers = num_layers
-        
-        # LSTM layer
-        self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True)
-        
-        # Fully connected layer for output
-        self.fc = nn.Linear(hidden_size, output_size)
-
-    def forward(self, x):
-        batch_size = x.size(0)
-        
-        # Initialize hidden state and cell state
-        h0 = torch.zeros(self.num_layers, batch_size, self.hidden_size).to(x.device)
-        c0 = torch.zeros(self.num_layers, batch_size, self.hidden_size).to(x.device)
-        
-        # Forward pass through LSTM layer
-        out, _ = self.lstm(x, (h0, c0))
-        
-        # Use only the last time step output
-        out = self.fc(out[:, -1, :])
-        
-        return out
-
-# Convert X and y into tensors
-X = torch.tensor(emprofile, dtype=torch.float32)
-y = torch.tensor(weatherprof, dtype=torch.float32)
-
-# Reshape X to match the expected shape [num_samples, num_timesteps, num_features]
+
+from lstm_model import FacilityEmissionsLSTM, YearlySequenceDataset, yearly_sequences
+
+# X and y are tensors over the mapped feature store, no copy
+modelData = modelStore.dataset()
+X, y = modelData.tensors()
+
+# X stays [num_samples, num_features]; the model expands it to [num_samples, num_timesteps, num_features]
+# as a view, so the profiles are not copied once per timestep
 number_timestamp = 15  # Set the number of timestamps
-X = X.unsqueeze(1).repeat(1, number_timestamp, 1)  # Add number_timestamp dimension
+
+# Set to True to train on real sequences, one timestep per reporting year instead of a repeated profile
+yearly_mode = False
+sequence_years = [2017, 2018]
 
 # Split your data into training and testing sets
 train_ratio = 0.85
@@ -301,39 +172,37 @@ train_size = int(train_ratio * len(X))
 train_X, test_X = X[:train_size], X[train_size:]
 train_y, test_y = y[:train_size], y[train_size:]
 
-# Create PyTorch DataLoader for batch processing
-train_dataset = TensorDataset(train_X, train_y)
-train_dataloader = DataLoader(train_dataset, batch_size=128, shuffle=True)
+# Training rows of the store; DataLoader workers (and train_distributed processes) reopen the files
+# instead of receiving a pickled copy
+train_dataset = modelStore.dataset(np.arange(train_size))
+
+if yearly_mode:
+  from emission_profiles import build_emission_profile_matrix
+  # One profile matrix per reporting year, aligned to the facilities of the training data
+  yearlyProfiles = [build_emission_profile_matrix('/content/drive/MyDrive/E-PRTR_database_v18_csv', min_year=year, max_year=year)[0] for year in sequence_years]
+  sequences = yearly_sequences(yearlyProfiles, modelFacilityIDs, pollutants=profiles.pollutants)
+  train_X, test_X = torch.from_numpy(sequences[:train_size]), torch.from_numpy(sequences[train_size:])
+  train_dataset = YearlySequenceDataset(train_X, train_y)
 
 # Instantiate your LSTM network
-input_size = X.shape[2]  # Number of input features
+input_size = X.shape[-1]  # Number of input features
 hidden_size = 40  # Number of LSTM units (hidden states)
 num_layers = 5 # Number of LSTM layers
 output_size = y.shape[1]  # Desired output size
-net = FacilityEmissionsLSTM(input_size, hidden_size, num_layers, output_size)
+net = FacilityEmissionsLSTM(input_size, hidden_size, num_layers, output_size, num_timesteps=number_timestamp)
 
-# Define loss function and optimizer
-criterion = nn.MSELoss()
-optimizer = optim.Adam(net.parameters(), lr=0.01)
+from training import train_model
 
-# Training loop
+# Training with early stopping on a validation split and checkpoints, using every core of the node.
+# resume=True continues an interrupted run; a checkpoint of another model or dataset is ignored.
+# For several processes the model factory has to be picklable (mp.spawn sends it to every process), e.g.
+#   build_model = functools.partial(FacilityEmissionsLSTM, input_size, hidden_size, num_layers, output_size, num_timesteps=number_timestamp)
+#   net = training.train_distributed(build_model, train_dataset, checkpoint_dir=..., num_epochs=num_epochs)
 num_epochs = 15
-for epoch in range(num_epochs):
-    for batch_X, batch_y in train_dataloader:
-        optimizer.zero_grad()
-        
-        # Forward pass
-        output = net(batch_X)
-        
-        # Compute loss
-        loss = criterion(output.squeeze(), batch_y)
-        
-        # Backward pass and optimization
-        loss.backward()
-        optimizer.step()
-
-    # Print the training loss after each epoch
-    print(f"Epoch {epoch+1}/{num_epochs}, Loss: {loss.item()}")
+history = train_model(net, train_dataset, num_epochs=num_epochs, batch_size=128, lr=0.01, val_fraction=0.1,
+                      patience=3, num_threads=os.cpu_count(), num_workers=2, bf16=False,
+                      checkpoint_dir='/content/drive/MyDrive/lstm_checkpoints', resume=True)
+criterion = nn.MSELoss()
 
 # Evaluation
 net.eval()
@@ -351,22 +220,24 @@ with torch.no_grad():
     accuracy = correct * 100
     print(f"Accuracy: {accuracy}%")
 
+# Export the trained model so "what-if" emission profiles can be scored by inference_service.BatchingPredictor
+from inference_service import export_model
+export_model(net, '/content/drive/MyDrive/facility_emissions_lstm.pt', num_features=input_size)
+
 """## **Correlation Matrix**"""
 
-X = torch.tensor(emprofile)
-y = torch.tensor(weatherprof)
-# Convert tensors to NumPy arrays
-X_np = X.numpy()
-y_np = y.numpy()
+import numpy as np
+from spark_stages import correlation_moments
 
-# Concatenate X and y arrays
-data = np.concatenate((X_np, y_np), axis=1)
+# Sufficient statistics (counts, means, co-moments) over all facilities, computed on the executors in one
+# pass; only the pollutant x climate variable moments reach the driver. Per-group results are Part 6's.
+moments = correlation_moments(taggedFinal)
 
-# Calculate the correlation matrix using NumPy
-correlation_matrix = np.corrcoef(data, rowvar=False)
+# Correlation of every pollutant with the three climate variables (only the block that is used)
+correlation_matrix, p_values = moments.correlation()
 
-# Keep only the last three columns
-last_three_columns = correlation_matrix[:-3, -3:]
+# Pollutants x climate variables
+last_three_columns = correlation_matrix
 
 # Convert the last three columns to pandas DataFrame
 df = pd.DataFrame(last_three_columns,index=None)
@@ -392,7 +263,7 @@ import matplotlib.pyplot as plt
 
 # Example list of groups
 
-groups = emprofile[:20]
+groups = modelStore.features[:20].tolist()
 
 # Create an empty graph
 G = nx.Graph()
@@ -436,102 +307,21 @@ plt.show()
 
 """## **Group-based Correlation Matrix**"""
 
-import numpy as np
-from scipy.stats import pearsonr
-
-count = 0
-allValues = list()
-for group_id, vectors in groups.items():
-  if len(vectors) < 150:
-    continue 
-  emprofile = []
-  weatherprof = []
-  req = final.filter(lambda x:int(x[0]) in vectors)
-  #get data of all the similar groups
-  li = req.collect()
-  for x in li:
-    new_l = (x[1][0])
-    new_l = [float(x) for x in new_l]
-
-
-    emprofile.append(new_l)
-    weatherprof.append((x[1][1:]))
-  
-  count= count+1
-  # Convert tensors to NumPy arrays
-  X= torch.tensor(emprofile)
-  y = torch.tensor(weatherprof)
-  X_np = X.numpy()
-  y_np = y.numpy()
-
-  # # Concatenate X and y arrays
-  data = np.concatenate((X_np, y_np), axis=1)
-
-  # Calculate the correlation matrix using NumPy
-  correlation_matrix = np.corrcoef(data, rowvar=False)
-  
-  # Calculate p-values for correlation coefficients
-  p_values = np.zeros_like(correlation_matrix)
-  for i in range(correlation_matrix.shape[0]):
-      for j in range(correlation_matrix.shape[1]):
-          corr_coef, p_value = pearsonr(data[i], data[j])
-          p_values[i, j] = p_value
-
-  # Keep only the last three columns
-  last_three_columns = correlation_matrix[:-3, -3:]
-  p_last_three_columns = p_values[:-3, -3:]
-
-  # Convert the last three columns to pandas DataFrame
-  df1 = pd.DataFrame(last_three_columns,index=None)
-  df2 = pd.DataFrame(p_last_three_columns,index=None)
-  df1.columns = ['Change_in_avg_temp','change_in_avg_max_temp','change_in_avg_precipitation']
-  df2.columns = ['Change_in_avg_temp','change_in_avg_max_temp','change_in_avg_precipitation']
-
-  #Get the facility attributes
-  df1['Facility_Attributes'] = finalData.columns[1:-4]
-  df2['Facility_Attributes'] = finalData.columns[1:-4]
-  cols = df1.columns.tolist()
-
-  #create pandas dataframe with the required columns
-  cols = ['Facility_Attributes'] + cols[:cols.index('Facility_Attributes')] 
-  df1 = df1[cols]
-  df2 = df2[cols]
-  allValues.append([df1, df2])
-  if count >= 5:
-    break
-
-hypothesisValues = list()
-for i in range(len(allValues)):
-  correlationMatrix, pValueMatrix = allValues[i]
-
-  # Get the top 3 absolute values in the DataFrame
-  top_3_abs_values = correlationMatrix.nlargest(5, correlationMatrix.columns)
-  finalList = list()
-  indices = top_3_abs_values.index.tolist()
-  values = top_3_abs_values.values.tolist()
-  for i in range(3):
-    maxCol = -1
-    maxVal = -99999999999999
-    for j in range(3):
-      if i == 0:
-        if values[i][j] > maxVal:
-          maxCol = j
-          maxVal = values[i][j]
-        else:
-          maxVal = 999999999
-      else:
-        if i == 2:
-          if -values[i][j] > maxVal:
-            maxCol = j
-            maxVal = values[i][j]
-    finalList.append([pollutantColumns[indices[i]], df1.columns[maxCol], correlationMatrix.loc[indices[i], df1.columns[maxCol]], pValueMatrix.loc[indices[i], df1.columns[maxCol]]])
-    hypothesisValues.append(finalList)
+from group_analysis import analyse_groups, significant_findings
+
+# Every group with at least 150 facilities, read from the feature store and analysed in a process pool
+# (workers map the store themselves); p-values are corrected with Benjamini-Hochberg across all groups and pollutants
+groupData = modelStore.group_data(min_size=150)
+# method='permutation' swaps the normality-based Pearson p-values for a batched permutation test
+groupResults = analyse_groups(groupData, profiles.pollutants, min_size=150, alpha=0.05, method='pearson')
+groupResults.to_csv('/content/drive/MyDrive/groupCorrelation.csv', index=False)
+print(groupResults.head())
 
 # Hypothesis Testing
 alpha = 0.05
-for i in range(3):
-  pValue = hypothesisValues[0][i][3]
-  if pValue < 0.05 and hypothesisValues[0][i][2] > 0:
-    print("Observed correlation in the sample is statistically significant enough to say that increase in \"" + hypothesisValues[0][i][0] + "\", increases " + hypothesisValues[0][i][1])
-  elif pValue < 0.05 and hypothesisValues[0][i][2] < 0:
-    print("Observed correlation in the sample is statistically significant enough to say that increase in \"" + hypothesisValues[0][i][0] + "\", decreases " + hypothesisValues[0][i][1])
\ No newline at end of file
+for row in significant_findings(groupResults, top=20).itertuples():
+  print(f"Group {row.group_id}: observed correlation in the sample is statistically significant enough to say that increase in \"" + row.pollutant + "\", " + row.direction + " " + row.climate_variable)
+
+# Per-stage metrics of this run (only recorded with EPRTR_PROFILE=1), the trace opens in chrome://tracing
+if profiler.enabled:
+  profiler.export('/content/drive/MyDrive/pipeline_profile.trace.json')
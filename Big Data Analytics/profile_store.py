@@ -0,0 +1,73 @@
+"""
+General description of the code: Typed, columnar copy of emissionProfilesData.csv.
+The emission profile builder writes a Parquet file next to the CSV with float32 pollutant columns and
+dictionary encoded (categorical) CountryCode/CountryName. Readers ask only for the columns they need,
+so a job that only uses Lat/Long does not parse the ~90 pollutant columns.
+Frameworks used here: pandas, PyArrow, PySpark
+"""
+
+import os
+
+import numpy as np
+
+ID_COLUMN = 'FacilityID'
+LOCATION_COLUMNS = ['Lat', 'Long']
+COUNTRY_COLUMNS = ['CountryCode', 'CountryName']
+# Columns that are never pollutants (older CSV exports also carry an unnamed row index)
+NON_POLLUTANT_COLUMNS = {ID_COLUMN, *LOCATION_COLUMNS, *COUNTRY_COLUMNS, '', '_c0', 'Unnamed: 0'}
+
+
+def parquet_path(csv_path):
+    """
+    emissionProfilesData.csv -> emissionProfilesData.parquet
+    """
+    root, _ = os.path.splitext(csv_path)
+    return root + '.parquet'
+
+
+def pollutant_columns(columns):
+    """
+    Pollutant columns of an emission profile table, in table order
+    """
+    return [col for col in columns if col not in NON_POLLUTANT_COLUMNS]
+
+
+def to_typed_frame(finalData, pollutantColumns=None):
+    """
+    Cast an emission profile frame to the storage types of the Parquet copy
+    """
+    if pollutantColumns is None:
+        pollutantColumns = pollutant_columns(finalData.columns)
+    pollutantColumns = list(pollutantColumns)
+    typed = finalData.loc[:, [ID_COLUMN] + pollutantColumns + LOCATION_COLUMNS + COUNTRY_COLUMNS].copy()
+    typed[ID_COLUMN] = typed[ID_COLUMN].astype(np.int64)
+    typed[pollutantColumns] = typed[pollutantColumns].fillna(0).astype(np.float32)
+    typed[LOCATION_COLUMNS] = typed[LOCATION_COLUMNS].astype(np.float64)
+    for col in COUNTRY_COLUMNS:
+        typed[col] = typed[col].astype('category')
+    return typed
+
+
+def write_profiles_parquet(finalData, path, pollutantColumns=None):
+    """
+    Write the typed Parquet copy of the emission profiles, returns the path written
+    """
+    to_typed_frame(finalData, pollutantColumns).to_parquet(path, engine='pyarrow', index=False)
+    return path
+
+
+def load_profiles_spark(spark, path, columns=None):
+    """
+    Read emission profiles as a Spark DataFrame with column pruning.
+    Falls back to the CSV (with schema inference) when no Parquet copy exists yet.
+    """
+    if path.endswith('.csv') and os.path.exists(parquet_path(path)):
+        path = parquet_path(path)
+    if path.endswith('.csv'):
+        df = spark.read.csv(path, header=True, inferSchema=True)
+    else:
+        df = spark.read.parquet(path)
+    if columns is not None:
+        # Backticks so pollutant names with dots/commas resolve as plain column names
+        df = df.select(*['`{}`'.format(col) for col in columns])
+    return df
@@ -0,0 +1,257 @@
+"""
+General description of the code: Vectorized similarity hashing for real-valued emission profiles.
+Signatures for all facilities are computed at once with NumPy, either as weighted MinHash (consistent
+weighted sampling, so the amount emitted matters and not only which pollutants are reported) or as random
+hyperplane SimHash (cosine similarity). Signatures are bucketed with banded LSH to get candidate pairs.
+This replaces the per-value datasketch MinHash updates of Part 2 in predictive_model.py.
+Frameworks used here: NumPy, SciPy
+"""
+
+import numpy as np
+from scipy import sparse
+
+# Odd 64-bit multiplier used to mix the rows of a band into one bucket key
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _as_matrix(profiles):
+    """
+    Accept an EmissionProfileMatrix, a scipy sparse matrix or anything array-like
+    """
+    matrix = getattr(profiles, 'matrix', profiles)
+    # Dense input keeps its dtype (a float32 memory map is not copied), blocks are converted as they are hashed
+    return matrix if sparse.issparse(matrix) else np.asarray(matrix)
+
+
+class WeightedMinHash:
+    """
+    Consistent weighted sampling (Ioffe's ICWS) over non-negative profiles.
+    The probability that two facilities share a signature value is their weighted Jaccard similarity
+    sum(min(a, b)) / sum(max(a, b)).
+    """
+
+    def __init__(self, num_features, num_perm=128, seed=1, block_size=512):
+        rng = np.random.default_rng(seed)
+        self.num_features = num_features
+        self.num_perm = num_perm
+        self.block_size = block_size
+        self.r = rng.gamma(2.0, 1.0, size=(num_perm, num_features))
+        self.c = rng.gamma(2.0, 1.0, size=(num_perm, num_features))
+        self.beta = rng.uniform(0.0, 1.0, size=(num_perm, num_features))
+        self.log_c = np.log(self.c)
+
+    def signatures(self, profiles, transform=None):
+        """
+        [facilities, num_perm] int64 signatures, all-zero profiles get -1 everywhere.
+        transform (e.g. log_scale) is applied to one block of rows at a time.
+        """
+        matrix = _as_matrix(profiles)
+        out = np.empty((matrix.shape[0], self.num_perm), dtype=np.int64)
+        for start in range(0, matrix.shape[0], self.block_size):
+            block = matrix[start:start + self.block_size]
+            if transform is not None:
+                block = transform(block)
+            out[start:start + block.shape[0]] = self._block_signatures(sparse.csr_matrix(block, dtype=np.float64))
+        return out
+
+    def _block_signatures(self, block):
+        # Only the reported pollutants are sampled: one row of work per nonzero entry of the CSR block
+        block.sum_duplicates()
+        rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        positive = block.data > 0
+        rows, features, weights = rows[positive], block.indices[positive], block.data[positive]
+        signature = np.full((block.shape[0], self.num_perm), -1, dtype=np.int64)
+        if not len(weights):
+            return signature
+        # [nonzeros, num_perm]
+        r, beta = self.r[:, features].T, self.beta[:, features].T
+        t = np.floor(np.log(weights)[:, np.newaxis] / r + beta)
+        log_a = self.log_c[:, features].T - r * (t - beta) - r
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        counts = np.diff(np.r_[starts, len(rows)])
+        minimum = np.minimum.reduceat(log_a, starts, axis=0)
+        # First entry of each row reaching its minimum, the same choice as an argmin over all pollutants
+        position = np.where(log_a == np.repeat(minimum, counts, axis=0), np.arange(len(rows))[:, np.newaxis], len(rows))
+        first = np.minimum.reduceat(position, starts, axis=0)
+        chosen_t = np.take_along_axis(t, first, axis=0).astype(np.int64)
+        signature[rows[starts]] = (features[first].astype(np.int64) << 32) ^ (chosen_t & 0xFFFFFFFF)
+        return signature
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        """
+        Estimated weighted Jaccard similarity, sig_b may hold several signatures (one per row)
+        """
+        return (np.asarray(sig_a) == np.asarray(sig_b)).mean(axis=-1)
+
+
+class SimHash:
+    """
+    Random hyperplane hashing, the fraction of differing bits estimates angle / pi between two profiles
+    """
+
+    def __init__(self, num_features, num_bits=128, seed=1, block_size=65536):
+        rng = np.random.default_rng(seed)
+        self.num_features = num_features
+        self.num_perm = num_bits
+        self.block_size = block_size
+        self.planes = rng.standard_normal(size=(num_features, num_bits))
+
+    def signatures(self, profiles, transform=None):
+        """
+        [facilities, num_bits] uint8 (0/1) signatures, transform is applied to one block of rows at a time
+        """
+        matrix = _as_matrix(profiles)
+        out = np.empty((matrix.shape[0], self.num_perm), dtype=np.uint8)
+        for start in range(0, matrix.shape[0], self.block_size):
+            block = matrix[start:start + self.block_size]
+            if transform is not None:
+                block = transform(block)
+            out[start:start + block.shape[0]] = np.asarray(block @ self.planes) > 0
+        return out
+
+    @staticmethod
+    def similarity(sig_a, sig_b):
+        """
+        Estimated cosine similarity, sig_b may hold several signatures (one per row)
+        """
+        hamming = (np.asarray(sig_a) != np.asarray(sig_b)).mean(axis=-1)
+        return np.cos(np.pi * hamming)
+
+
+def log_scale(profiles):
+    """
+    log1p of the emitted quantities; totals span many orders of magnitude so this keeps a single large
+    pollutant from deciding every signature. Sparse input stays sparse.
+    """
+    matrix = _as_matrix(profiles)
+    if sparse.issparse(matrix):
+        matrix = matrix.astype(np.float64, copy=True)
+        matrix.data = np.log1p(np.maximum(matrix.data, 0))
+        return matrix
+    return np.log1p(np.maximum(matrix, 0))
+
+
+def band_keys(signatures, bands):
+    """
+    [facilities, bands] uint64 bucket keys, each band of rows is mixed into one key
+    """
+    signatures = np.asarray(signatures)
+    rows = signatures.shape[1] // bands
+    if rows == 0:
+        raise ValueError("{} bands need at least {} signature values".format(bands, bands))
+    values = signatures[:, :bands * rows].astype(np.int64).view(np.uint64).reshape(len(signatures), bands, rows)
+    keys = np.zeros((len(signatures), bands), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i in range(rows):
+            keys = (keys ^ values[:, :, i]) * _MIX
+            keys ^= keys >> np.uint64(29)
+    return keys
+
+
+def unique_codes(codes):
+    """
+    Sorted unique values of an int64 array
+    """
+    # Timsort (kind='stable') merges the already sorted runs of concatenated results in near linear time
+    codes = np.sort(codes, kind='stable')
+    return codes[np.r_[True, codes[1:] != codes[:-1]]] if len(codes) else codes
+
+
+class BandedLSH:
+    """
+    Banded LSH over precomputed signatures.
+    Two facilities are candidates when all rows of at least one band agree.
+    """
+
+    def __init__(self, signatures, bands=32):
+        self.signatures = np.asarray(signatures)
+        self.bands = bands
+        keys = band_keys(self.signatures, bands)
+        # Per band: facilities sorted by key, so each bucket is a contiguous slice
+        self.order = np.argsort(keys, axis=0, kind='stable')
+        self.sorted_keys = np.take_along_axis(keys, self.order, axis=0)
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def _bucket(self, band, key):
+        keys = self.sorted_keys[:, band]
+        lo = np.searchsorted(keys, key, side='left')
+        hi = np.searchsorted(keys, key, side='right')
+        return self.order[lo:hi, band]
+
+    def query_signature(self, signature, exclude=None):
+        """
+        Candidate rows whose bucket matches signature in any band
+        """
+        keys = band_keys(np.asarray(signature).reshape(1, -1), self.bands)[0]
+        found = np.unique(np.concatenate([self._bucket(b, keys[b]) for b in range(self.bands)]))
+        if exclude is not None:
+            found = found[found != exclude]
+        return found
+
+    def query(self, row, exclude_self=True):
+        return self.query_signature(self.signatures[row], exclude=row if exclude_self else None)
+
+    def _band_pairs(self, band, max_bucket_size, max_band_pairs):
+        """
+        Sorted unique i * n + j codes (i < j) of the pairs sharing a bucket in one band
+        """
+        n = len(self)
+        keys = self.sorted_keys[:, band]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        sizes = np.diff(np.r_[starts, len(keys)])
+        shared = (sizes > 1) & (sizes <= max_bucket_size)
+        starts, sizes = starts[shared], sizes[shared]
+        # Largest buckets first out until the band fits its pair budget
+        by_size = np.argsort(sizes, kind='stable')
+        fits = np.cumsum(sizes[by_size] * (sizes[by_size] - 1) // 2) <= max_band_pairs
+        starts, sizes = starts[by_size[fits]], sizes[by_size[fits]]
+        codes = []
+        # Buckets of the same size are expanded together
+        for size in np.unique(sizes):
+            members = np.asarray(self.order[:, band])[starts[sizes == size, np.newaxis] + np.arange(size)]
+            i, j = np.triu_indices(size, k=1)
+            a, b = members[:, i].ravel(), members[:, j].ravel()
+            codes.append(np.minimum(a, b).astype(np.int64) * n + np.maximum(a, b))
+        return unique_codes(np.concatenate(codes)) if codes else np.empty(0, dtype=np.int64)
+
+    def candidate_pairs(self, max_bucket_size=1000, max_band_pairs=20000000):
+        """
+        All candidate pairs (i < j) as two arrays. Buckets bigger than max_bucket_size are skipped
+        since they only hold near-empty profiles and would produce quadratic output; when a band still has
+        more than max_band_pairs pairs its largest buckets are skipped as well.
+        Pairs are deduplicated as int64 codes i * n + j, band by band.
+        """
+        n = len(self)
+        pairs = np.empty(0, dtype=np.int64)
+        pending, pending_size = [], 0
+        for b in range(self.bands):
+            codes = self._band_pairs(b, max_bucket_size, max_band_pairs)
+            pending.append(codes)
+            pending_size += len(codes)
+            # Most pairs repeat in many bands, merging once the pending ones outgrow the result bounds memory
+            if pending_size > max(len(pairs), 1 << 20) or b == self.bands - 1:
+                pairs = unique_codes(np.concatenate([pairs] + pending))
+                pending, pending_size = [], 0
+        return pairs // max(n, 1), pairs % max(n, 1)
+
+
+def build_hasher(num_features, method='minhash', num_perm=128, seed=1):
+    if method == 'minhash':
+        return WeightedMinHash(num_features, num_perm=num_perm, seed=seed)
+    if method == 'simhash':
+        return SimHash(num_features, num_bits=num_perm, seed=seed)
+    raise ValueError("unknown hashing method: {}".format(method))
+
+
+def hash_profiles(profiles, method='minhash', num_perm=128, bands=32, seed=1, scale=True):
+    """
+    Signatures and a banded LSH index for all facilities in one call.
+    Returns (hasher, signatures, lsh)
+    """
+    matrix = _as_matrix(profiles)
+    hasher = build_hasher(matrix.shape[1], method, num_perm, seed)
+    signatures = hasher.signatures(matrix, transform=log_scale if scale else None)
+    return hasher, signatures, BandedLSH(signatures, bands)
@@ -0,0 +1,299 @@
+"""
+General description of the code: Persistent facility similarity index.
+The signatures and banded LSH tables from similarity_hashing.py are saved as .npy files and opened with
+mmap, so loading the index does not read it into memory. Lookups answer "which plants look like this one"
+for a FacilityID or for a new emission profile. New or updated facilities go to a small delta segment
+that is searched next to the main tables until compact() folds it in.
+Frameworks used here: NumPy
+"""
+
+import json
+import os
+
+import numpy as np
+
+from similarity_hashing import band_keys, build_hasher, log_scale, unique_codes
+
+_ARRAYS = ['facility_ids', 'signatures', 'order', 'sorted_keys']
+_DELTA_ARRAYS = ['delta_facility_ids', 'delta_signatures', 'deleted']
+
+
+def _sorted_lookup(facility_ids):
+    facility_ids = np.asarray(facility_ids)
+    order = np.argsort(facility_ids, kind='stable')
+    return facility_ids[order], order
+
+
+def _find(lookup, facility_ids):
+    """
+    Rows of facility_ids in a segment, -1 for the ones it does not hold
+    """
+    sorted_ids, order = lookup
+    if not len(sorted_ids):
+        return np.full(len(facility_ids), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(sorted_ids, facility_ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[positions] == facility_ids, order[positions], -1)
+
+
+def _bucket_members(sorted_keys, order, keys, max_bucket_size):
+    """
+    (position in keys, row) for every row of a band that shares its bucket with one of keys
+    """
+    lo = np.searchsorted(sorted_keys, keys, side='left')
+    counts = np.searchsorted(sorted_keys, keys, side='right') - lo
+    counts[counts > max_bucket_size] = 0
+    query = np.repeat(np.arange(len(keys), dtype=np.int64), counts)
+    offsets = np.arange(len(query)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return query, np.asarray(order[np.repeat(lo, counts) + offsets], dtype=np.int64)
+
+
+class FacilitySimilarityIndex:
+    """
+    Similarity index over facility signatures.
+    Use FacilitySimilarityIndex.build() for a new index and FacilitySimilarityIndex.open() for a saved one.
+    """
+
+    def __init__(self, config, facility_ids, signatures, order, sorted_keys,
+                 delta_facility_ids=None, delta_signatures=None, deleted=None, path=None):
+        self.config = config
+        self.hasher = build_hasher(config['num_features'], config['method'], config['num_perm'], config['seed'])
+        self.bands = config['bands']
+        self.facility_ids = facility_ids
+        self.signatures = signatures
+        self.order = order
+        self.sorted_keys = sorted_keys
+        self.path = path
+        num_perm = signatures.shape[1]
+        self.delta_facility_ids = np.empty(0, dtype=np.int64) if delta_facility_ids is None else np.asarray(delta_facility_ids)
+        self.delta_signatures = np.empty((0, num_perm), dtype=signatures.dtype) if delta_signatures is None else np.asarray(delta_signatures)
+        # Rows of the main segment replaced by the delta segment
+        self.deleted = np.zeros(len(facility_ids), dtype=bool) if deleted is None else np.array(deleted, dtype=bool)
+        # (sorted ids, their rows) of both segments, built on the first lookup
+        self._main_lookup = None
+        self._delta_lookup = None
+        self._delta_keys = band_keys(self.delta_signatures, self.bands) if len(self.delta_signatures) else None
+
+    @classmethod
+    def build(cls, profiles, method='minhash', num_perm=128, bands=32, seed=1, scale=True):
+        """
+        Index every facility of an EmissionProfileMatrix (or a FeatureStore)
+        """
+        config = {'method': method, 'num_perm': num_perm, 'bands': bands, 'seed': seed, 'scale': scale,
+                  'num_features': profiles.shape[1], 'pollutants': list(profiles.pollutants)}
+        hasher = build_hasher(config['num_features'], method, num_perm, seed)
+        signatures = hasher.signatures(profiles.matrix, transform=log_scale if scale else None)
+        keys = band_keys(signatures, bands)
+        order = np.argsort(keys, axis=0, kind='stable')
+        return cls(config, np.asarray(profiles.facility_ids, dtype=np.int64), signatures,
+                   order, np.take_along_axis(keys, order, axis=0))
+
+    @classmethod
+    def open(cls, path, mmap_mode='r'):
+        """
+        Open a saved index, the main arrays are memory-mapped rather than read
+        """
+        with open(os.path.join(path, 'config.json')) as f:
+            config = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode) for name in _ARRAYS}
+        delta = {}
+        for name in _DELTA_ARRAYS:
+            file = os.path.join(path, name + '.npy')
+            delta[name] = np.load(file) if os.path.exists(file) else None
+        return cls(config, path=path, **arrays, **delta)
+
+    def save(self, path=None):
+        """
+        Write the index to a directory. When saving over the directory it was opened from, only the
+        delta segment is rewritten.
+        """
+        path = path or self.path
+        os.makedirs(path, exist_ok=True)
+        if path != self.path:
+            for name in _ARRAYS:
+                np.save(os.path.join(path, name + '.npy'), np.asarray(getattr(self, name)))
+            with open(os.path.join(path, 'config.json'), 'w') as f:
+                json.dump(self.config, f)
+        for name in _DELTA_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        self.path = path
+        return path
+
+    def __len__(self):
+        return int((~self.deleted).sum()) + len(self.delta_facility_ids)
+
+    def _main_rows(self, facility_ids):
+        if self._main_lookup is None:
+            self._main_lookup = _sorted_lookup(self.facility_ids)
+        return _find(self._main_lookup, facility_ids)
+
+    def _delta_rows(self, facility_ids):
+        if self._delta_lookup is None:
+            self._delta_lookup = _sorted_lookup(self.delta_facility_ids)
+        return _find(self._delta_lookup, facility_ids)
+
+    def __contains__(self, facility_id):
+        facility_id = np.array([facility_id], dtype=np.int64)
+        main = self._main_rows(facility_id)[0]
+        return bool(self._delta_rows(facility_id)[0] >= 0 or (main >= 0 and not self.deleted[main]))
+
+    def signature_of(self, profile):
+        """
+        Signature of a single emission profile (pollutants in the order of config['pollutants'])
+        """
+        profile = np.asarray(profile, dtype=np.float64).reshape(1, -1)
+        if self.config['scale']:
+            profile = log_scale(profile)
+        return self.hasher.signatures(profile)[0]
+
+    def add(self, facility_ids, profiles):
+        """
+        Insert or replace facilities without rebuilding the main tables.
+        profiles is a [len(facility_ids), pollutants] array-like or sparse matrix.
+        """
+        facility_ids = np.asarray(facility_ids, dtype=np.int64).reshape(-1)
+        matrix = log_scale(profiles) if self.config['scale'] else profiles
+        signatures = self.hasher.signatures(matrix).astype(self.delta_signatures.dtype, copy=False)
+        # A facility given twice keeps its last profile
+        _, last = np.unique(facility_ids[::-1], return_index=True)
+        keep = np.sort(len(facility_ids) - 1 - last)
+        facility_ids, signatures = facility_ids[keep], signatures[keep]
+
+        main = self._main_rows(facility_ids)
+        self.deleted[main[main >= 0]] = True
+        delta = self._delta_rows(facility_ids)
+        replaced = delta >= 0
+        self.delta_signatures[delta[replaced]] = signatures[replaced]
+        self.delta_facility_ids = np.concatenate([self.delta_facility_ids, facility_ids[~replaced]])
+        self.delta_signatures = np.concatenate([self.delta_signatures, signatures[~replaced]])
+        self._delta_lookup = None
+        self._delta_keys = band_keys(self.delta_signatures, self.bands)
+
+    def compact(self):
+        """
+        Fold the delta segment into the main tables (one sort per band)
+        """
+        keep = ~self.deleted
+        self.facility_ids = np.concatenate([np.asarray(self.facility_ids)[keep], self.delta_facility_ids])
+        self.signatures = np.concatenate([np.asarray(self.signatures)[keep], self.delta_signatures])
+        keys = band_keys(self.signatures, self.bands)
+        self.order = np.argsort(keys, axis=0, kind='stable')
+        self.sorted_keys = np.take_along_axis(keys, self.order, axis=0)
+        self.delta_facility_ids = np.empty(0, dtype=np.int64)
+        self.delta_signatures = np.empty((0, self.signatures.shape[1]), dtype=self.signatures.dtype)
+        self.deleted = np.zeros(len(self.facility_ids), dtype=bool)
+        self._main_lookup = None
+        self._delta_lookup = None
+        self._delta_keys = None
+        # The main arrays changed, a later save() has to write them all
+        self.path = None
+
+    def _signatures_of(self, facility_ids):
+        delta = self._delta_rows(facility_ids)
+        main = self._main_rows(facility_ids)
+        in_main = (delta < 0) & (main >= 0)
+        in_main[in_main] = ~self.deleted[main[in_main]]
+        missing = (delta < 0) & ~in_main
+        if missing.any():
+            raise KeyError("FacilityIDs not in the index: {}".format(facility_ids[missing][:10].tolist()))
+        signatures = np.empty((len(facility_ids), self.signatures.shape[1]), dtype=self.signatures.dtype)
+        signatures[delta >= 0] = self.delta_signatures[delta[delta >= 0]]
+        signatures[in_main] = self.signatures[main[in_main]]
+        return signatures
+
+    def neighbours(self, facility_ids, threshold=0.0, max_bucket_size=1000, block_size=100000):
+        """
+        query() for many indexed facilities at once: (FacilityIDs, neighbour FacilityIDs, estimated similarity)
+        arrays of every candidate pair with a similarity of at least threshold; a pair of two of the given
+        facilities is returned once. Like BandedLSH.candidate_pairs(), buckets bigger than max_bucket_size
+        are skipped.
+        """
+        facility_ids = np.asarray(facility_ids, dtype=np.int64).reshape(-1)
+        own = self._signatures_of(facility_ids)
+        keys = band_keys(own, self.bands)
+        num_main = len(self.facility_ids)
+        # Candidates are coded as query position * rows + row, delta rows come after the main rows
+        rows = num_main + len(self.delta_facility_ids)
+        segments = [(self.sorted_keys, self.order, 0)]
+        if self._delta_keys is not None:
+            delta_order = np.argsort(self._delta_keys, axis=0, kind='stable')
+            segments.append((np.take_along_axis(self._delta_keys, delta_order, axis=0), delta_order, num_main))
+        codes = []
+        for b in range(self.bands):
+            for sorted_keys, order, offset in segments:
+                query, found = _bucket_members(sorted_keys[:, b], order[:, b], keys[:, b], max_bucket_size)
+                if offset == 0:
+                    query, found = query[~self.deleted[found]], found[~self.deleted[found]]
+                codes.append(query * rows + found + offset)
+        codes = unique_codes(np.concatenate(codes))
+        query, found = codes // max(rows, 1), codes % max(rows, 1)
+        in_delta = found >= num_main
+        other = np.empty(len(found), dtype=np.int64)
+        other[~in_delta] = self.facility_ids[found[~in_delta]]
+        other[in_delta] = self.delta_facility_ids[found[in_delta] - num_main]
+        # Pairs of two queried facilities are found from both sides, they are kept once
+        keep = (other != facility_ids[query]) & ~(np.isin(other, facility_ids) & (other < facility_ids[query]))
+        query, found, other, in_delta = query[keep], found[keep], other[keep], in_delta[keep]
+
+        similarity = np.empty(len(query), dtype=np.float64)
+        for start in range(0, len(query), block_size):
+            part = slice(start, start + block_size)
+            block_found, block_delta = found[part], in_delta[part]
+            signatures = np.empty((len(block_found), self.signatures.shape[1]), dtype=self.signatures.dtype)
+            signatures[~block_delta] = self.signatures[block_found[~block_delta]]
+            signatures[block_delta] = self.delta_signatures[block_found[block_delta] - num_main]
+            similarity[part] = self.hasher.similarity(own[query[part]], signatures)
+        keep = similarity >= threshold
+        return facility_ids[query[keep]], other[keep], similarity[keep]
+
+    def _candidates(self, signature, exclude=None):
+        keys = band_keys(np.asarray(signature).reshape(1, -1), self.bands)[0]
+        main = []
+        for b in range(self.bands):
+            column = self.sorted_keys[:, b]
+            lo = np.searchsorted(column, keys[b], side='left')
+            hi = np.searchsorted(column, keys[b], side='right')
+            main.append(np.asarray(self.order[lo:hi, b]))
+        main = np.unique(np.concatenate(main)) if main else np.empty(0, dtype=np.int64)
+        main = main[~self.deleted[main]]
+        main_ids = np.asarray(self.facility_ids[main])
+        main_signatures = np.asarray(self.signatures[main])
+        if self._delta_keys is not None:
+            delta = np.flatnonzero((self._delta_keys == keys).any(axis=1))
+            ids = np.concatenate([main_ids, self.delta_facility_ids[delta]])
+            signatures = np.concatenate([main_signatures, self.delta_signatures[delta]])
+        else:
+            ids, signatures = main_ids, main_signatures
+        if exclude is not None:
+            keep = ids != exclude
+            ids, signatures = ids[keep], signatures[keep]
+        return ids, signatures
+
+    def query_vector(self, profile, k=10, exclude=None):
+        """
+        Up to k (FacilityID, estimated similarity) pairs for an emission profile, most similar first
+        """
+        signature = self.signature_of(profile)
+        return self._rank(signature, k, exclude)
+
+    def query(self, facility_id, k=10):
+        """
+        Up to k (FacilityID, estimated similarity) pairs that look like an indexed facility, most similar first
+        """
+        facility_id = int(facility_id)
+        delta = self._delta_rows(np.array([facility_id]))[0]
+        main = self._main_rows(np.array([facility_id]))[0]
+        if delta >= 0:
+            signature = self.delta_signatures[delta]
+        elif main >= 0 and not self.deleted[main]:
+            signature = np.asarray(self.signatures[main])
+        else:
+            raise KeyError("FacilityID {} is not in the index".format(facility_id))
+        return self._rank(signature, k, exclude=facility_id)
+
+    def _rank(self, signature, k, exclude=None):
+        ids, signatures = self._candidates(signature, exclude)
+        if not len(ids):
+            return []
+        similarity = self.hasher.similarity(signature, signatures)
+        top = np.argsort(-similarity, kind='stable')[:k]
+        return [(int(ids[i]), float(similarity[i])) for i in top]
@@ -0,0 +1,181 @@
+"""
+General description of the code: Spark stages of predictive_model.py.
+Part 3 (yearly station averages, per-station climate deltas in one combiner, nearest station join), tagging
+the merged facility/climate RDD with similarity groups (broadcast mapping, partitioned by group so every
+per-group dataset comes out of one shuffle), writing the per-group model data to the feature store and the
+distributed correlation statistics of Part 5.
+Frameworks used here: PySpark, NumPy
+"""
+
+import numpy as np
+
+from correlation import CLIMATE_COLUMNS, CorrelationMoments
+from feature_store import FeatureStoreWriter
+from profile_store import load_profiles_spark, pollutant_columns
+from spatial_index import nearest_stations
+
+
+def tag_groups(sc, final, facility_groups, min_size=1, num_partitions=None):
+    """
+    Tag every row of final ((FacilityID, values) pairs) with the group of its facility.
+    Rows of facilities outside groups with at least min_size members are dropped.
+    Returns an RDD of (group_id, row) partitioned by group_id.
+    """
+    sizes = facility_groups.sizes
+    mapping = {int(f): int(g) for f, g in zip(facility_groups.facility_ids, facility_groups.group_of) if sizes[g] >= min_size}
+    group_of = sc.broadcast(mapping)
+
+    def tag_partition(rows):
+        lookup = group_of.value
+        for row in rows:
+            group_id = lookup.get(int(row[0]))
+            if group_id is not None:
+                yield group_id, row
+
+    tagged = final.mapPartitions(tag_partition)
+    return tagged.partitionBy(num_partitions or final.getNumPartitions())
+
+
+def _group_partition(rows):
+    groups = {}
+    for group_id, row in rows:
+        groups.setdefault(group_id, []).append(row)
+    return iter(groups.items())
+
+
+def iter_group_datasets(tagged, group_ids=None):
+    """
+    Stream (group_id, [rows]) to the driver one partition at a time.
+    Rows of a group all sit in the same partition (tag_groups partitions by group). This is not a single
+    pass: toLocalIterator() runs one Spark job per partition, so only one partition is held on the driver
+    at a time. The later jobs reuse the output of the group shuffle, but each one has its own scheduling
+    overhead. group_ids optionally restricts the output to some groups.
+    """
+    if group_ids is not None:
+        wanted = tagged.context.broadcast(set(group_ids))
+        tagged = tagged.filter(lambda x: x[0] in wanted.value)
+    return tagged.mapPartitions(_group_partition, preservesPartitioning=True).toLocalIterator()
+
+
+def write_feature_store(tagged, profiles, path, target_columns=CLIMATE_COLUMNS):
+    """
+    Stream the tagged rows to the driver one partition at a time and write them to a FeatureStore at path,
+    group by group: features from the sparse profile matrix, targets are the climate deltas of each row.
+    Returns the opened store.
+    """
+    writer = FeatureStoreWriter(path, profiles.pollutants, target_columns)
+    for group_id, rows in iter_group_datasets(tagged):
+        facility_ids = [int(row[0]) for row in rows]
+        writer.append(facility_ids, profiles.dense(facility_ids), [row[1][1:] for row in rows], group_ids=group_id)
+    return writer.close()
+
+
+def station_averages(lines):
+    """
+    Yearly averages per station from the lines of weather.csv (header included).
+    Rows are (name, station, year, lat, lon, country, avg_temp, avg_max_temp, avg_prcp).
+    """
+    # Store the header in a separate variable
+    header = lines.first()
+    lines = lines.filter(lambda line: line != header)
+
+    # Parse each line into a tuple of values, dropping state and the unwanted field avg_snow_depth
+    rdd = lines.map(lambda line: tuple(line.split(",")[1:]))
+    filtered_rdd = rdd.map(lambda x: (x[0], x[1], x[2], x[3], float(x[4]), float(x[5]), float(x[6]), float(x[7]), float(x[8]), x[10]))
+
+    # create key-value pairs with name, year as key and (avg_temp, avg_max_temp, avg_prcp, count) as value
+    keyed_rdd = filtered_rdd.map(lambda x: ((x[0], x[1], x[2], x[5], x[6], x[9]), (x[4], x[7], x[8], 1))) \
+        .reduceByKey(lambda x, y: (x[0]+y[0], x[1]+y[1], x[2]+y[2], x[3]+y[3]))
+
+    # calculate averages for each name, year
+    return keyed_rdd.map(lambda x: (x[0][0], x[0][1], x[0][2], x[0][3], x[0][4], x[0][5], x[1][0]/x[1][3], x[1][1]/x[1][3], x[1][2]/x[1][3]))
+
+
+def merge_facilities_with_climate(sc, spark, weather_path, profiles_path):
+    """
+    Part 3 of predictive_model.py: pair every facility with its nearest weather station and attach the
+    station's climate deltas. Returns (final, change_rdd) where final rows are
+    (FacilityID, (profile, d_temp, d_max_temp, d_prcp)).
+    """
+    change_rdd = climate_deltas(station_averages(sc.textFile(weather_path))).cache()
+
+    # Read the emission profiles from the Parquet copy, only the columns each step needs are decoded
+    profileColumns = pollutant_columns(load_profiles_spark(spark, profiles_path).columns)
+    locations = load_profiles_spark(spark, profiles_path, ['FacilityID', 'Lat', 'Long']) \
+        .rdd.map(lambda x: (str(x[0]), (float(x[1]), float(x[2]))))
+    stations = change_rdd.map(lambda x: (x[0][0], (x[0][2], x[0][3])))
+
+    # Nearest weather station of each facility through the broadcast spatial index
+    nearest = nearest_stations(sc, locations, stations, k=1)
+
+    emissions = load_profiles_spark(spark, profiles_path, ['FacilityID'] + profileColumns) \
+        .rdd.map(lambda x: (str(x[0]), tuple(x[1:])))
+    # station name -> (station, lat, lon, d_temp, d_max_temp, d_prcp)
+    climate = change_rdd.map(lambda x: (x[0][0], (x[0][1], x[0][2], x[0][3], x[1][0], x[1][1], x[1][2])))
+
+    by_station = nearest.join(emissions).map(lambda x: (x[1][0], (x[0], x[1][1])))
+    final = by_station.join(climate).map(lambda x: (x[1][0][0], (x[1][0][1], x[1][1][3], x[1][1][4], x[1][1][5])))
+    return final, change_rdd
+
+
+def _first_last_seed(row):
+    # (earliest year, its values, latest year, its values)
+    year, values = row
+    return year, values, year, values
+
+
+def _first_last_add(acc, row):
+    year, values = row
+    first_year, first, last_year, last = acc
+    if year < first_year:
+        first_year, first = year, values
+    if year > last_year:
+        last_year, last = year, values
+    return first_year, first, last_year, last
+
+
+def _first_last_merge(a, b):
+    first = a[:2] if a[0] <= b[0] else b[:2]
+    last = a[2:] if a[2] >= b[2] else b[2:]
+    return first + last
+
+
+def climate_deltas(avg_rdd):
+    """
+    Change in (avg_temp, avg_max_temp, avg_prcp) between the earliest and the latest year of every station.
+    avg_rdd rows are (name, station, year, lat, lon, country, temp, max_temp, prcp); the result is keyed by
+    (name, station, lat, lon) like change_rdd in predictive_model.py. A single combineByKey keeps only the
+    earliest and latest year per station, so the shuffle carries O(stations) records.
+    """
+    keyed = avg_rdd.map(lambda x: ((x[0], x[1], x[3], x[4]), (x[2], (x[6], x[7], x[8]))))
+    first_last = keyed.combineByKey(_first_last_seed, _first_last_add, _first_last_merge)
+    return first_last.mapValues(lambda x: (x[3][0] - x[1][0], x[3][1] - x[1][1], x[3][2] - x[1][2]))
+
+
+def correlation_moments(tagged, batch_size=4096):
+    """
+    Pollutant x climate-variable correlation statistics over all rows, computed in one pass. tagged rows
+    are (group_id, (FacilityID, (profile, d_temp, d_max_temp, d_prcp))) as produced by tag_groups(). Each
+    partition folds its rows into CorrelationMoments in NumPy batches, only one set of moments per
+    partition (pollutants x 3 numbers) reaches the driver. Returns the merged CorrelationMoments.
+    """
+    def partition_moments(rows):
+        batch = []
+        moments = None
+
+        def flush(moments):
+            X, Y = zip(*batch)
+            block = CorrelationMoments.from_batch(np.array(X, dtype=np.float64), np.array(Y, dtype=np.float64))
+            batch.clear()
+            return block if moments is None else moments.merge(block)
+
+        for _, row in rows:
+            values = row[1]
+            batch.append(([float(v or 0) for v in values[0]], [float(v) for v in values[1:]]))
+            if len(batch) >= batch_size:
+                moments = flush(moments)
+        if batch:
+            moments = flush(moments)
+        return [moments] if moments is not None else []
+
+    return tagged.mapPartitions(partition_moments).reduce(lambda a, b: a.merge(b))
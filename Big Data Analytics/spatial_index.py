@@ -0,0 +1,111 @@
+"""
+General description of the code: Nearest weather station lookup for facilities.
+Stations are placed on the unit sphere as 3-D points and indexed with a KD-tree, so the
+straight-line (chord) distance between two points orders them exactly like the great circle
+distance. This replaces the facility x station cartesian product in Part 3 of predictive_model.py.
+Frameworks used here: NumPy, SciPy, PySpark
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from geo_distance import EARTH_RADIUS_KM, haversine_np
+
+
+def to_unit_sphere(lat, lon):
+    """
+    Convert latitudes/longitudes (decimal degrees) into 3-D points on the unit sphere
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def km_to_chord(km):
+    """
+    Great circle distance in kilometers -> chord length on the unit sphere
+    """
+    return 2 * np.sin(np.minimum(np.asarray(km, dtype=np.float64) / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+def chord_to_km(chord):
+    """
+    Chord length on the unit sphere -> great circle distance in kilometers
+    """
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord, dtype=np.float64) / 2, 0, 1))
+
+
+class StationIndex:
+    """
+    Spatial index over weather stations.
+    stations is a list of (station, (lat, lon)) pairs, the same layout as rdd2 in predictive_model.py
+    """
+
+    def __init__(self, stations):
+        stations = list(stations)
+        self.names = np.array([s[0] for s in stations], dtype=object)
+        coords = np.array([s[1] for s in stations], dtype=np.float64).reshape(-1, 2)
+        self.lat = coords[:, 0]
+        self.lon = coords[:, 1]
+        self.tree = cKDTree(to_unit_sphere(self.lat, self.lon))
+
+    def __len__(self):
+        return len(self.names)
+
+    def query(self, lat, lon, k=1, max_km=None):
+        """
+        Find the k nearest stations for every (lat, lon) point.
+        Returns (distances_km, positions), both shaped [num_points, k]. Neighbours further than
+        max_km are reported with an infinite distance and a position of len(self).
+        """
+        points = to_unit_sphere(lat, lon).reshape(-1, 3)
+        k = min(k, len(self))
+        bound = np.inf if max_km is None else km_to_chord(max_km) * (1 + 1e-12)
+        chords, positions = self.tree.query(points, k=k, distance_upper_bound=bound)
+        chords = np.asarray(chords).reshape(len(points), k)
+        positions = np.asarray(positions).reshape(len(points), k)
+        # Report exact haversine distances for the neighbours that were found
+        found = ~np.isinf(chords)
+        safe = np.where(found, positions, 0)
+        lat = np.broadcast_to(np.asarray(lat, dtype=np.float64).reshape(-1, 1), safe.shape)
+        lon = np.broadcast_to(np.asarray(lon, dtype=np.float64).reshape(-1, 1), safe.shape)
+        distances = np.where(found, haversine_np(lon, lat, self.lon[safe], self.lat[safe]), np.inf)
+        return distances, positions
+
+    def nearest(self, facilities, k=1, max_km=None):
+        """
+        Yield (FacilityID, station, distance_km) for the k nearest stations of each facility.
+        facilities is an iterable of (FacilityID, (lat, lon)) pairs, the same layout as rdd1 in predictive_model.py
+        """
+        facilities = list(facilities)
+        if not facilities or not len(self):
+            return
+        ids = [f[0] for f in facilities]
+        coords = np.array([f[1] for f in facilities], dtype=np.float64).reshape(-1, 2)
+        distances, positions = self.query(coords[:, 0], coords[:, 1], k=k, max_km=max_km)
+        for facility_id, row_distances, row_positions in zip(ids, distances, positions):
+            for distance, position in zip(row_distances, row_positions):
+                if np.isinf(distance):
+                    break
+                yield facility_id, self.names[position], float(distance)
+
+
+def nearest_stations(sc, facility_rdd, station_rdd, k=1, max_km=None, with_distance=False):
+    """
+    Nearest station join without a cartesian product.
+    The stations are collected once, indexed on the driver and broadcast to the executors; every
+    facility partition is then answered with one batched tree query.
+    Returns an RDD of (FacilityID, station) pairs (or (FacilityID, station, distance_km) with
+    with_distance=True). With k > 1 a facility appears once per neighbour, nearest first.
+    """
+    index = sc.broadcast(StationIndex(station_rdd.collect()))
+
+    def query_partition(rows):
+        for facility_id, station, distance in index.value.nearest(rows, k=k, max_km=max_km):
+            if with_distance:
+                yield facility_id, station, distance
+            else:
+                yield facility_id, station
+
+    return facility_rdd.mapPartitions(query_partition)
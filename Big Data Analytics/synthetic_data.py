@@ -0,0 +1,201 @@
+"""
+General description of the code: Synthetic E-PRTR and GSOD data for offline runs and benchmarks.
+Writes the three E-PRTR tables read by emission_profiles.py (reports, facility reports, pollutant releases)
+and the GSOD tables read by weather_data.DuckDBBackend (stations.csv, gsod<year>.csv), plus the weather.csv
+they aggregate to, all with the real column names. The size is set by the number of release rows
+(10k to 10M); facilities belong to a few industry archetypes, so similar facilities report similar
+pollutants and the similarity groups are not trivial. Tables are written in chunks, memory stays bounded.
+Frameworks used here: NumPy, pandas
+"""
+
+import argparse
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from emission_profiles import FACILITY_REPORT_FILE, POLLUTANT_RELEASE_FILE, REPORT_FILE
+from weather_data import columns as WEATHER_COLUMNS
+
+# (code, name, lat, lon) of the countries facilities and stations are placed in
+COUNTRIES = [('AT', 'Austria', 47.6, 14.1), ('BE', 'Belgium', 50.6, 4.6), ('CZ', 'Czechia', 49.8, 15.5),
+             ('DE', 'Germany', 51.2, 10.4), ('DK', 'Denmark', 56.0, 9.5), ('ES', 'Spain', 40.2, -3.6),
+             ('FI', 'Finland', 62.5, 26.0), ('FR', 'France', 46.6, 2.4), ('GR', 'Greece', 39.1, 22.0),
+             ('HU', 'Hungary', 47.2, 19.4), ('IE', 'Ireland', 53.2, -8.0), ('IT', 'Italy', 42.8, 12.6),
+             ('NL', 'Netherlands', 52.2, 5.5), ('PL', 'Poland', 52.0, 19.1), ('PT', 'Portugal', 39.6, -8.0),
+             ('RO', 'Romania', 45.9, 24.9), ('SE', 'Sweden', 60.1, 15.0), ('SK', 'Slovakia', 48.7, 19.7)]
+
+POLLUTANTS = ['Ammonia (NH3)', 'Arsenic and compounds (as As)', 'Benzene', 'Cadmium and compounds (as Cd)',
+              'Carbon dioxide (CO2)', 'Carbon monoxide (CO)', 'Chlorides (as total Cl)', 'Chromium and compounds (as Cr)',
+              'Copper and compounds (as Cu)', 'Dichloromethane (DCM)', 'Fluorides (as total F)', 'Hydrochlorofluorocarbons (HCFCs)',
+              'Hydrogen cyanide (HCN)', 'Lead and compounds (as Pb)', 'Mercury and compounds (as Hg)', 'Methane (CH4)',
+              'Nickel and compounds (as Ni)', 'Nitrogen oxides (NOX)', 'Nitrous oxide (N2O)', 'Non-methane volatile organic compounds (NMVOC)',
+              'Particulate matter (PM10)', 'Phenols (as total C)', 'Sulphur oxides (SOX)', 'Total nitrogen',
+              'Total organic carbon (TOC)', 'Total phosphorus', 'Zinc and compounds (as Zn)']
+
+YEARS = [2015, 2016, 2017, 2018]
+NUM_ARCHETYPES = 12
+POLLUTANTS_PER_ARCHETYPE = 8
+# Probability that a facility reports one of its archetype's pollutants in a given year
+REPORT_PROBABILITY = 0.6
+
+
+def parse_scale(value):
+    """
+    '10k', '2.5M' or '10000' -> number of release rows
+    """
+    match = re.fullmatch(r'([0-9.]+)\s*([kKmM]?)', str(value).strip())
+    if not match:
+        raise ValueError("not a scale factor: {}".format(value))
+    return int(float(match.group(1)) * {'': 1, 'k': 10 ** 3, 'm': 10 ** 6}[match.group(2).lower()])
+
+
+class SyntheticEPRTR:
+    """
+    Facilities, stations and their properties for a target number of release rows, reproducible from seed
+    """
+
+    def __init__(self, release_rows, years=YEARS, seed=0, facilities_per_station=20):
+        self.release_rows = release_rows
+        self.years = list(years)
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        rows_per_report = POLLUTANTS_PER_ARCHETYPE * REPORT_PROBABILITY
+        self.num_facilities = max(int(release_rows / (len(self.years) * rows_per_report)), 1)
+
+        # Archetypes: which pollutants they emit and how much (log10 of the typical quantity)
+        self.archetype_pollutants = np.stack([rng.choice(len(POLLUTANTS), POLLUTANTS_PER_ARCHETYPE, replace=False)
+                                              for _ in range(NUM_ARCHETYPES)])
+        self.archetype_scale = rng.uniform(1.0, 7.0, size=(NUM_ARCHETYPES, POLLUTANTS_PER_ARCHETYPE))
+
+        n = self.num_facilities
+        self.facility_ids = np.arange(1, n + 1, dtype=np.int64)
+        self.archetype = rng.integers(0, NUM_ARCHETYPES, n)
+        self.size = rng.lognormal(0.0, 0.5, n)
+        self.country = rng.integers(0, len(COUNTRIES), n)
+        centres = np.array([(lat, lon) for _, _, lat, lon in COUNTRIES])
+        self.location = centres[self.country] + rng.normal(0.0, 1.5, size=(n, 2))
+
+        num_stations = max(n // facilities_per_station, len(COUNTRIES))
+        self.station_country = np.arange(num_stations) % len(COUNTRIES)
+        self.station_location = centres[self.station_country] + rng.normal(0.0, 1.5, size=(num_stations, 2))
+        # Warming trend per station (degrees per year) and precipitation level
+        self.station_trend = rng.normal(0.05, 0.1, num_stations)
+        self.station_prcp = rng.gamma(2.0, 0.05, num_stations)
+
+    def report_ids(self):
+        """
+        PollutantReleaseAndTransferReportID of (country, year), one report per country and year
+        """
+        return {(c, year): 1 + c * len(self.years) + t for c in range(len(COUNTRIES)) for t, year in enumerate(self.years)}
+
+    def write_eprtr(self, out_dir, chunk_facilities=100000):
+        """
+        Write the three dbo.PUBLISH_* tables to out_dir, returns the number of release rows written
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        report_ids = self.report_ids()
+        reports = pd.DataFrame([(report_ids[c, year], year, COUNTRIES[c][0], COUNTRIES[c][1]) for c, year in sorted(report_ids)],
+                               columns=['PollutantReleaseAndTransferReportID', 'ReportingYear', 'CountryCode', 'CountryName'])
+        reports.to_csv(os.path.join(out_dir, REPORT_FILE), index=False, encoding='latin-1')
+
+        rng = np.random.default_rng(self.seed + 1)
+        facility_path = os.path.join(out_dir, FACILITY_REPORT_FILE)
+        release_path = os.path.join(out_dir, POLLUTANT_RELEASE_FILE)
+        first, written, next_report = True, 0, 1
+        for t, year in enumerate(self.years):
+            for start in range(0, self.num_facilities, chunk_facilities):
+                rows = np.arange(start, min(start + chunk_facilities, self.num_facilities))
+                report_of = 1 + self.country[rows] * len(self.years) + t
+                facility_report_ids = np.arange(next_report, next_report + len(rows), dtype=np.int64)
+                next_report += len(rows)
+                pd.DataFrame({'FacilityReportID': facility_report_ids, 'PollutantReleaseAndTransferReportID': report_of,
+                              'FacilityID': self.facility_ids[rows], 'FacilityName': ['Facility {}'.format(i) for i in self.facility_ids[rows]],
+                              'Lat': self.location[rows, 0], 'Long': self.location[rows, 1]}) \
+                    .to_csv(facility_path, mode='w' if first else 'a', header=first, index=False, encoding='latin-1')
+
+                # Every facility report holds a random subset of its archetype's pollutants
+                reported = rng.random((len(rows), POLLUTANTS_PER_ARCHETYPE)) < REPORT_PROBABILITY
+                report_rows, slots = np.nonzero(reported)
+                archetypes = self.archetype[rows][report_rows]
+                log_quantity = self.archetype_scale[archetypes, slots] + np.log10(self.size[rows][report_rows]) + \
+                    rng.normal(0.0, 0.3, len(report_rows))
+                releases = pd.DataFrame({'PollutantReleaseID': np.arange(written + 1, written + len(report_rows) + 1),
+                                         'FacilityReportID': facility_report_ids[report_rows],
+                                         'ReleaseMediumCode': 'AIR',
+                                         'PollutantName': np.asarray(POLLUTANTS, dtype=object)[self.archetype_pollutants[archetypes, slots]],
+                                         'TotalQuantity': np.round(10.0 ** log_quantity, 3)})
+                releases.to_csv(release_path, mode='w' if first else 'a', header=first, index=False, encoding='latin-1')
+                written += len(releases)
+                first = False
+        return written
+
+    def station_table(self):
+        n = len(self.station_country)
+        return pd.DataFrame({'usaf': np.arange(100000, 100000 + n), 'wban': 99999,
+                             'name': ['STATION {}'.format(i) for i in range(n)],
+                             'country': [COUNTRIES[c][0] for c in self.station_country], 'state': '',
+                             'lat': self.station_location[:, 0], 'lon': self.station_location[:, 1]})
+
+    def gsod_year(self, year, days_per_month=4):
+        """
+        Daily GSOD-style rows (stn, wban, year, mo, da, temp, max, prcp, sndp) of one year, in Fahrenheit like GSOD
+        """
+        rng = np.random.default_rng(self.seed + year)
+        n = len(self.station_country)
+        station = np.repeat(np.arange(n), 12 * days_per_month)
+        month = np.tile(np.repeat(np.arange(1, 13), days_per_month), n)
+        seasonal = 50.0 - 0.8 * (self.station_location[station, 0] - 45.0) - 20.0 * np.cos((month - 1) / 12.0 * 2 * np.pi)
+        temp = seasonal + self.station_trend[station] * (year - self.years[0]) * 1.8 + rng.normal(0.0, 4.0, len(station))
+        return pd.DataFrame({'stn': 100000 + station, 'wban': 99999, 'year': year, 'mo': month,
+                             'da': np.tile(np.arange(1, days_per_month + 1), n * 12),
+                             'temp': np.round(temp, 1), 'max': np.round(temp + rng.gamma(4.0, 2.0, len(station)), 1),
+                             'prcp': np.round(rng.exponential(self.station_prcp[station]), 2), 'sndp': 999.9})
+
+    def write_gsod(self, out_dir, days_per_month=4):
+        """
+        stations.csv and gsod<year>.csv for weather_data.DuckDBBackend, and the weather.csv they aggregate to
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        stations = self.station_table()
+        stations.to_csv(os.path.join(out_dir, 'stations.csv'), index=False)
+        monthly = []
+        for year in self.years:
+            gsod = self.gsod_year(year, days_per_month)
+            gsod.to_csv(os.path.join(out_dir, 'gsod{}.csv'.format(year)), index=False)
+            # Same aggregation as weather_data.QUERY
+            joined = gsod.merge(stations, left_on='stn', right_on='usaf')
+            month = joined.groupby(['state', 'name', 'mo'], sort=True).agg(
+                station=('stn', 'min'), year=('year', 'min'), avg_temp=('temp', 'mean'), avg_lat=('lat', 'mean'),
+                avg_lon=('lon', 'mean'), avg_max_temp=('max', 'mean'), avg_prcp=('prcp', 'mean'),
+                avg_snow_depth=('sndp', 'mean'), country=('country', 'first')).reset_index()
+            monthly.append(month.rename(columns={'mo': 'month'})[WEATHER_COLUMNS])
+        weather = pd.concat(monthly, ignore_index=True)
+        weather.to_csv(os.path.join(out_dir, 'weather.csv'), index=False)
+        return weather
+
+
+def generate(out_dir, release_rows, seed=0, days_per_month=4):
+    """
+    E-PRTR tables in out_dir/eprtr, GSOD tables and weather.csv in out_dir/gsod.
+    Returns {'release_rows', 'facilities', 'stations', 'weather_rows'}
+    """
+    data = SyntheticEPRTR(release_rows, seed=seed)
+    written = data.write_eprtr(os.path.join(out_dir, 'eprtr'))
+    weather = data.write_gsod(os.path.join(out_dir, 'gsod'), days_per_month)
+    return {'release_rows': written, 'facilities': data.num_facilities, 'stations': len(data.station_country),
+            'weather_rows': len(weather)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic E-PRTR and GSOD data")
+    parser.add_argument("--scale", default="10k", help="number of release rows, e.g. 10k, 1M, 10M")
+    parser.add_argument("--output-dir", default="synthetic_data")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.output_dir, parse_scale(args.scale), args.seed))
+
+
+if __name__ == "__main__":
+    main()
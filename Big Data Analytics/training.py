@@ -0,0 +1,214 @@
+"""
+General description of the code: Training runner for FacilityEmissionsLSTM on CPU nodes.
+Adds what the bare loop in Part 4 of predictive_model.py did not have: configurable intra-op threads and
+DataLoader workers, optional bf16 autocast, a validation split with early stopping, periodic checkpoints
+that a later run on the same model and data can resume from, and data-parallel training over several processes (gloo backend).
+Epochs and per-batch throughput are recorded by instrumentation.profiler when it is enabled.
+Frameworks used here: PyTorch
+"""
+
+import hashlib
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, random_split
+from torch.utils.data.distributed import DistributedSampler
+
+from instrumentation import profiler
+
+
+def _split(dataset, val_fraction, seed):
+    val_size = int(len(dataset) * val_fraction)
+    if val_size == 0:
+        return dataset, None
+    generator = torch.Generator().manual_seed(seed)
+    return random_split(dataset, [len(dataset) - val_size, val_size], generator=generator)
+
+
+def _loss(net, loader, criterion, bf16):
+    net.eval()
+    total, count = 0.0, 0
+    with torch.no_grad(), torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+        for batch_X, batch_y in loader:
+            output = net(batch_X)
+            total += criterion(output.float().squeeze(), batch_y).item() * len(batch_y)
+            count += len(batch_y)
+    net.train()
+    return total / max(count, 1)
+
+
+def fingerprint(net, dataset, samples=64):
+    """
+    Hash of the model's parameter shapes and of the dataset (its length and a strided sample of its rows),
+    a checkpoint is only resumed by a run with the same fingerprint
+    """
+    h = hashlib.sha1()
+    for name, value in net.state_dict().items():
+        h.update('{}{}'.format(name, tuple(value.shape)).encode())
+    h.update(str(len(dataset)).encode())
+    for idx in sorted({int(i) for i in torch.linspace(0, len(dataset) - 1, min(samples, len(dataset))).tolist()}):
+        for tensor in dataset[idx]:
+            h.update(torch.as_tensor(tensor).contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def save_checkpoint(path, net, optimizer, epoch, best_val, bad_epochs, run_fingerprint=None):
+    state = {'model': net.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch,
+             'best_val': best_val, 'bad_epochs': bad_epochs, 'rng': torch.get_rng_state(),
+             'fingerprint': run_fingerprint}
+    # Write then rename so a crash during saving never corrupts the previous checkpoint
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, net, optimizer, run_fingerprint=None):
+    """
+    Restore net and optimizer from path, returns (epoch, best_val, bad_epochs), or None when the
+    checkpoint was written for another model or dataset
+    """
+    state = torch.load(path, map_location='cpu')
+    if state.get('fingerprint') != run_fingerprint:
+        return None
+    net.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    torch.set_rng_state(state['rng'])
+    return state['epoch'], state['best_val'], state['bad_epochs']
+
+
+def train_model(net, dataset, num_epochs=15, batch_size=128, lr=0.01, val_fraction=0.1, patience=3,
+                num_threads=None, num_workers=0, bf16=False, checkpoint_dir=None, checkpoint_every=1,
+                resume=False, seed=0, rank=0, world_size=1, log=print):
+    """
+    Train net on dataset with MSE loss and Adam, like Part 4 of predictive_model.py.
+    Training stops after patience epochs without a better validation loss; the best weights are
+    restored at the end. With checkpoint_dir, checkpoint_dir/last.pt is written every checkpoint_every
+    epochs and checkpoint_dir/best.pt holds the best model. With resume, last.pt is resumed from if it was
+    written for the same model configuration and data (see fingerprint()); otherwise training starts fresh.
+    rank/world_size are set by train_distributed(). Returns the list of (epoch, train_loss, val_loss).
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    torch.manual_seed(seed)
+
+    train_set, val_set = _split(dataset, val_fraction, seed)
+    sampler = DistributedSampler(train_set, world_size, rank, shuffle=True, seed=seed) if world_size > 1 else None
+    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=sampler is None, sampler=sampler,
+                              num_workers=num_workers, persistent_workers=num_workers > 0)
+    val_loader = DataLoader(val_set, batch_size=batch_size * 4, num_workers=num_workers) if val_set is not None else None
+
+    model = DistributedDataParallel(net) if world_size > 1 else net
+    criterion = nn.MSELoss()
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+
+    start_epoch, best_val, bad_epochs = 0, float('inf'), 0
+    last_path = best_path = run_fingerprint = None
+    if checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        last_path = os.path.join(checkpoint_dir, 'last.pt')
+        best_path = os.path.join(checkpoint_dir, 'best.pt')
+        run_fingerprint = fingerprint(net, dataset)
+        if resume and os.path.exists(last_path):
+            restored = load_checkpoint(last_path, net, optimizer, run_fingerprint)
+            if restored is not None:
+                start_epoch, best_val, bad_epochs = restored
+            if rank == 0:
+                log(f"Resumed from epoch {start_epoch}" if restored is not None else
+                    f"{last_path} was written for another model or dataset, starting fresh")
+            if restored is not None and (bad_epochs >= patience or start_epoch >= num_epochs):
+                # The resumed run had already stopped early or finished; no epoch may overwrite its checkpoints
+                if rank == 0:
+                    log(f"Training already finished at epoch {start_epoch}")
+                start_epoch = max(start_epoch, num_epochs)
+
+    best_state = None
+    history = []
+    for epoch in range(start_epoch, num_epochs):
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+        total, count = 0.0, 0
+        with profiler.stage('train_epoch') as span:
+            batch_start = time.perf_counter()
+            for batch_X, batch_y in train_loader:
+                optimizer.zero_grad()
+                with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+                    output = model(batch_X)
+                loss = criterion(output.float().squeeze(), batch_y)
+                loss.backward()
+                optimizer.step()
+                total += loss.item() * len(batch_y)
+                count += len(batch_y)
+                if profiler.enabled:
+                    # Includes the wait for the DataLoader, so input stalls show up as lower throughput
+                    now = time.perf_counter()
+                    profiler.counter('train_throughput', samples_per_s=len(batch_y) / max(now - batch_start, 1e-9))
+                    batch_start = now
+            span.rows_in = count
+            span.set(epoch=epoch + 1, rank=rank)
+        train_loss = total / max(count, 1)
+
+        # Every rank holds the same weights after the all-reduce, so every rank reaches the same decision
+        val_loss = _loss(net, val_loader, criterion, bf16) if val_loader is not None else train_loss
+        if val_loss < best_val:
+            best_val, bad_epochs = val_loss, 0
+            best_state = {k: v.detach().clone() for k, v in net.state_dict().items()}
+            if best_path and rank == 0:
+                torch.save(net.state_dict(), best_path)
+        else:
+            bad_epochs += 1
+        history.append((epoch + 1, train_loss, val_loss))
+
+        if rank == 0:
+            log(f"Epoch {epoch+1}/{num_epochs}, Loss: {train_loss}, Validation loss: {val_loss}")
+            if last_path and ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == num_epochs):
+                save_checkpoint(last_path, net, optimizer, epoch + 1, best_val, bad_epochs, run_fingerprint)
+        if bad_epochs >= patience:
+            if rank == 0:
+                log(f"Early stopping after epoch {epoch+1}")
+                if last_path:
+                    save_checkpoint(last_path, net, optimizer, epoch + 1, best_val, bad_epochs, run_fingerprint)
+            break
+
+    if best_state is not None:
+        net.load_state_dict(best_state)
+    elif best_path and start_epoch > 0 and os.path.exists(best_path):
+        # Resumed and no epoch improved on the resumed best_val: best.pt is from the same run
+        net.load_state_dict(torch.load(best_path, map_location='cpu'))
+    return history
+
+
+def _worker(rank, world_size, build_model, dataset, port, kwargs):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        net = build_model()
+        train_model(net, dataset, rank=rank, world_size=world_size, **kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def train_distributed(build_model, dataset, world_size=None, port=29500, **kwargs):
+    """
+    Data-parallel training over world_size processes on this machine with the gloo backend.
+    build_model() must return a fresh FacilityEmissionsLSTM and be picklable, since mp.spawn sends it to
+    every process: a functools.partial or a module-level function, not a lambda, e.g.
+    train_distributed(partial(FacilityEmissionsLSTM, input_size, 40, 5, output_size), dataset, checkpoint_dir=...).
+    Every process gets the cores divided evenly unless num_threads is given. Requires checkpoint_dir, the
+    trained weights are read back from best.pt.
+    """
+    world_size = world_size or max(1, (os.cpu_count() or 1) // 4)
+    if not kwargs.get('checkpoint_dir'):
+        raise ValueError("train_distributed needs a checkpoint_dir to hand the trained model back")
+    kwargs.setdefault('num_threads', max(1, (os.cpu_count() or 1) // world_size))
+    mp.spawn(_worker, args=(world_size, build_model, dataset, port, kwargs), nprocs=world_size, join=True)
+    net = build_model()
+    best_path = os.path.join(kwargs['checkpoint_dir'], 'best.pt')
+    if os.path.exists(best_path):
+        net.load_state_dict(torch.load(best_path, map_location='cpu'))
+    return net
@@ -14,52 +14,96 @@ System used to run the code: Google Colab
 
 """
 
-import bq_helper
-from bq_helper import BigQueryHelper
-import pandas as pd
-
-# create BigQueryHelper objects for the NOAA GSOD dataset in the bigquery-public-data and fh-bigquery projects
-noaa = bq_helper.BigQueryHelper(active_project="bigquery-public-data",
-                                   dataset_name="ghcn_d")
-
-noaa = bq_helper.BigQueryHelper(active_project="fh-bigquery",
-                                   dataset_name="weather_gsod")
-
-# create a BigQueryHelper object for the NOAA GSOD dataset in the bigquery-public-data project
-bq_assistant = BigQueryHelper("bigquery-public-data", "noaa_gsod")
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-df=pd.DataFrame(bq_assistant.head("stations"))
+import pandas as pd
 
 # create a list of the European Union country codes
 european_union = ['AT', 'BE', 'BG', 'CY', 'CZ', 'DE', 'DK', 'EE', 'ES', 'FI', 'FR', 'GR', 'HR', 'HU', 'IE', 'IT', 'LT', 'LU', 'LV', 'MT', 'NL', 'PL', 'PT', 'RO', 'SE', 'SI', 'SK']
-
-# create an empty DataFrame to hold the weather data
-data = pd.DataFrame()
-
-# loop through each European Union country and query weather data for 2015-2018
-for each in european_union:
-    QUERY15 = """select state, name, min(stn), min(year), mo, avg(temp), avg(lat), avg(lon), avg(max), avg(prcp), avg(sndp) from`bigquery-public-data.noaa_gsod.stations` b JOIN `bigquery-public-data.noaa_gsod.gsod2015`a 
-    ON a.wban=b.wban AND a.stn=b.usaf where b.country = '{}' group by state, name, mo""".format(each)
-    weather15 = bq_assistant.query_to_pandas(QUERY15)
-
-    QUERY16 = """select state, name, min(stn), min(year), mo, avg(temp), avg(lat), avg(lon), avg(max), avg(prcp), avg(sndp) from`bigquery-public-data.noaa_gsod.stations` b JOIN `bigquery-public-data.noaa_gsod.gsod2016`a 
-    ON a.wban=b.wban AND a.stn=b.usaf where b.country = '{}' group by state, name, mo""".format(each)
-    weather16= bq_assistant.query_to_pandas(QUERY16)
-
-
-    QUERY17 =  """select state, name, min(stn), min(year), mo, avg(temp), avg(lat), avg(lon), avg(max), avg(prcp), avg(sndp) from`bigquery-public-data.noaa_gsod.stations` b JOIN `bigquery-public-data.noaa_gsod.gsod2017`a 
-    ON a.wban=b.wban AND a.stn=b.usaf where b.country = '{}' group by state, name, mo""".format(each)
-    weather17= bq_assistant.query_to_pandas(QUERY17)
-
-    QUERY18 = """select state, name, min(stn), min(year), mo, avg(temp), avg(lat), avg(lon), avg(max), avg(prcp), avg(sndp) from`bigquery-public-data.noaa_gsod.stations` b JOIN `bigquery-public-data.noaa_gsod.gsod2018`a 
-    ON a.wban=b.wban AND a.stn=b.usaf where b.country = '{}' group by state, name, mo""".format(each)
-    
-    weather18= bq_assistant.query_to_pandas(QUERY18)
-    temp = pd.concat([weather15, weather16, weather17, weather18])
-    temp['country'] = each
-    data = pd.concat([data, temp])
-
-    
-data.columns = ['state','name', 'station', 'year', 'month', 'avg_temp','avg_lat', 'avg_lon', 'avg_max_temp', 'avg_prcp', 'avg_snow_depth', 'country']
-
-data.to_csv('weather.csv', index = False)
\ No newline at end of file
+years = [2015, 2016, 2017, 2018]
+
+columns = ['state','name', 'station', 'year', 'month', 'avg_temp','avg_lat', 'avg_lon', 'avg_max_temp', 'avg_prcp', 'avg_snow_depth', 'country']
+
+# Monthly averages per station for one country and one year; {stations} and {gsod} are filled in by the backend
+QUERY = """select state, name, min(stn), min(year), mo, avg(temp), avg(lat), avg(lon), avg(max), avg(prcp), avg(sndp) from {stations} b JOIN {gsod} a 
+    ON a.wban=b.wban AND a.stn=b.usaf where b.country = '{country}' group by state, name, mo"""
+
+
+class BigQueryBackend:
+    """
+    NOAA GSOD tables in the bigquery-public-data project, queried through bq_helper
+    """
+
+    def __init__(self):
+        from bq_helper import BigQueryHelper
+        # create a BigQueryHelper object for the NOAA GSOD dataset in the bigquery-public-data project
+        self.bq_assistant = BigQueryHelper("bigquery-public-data", "noaa_gsod")
+
+    def query(self, country, year):
+        sql = QUERY.format(stations='`bigquery-public-data.noaa_gsod.stations`',
+                           gsod='`bigquery-public-data.noaa_gsod.gsod{}`'.format(year), country=country)
+        return self.bq_assistant.query_to_pandas(sql)
+
+
+class DuckDBBackend:
+    """
+    Local stand-in for BigQuery: the same query run with DuckDB over GSOD files in data_dir
+    (stations.csv and gsod<year>.csv or gsod<year>.parquet, with the BigQuery column names)
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def _table(self, name):
+        parquet = os.path.join(self.data_dir, name + '.parquet')
+        if os.path.exists(parquet):
+            return "read_parquet('{}')".format(parquet)
+        return "read_csv_auto('{}')".format(os.path.join(self.data_dir, name + '.csv'))
+
+    def query(self, country, year):
+        import duckdb
+        sql = QUERY.format(stations=self._table('stations'), gsod=self._table('gsod{}'.format(year)), country=country)
+        # One connection per call, DuckDB connections are not shared between threads
+        with duckdb.connect() as connection:
+            return connection.execute(sql).df()
+
+
+def cache_path(cache_dir, country, year):
+    return os.path.join(cache_dir, 'weather_{}_{}.parquet'.format(country, year))
+
+
+def fetch(backend, country, year, cache_dir):
+    """
+    Weather rows of one (country, year), from the Parquet cache when present
+    """
+    path = cache_path(cache_dir, country, year)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    result = backend.query(country, year)
+    result.columns = columns[:-1]
+    result['country'] = country
+    # Write to a temporary name first so an interrupted run never leaves a partial cache file behind
+    result.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    return result
+
+
+def load_weather(backend, countries=european_union, years=years, cache_dir='weather_cache', max_workers=8):
+    """
+    Query every (country, year) concurrently through a bounded thread pool. Results are cached on disk
+    as Parquet, so a rerun only queries what is missing. Rows come back in (country, year) order.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tasks = [(country, year) for country in countries for year in years]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        parts = list(pool.map(lambda task: fetch(backend, task[0], task[1], cache_dir), tasks))
+    # Single concat instead of growing the frame inside the loop
+    data = pd.concat(parts, ignore_index=True)
+    data.columns = columns
+    return data
+
+
+if __name__ == "__main__":
+    data = load_weather(BigQueryBackend())
+    data.to_csv('weather.csv', index = False)